@@ -15,10 +15,13 @@ warnings.warn("agpy.AG_fft_tools is deprecated."
               DeprecationWarning)
 
 from correlate2d import correlate2d
-from psds import PSD2
-from smooth_tools import smooth
+from psds import PSD2,PSD2_stack
+from smooth_tools import smooth,smooth_planes
 from convolve_nd import convolvend
 from convolve_nd import convolvend as convolve
+from convolve_nd import convolve_separable
+from convolve_tiled import convolve_tiled
 import fast_ffts
 from upsample import dftups,upsample_image
-from shift import shift
+from shift import shift,shift1d,shift_stack,shift1d_stack
+from registration import Registration,register_stack
@@ -4,32 +4,11 @@ ND fft convolution with NaN masking:
 """
 import numpy as np
 import warnings
+import fast_ffts
+from fast_ffts import has_fftw, get_ffts
 #from guppy import hpy
 #heapy = hpy()
 
-try:
-    import fftw3
-    has_fftw = True
-
-    def fftwn(array, nthreads=1):
-        array = array.astype('complex').copy()
-        outarray = array.copy()
-        fft_forward = fftw3.Plan(array, outarray, direction='forward',
-                flags=['estimate'], nthreads=nthreads)
-        fft_forward.execute()
-        return outarray
-
-    def ifftwn(array, nthreads=1):
-        array = array.astype('complex').copy()
-        outarray = array.copy()
-        fft_backward = fftw3.Plan(array, outarray, direction='backward',
-                flags=['estimate'], nthreads=nthreads)
-        fft_backward.execute()
-        return outarray / np.size(array)
-except ImportError:
-    fftn = np.fft.fftn
-    ifftn = np.fft.ifftn
-    has_fftw = False
 # I performed some fft speed tests and found that scipy is slower than numpy
 # http://code.google.com/p/agpy/source/browse/trunk/tests/test_ffts.py However,
 # the speed varied on machines - YMMV.  If someone finds that scipy's fft is
@@ -41,7 +20,7 @@ def convolvend(array, kernel, boundary='fill', fill_value=0,
         psf_pad=False, interpolate_nan=False, quiet=False,
         ignore_edge_zeros=False, min_wt=0.0, normalize_kernel=False,
         use_numpy_fft=not has_fftw, nthreads=1, complextype=np.complex128,
-        use_rfft=False):
+        use_rfft=None, use_fft_cache=True):
     """
     Convolve an ndarray with an nd-kernel.  Returns a convolved image with shape =
     array.shape.  Assumes image & kernel are centered.
@@ -85,8 +64,11 @@ def convolvend(array, kernel, boundary='fill', fill_value=0,
 
     Advanced options
     ----------------
-    fft_pad: bool
-        Default on.  Zero-pad image to the nearest 2^n
+    fft_pad: bool or 'pow2'
+        Default on.  Zero-pad each axis separately to the nearest length
+        whose only prime factors are 2, 3, 5 and 7 (see
+        `fast_ffts.next_fast_len`).  'pow2' restores the old behavior of
+        padding every axis to the same 2^n.
     psf_pad: bool
         Default off.  Zero-pad image to be at least the sum of the image sizes
         (in order to avoid edge-wrapping when smoothing)
@@ -107,6 +89,29 @@ def convolvend(array, kernel, boundary='fill', fill_value=0,
     use_numpy_fft: bool
         Force the code to use the numpy FFTs instead of FFTW even if FFTW is
         installed
+    use_rfft: bool or None
+        Use real-to-complex FFTs (`numpy.fft.rfftn`), which only store half of
+        the (Hermitian) spectrum: the padded arrays, the NaN / edge weight map
+        and the kernel FFT are all real or half-size, halving the memory and
+        roughly halving the FFT work.  The default (None) uses this whenever
+        both `array` and `kernel` are real; set it to False to force the
+        complex path.  `return_fft` still returns the full spectrum.
+    complextype: np.complex128 or np.complex64
+        Precision of the padded arrays and the FFTs.  With np.complex64 the
+        whole computation stays in single precision (float32 arrays on the
+        real-input path) and the result is float32, which halves the peak
+        memory and, with fftw3f or scipy.fft, roughly halves the run time.
+        Single-precision FFTs are accurate to about eps_32 * log2(N) ~ 1e-6
+        relative to the peak of the convolved image, so structure fainter
+        than ~1e-6 of the peak is lost and `min_wt` values below ~1e-6 are
+        not meaningful.
+    use_fft_cache: bool
+        Default on.  Keep the kernel FFT (and the weight map used by
+        `interpolate_nan` / `ignore_edge_zeros` when it does not depend on the
+        data) in `fast_ffts.kernel_cache`, keyed on the padded shape, dtype,
+        kernel contents and nthreads, and reuse the padded work arrays between
+        calls.  Repeatedly convolving same-shaped images with the same kernel
+        then costs only one forward and one inverse FFT per call.
 
     Returns
     -------
@@ -152,53 +157,59 @@ def convolvend(array, kernel, boundary='fill', fill_value=0,
     # complex components, we change the types.  Only the real part will be
     # returned!
     # Check that the arguments are lists or Numpy arrays
-    array = np.asarray(array, dtype=np.complex)
-    kernel = np.asarray(kernel, dtype=np.complex)
+    array = np.asanyarray(array)
+    kernel = np.asanyarray(kernel)
 
     # Check that the number of dimensions is compatible
     if array.ndim != kernel.ndim:
         raise Exception('array and kernel have differing number of'
                         'dimensions')
 
-    # store the dtype for conversion back later
-    array_dtype = array.dtype
-    # turn the arrays into 'complex' arrays
-    if array.dtype.kind != 'c':
-        array = array.astype(np.complex)
-    if kernel.dtype.kind != 'c':
-        kernel = kernel.astype(np.complex)
+    # real inputs can use the half-spectrum (rfftn) transforms throughout
+    real_input = not (np.iscomplexobj(array) or np.iscomplexobj(kernel))
+    if use_rfft is None:
+        use_rfft = real_input
+    elif use_rfft and not real_input:
+        raise ValueError("use_rfft requires a real array and a real kernel")
+    # float32 for complex64, float64 for complex128
+    realtype = np.finfo(complextype).dtype
+    if use_rfft:
+        # the padded arrays and weights are real; the spectra are half-size
+        padtype = realtype
+    else:
+        padtype = complextype
 
     # mask catching - masks must be turned into NaNs for use later
     if np.ma.is_masked(array):
         mask = array.mask
-        array = np.array(array)
+        array = np.array(array, dtype=padtype)
         array[mask] = np.nan
     if np.ma.is_masked(kernel):
         mask = kernel.mask
-        kernel = np.array(kernel)
+        kernel = np.array(kernel, dtype=padtype)
         kernel[mask] = np.nan
 
+    # turn the arrays into 'complex' (or, for rfft, float) arrays
+    array = np.asarray(array, dtype=padtype)
+    kernel = np.asarray(kernel, dtype=padtype)
+
     # replace fftn if has_fftw so that nthreads can be passed
-    global fftn, ifftn
     if use_rfft:
-        fftn = np.fft.rfftn
-        ifftn = np.fft.irfftn
-    elif has_fftw and not use_numpy_fft:
-        def fftn(*args, **kwargs):
-            return fftwn(*args, nthreads=nthreads, **kwargs)
-
-        def ifftn(*args, **kwargs):
-            return ifftwn(*args, nthreads=nthreads, **kwargs)
-    elif use_numpy_fft:
-        fftn = np.fft.fftn
-        ifftn = np.fft.ifftn
+        fftn, irfftn = fast_ffts.get_rffts(nthreads=nthreads,
+                use_numpy_fft=use_numpy_fft, dtype=realtype)
+    else:
+        fftn, ifftn = get_ffts(nthreads=nthreads, use_numpy_fft=use_numpy_fft,
+                dtype=complextype)
 
 
-    # NAN catching
+    # NAN catching.  asarray does not copy inputs that already have padtype,
+    # so zero the NaNs in a copy rather than in the caller's arrays
     nanmaskarray = np.isnan(array)
-    array[nanmaskarray] = 0
+    if nanmaskarray.any():
+        array = np.where(nanmaskarray, 0, array).astype(padtype, copy=False)
     nanmaskkernel = np.isnan(kernel)
-    kernel[nanmaskkernel] = 0
+    if nanmaskkernel.any():
+        kernel = np.where(nanmaskkernel, 0, kernel).astype(padtype, copy=False)
     if ((nanmaskarray.sum() > 0 or nanmaskkernel.sum() > 0) and not interpolate_nan
             and not quiet):
         warnings.warn("NOT ignoring nan values even though they are present" +
@@ -213,7 +224,9 @@ def convolvend(array, kernel, boundary='fill', fill_value=0,
         kernel = kernel / normalize_kernel(kernel)
         kernel_is_normalized = True
     else:
-        if np.abs(kernel.sum() - 1) < 1e-8:
+        # a normalized single-precision kernel only sums to 1 within ~eps_32
+        if np.abs(kernel.sum(dtype=np.complex128) - 1) < max(1e-8,
+                10*np.finfo(realtype).eps):
             kernel_is_normalized = True
         else:
             kernel_is_normalized = False
@@ -244,9 +257,17 @@ def convolvend(array, kernel, boundary='fill', fill_value=0,
     if array.ndim != kernel.ndim:
         raise ValueError("Image and kernel must " +
             "have same number of dimensions")
-    # find ideal size (power of 2) for fft.
+    # find a fast size for the fft (2,3,5,7-smooth or, optionally, power of 2).
     # Can add shapes because they are tuples
-    if fft_pad:
+    if fft_pad and fft_pad != 'pow2':
+        if psf_pad:
+            # each axis only needs to hold the image plus the kernel
+            newshape = np.array([fast_ffts.next_fast_len(imsh+kernsh)
+                for imsh, kernsh in zip(arrayshape, kernshape)])
+        else:
+            newshape = np.array([fast_ffts.next_fast_len(max(imsh, kernsh))
+                for imsh, kernsh in zip(arrayshape, kernshape)])
+    elif fft_pad:
         if psf_pad:
             # add the dimensions and then take the max (bigger)
             fsize = 2**np.ceil(np.log2(
@@ -255,7 +276,7 @@ def convolvend(array, kernel, boundary='fill', fill_value=0,
             # add the shape lists (max of a list of length 4) (smaller)
             # also makes the shapes square
             fsize = 2**np.ceil(np.log2(np.max(arrayshape+kernshape)))
-        newshape = np.array([fsize for ii in range(array.ndim)])
+        newshape = np.array([fsize for ii in range(array.ndim)], dtype=int)
     else:
         if psf_pad:
             # just add the biggest dimensions
@@ -266,6 +287,12 @@ def convolvend(array, kernel, boundary='fill', fill_value=0,
                 for imsh, kernsh in zip(arrayshape, kernshape)])
 
 
+    if use_rfft:
+        # the inverse real transform needs the full shape to tell whether the
+        # last axis has odd length
+        def ifftn(arr):
+            return irfftn(arr, tuple(newshape))
+
     # separate each dimension by the padding size...  this is to determine the
     # appropriate slice size to get back to the input dimensions
     arrayslices = []
@@ -284,16 +311,37 @@ def convolvend(array, kernel, boundary='fill', fill_value=0,
     if tuple(newshape) == arrayshape:
         bigarray = array
     else:
-        bigarray = np.ones(newshape, dtype=complextype) * fill_value
+        if use_fft_cache:
+            bigarray = fast_ffts.get_workspace(newshape, padtype, 'array')
+            bigarray.fill(fill_value)
+        else:
+            bigarray = np.ones(newshape, dtype=padtype) * fill_value
         bigarray[arrayslices] = array
 
-    if tuple(newshape) == kernshape:
-        bigkernel = kernel
+    # the kernel FFT only depends on the (normalized) kernel and the padded
+    # shape, so it can be re-used when smoothing many images the same way
+    if use_fft_cache:
+        kernkey = ('kernfft', tuple(int(s) for s in newshape),
+                np.dtype(padtype).str, fast_ffts.array_digest(kernel),
+                nthreads, use_numpy_fft or not has_fftw, use_rfft)
+        kernfft = fast_ffts.kernel_cache.get(kernkey)
     else:
-        bigkernel = np.zeros(newshape, dtype=complextype)
-        bigkernel[kernslices] = kernel
-    # need to shift the kernel so that, e.g., [0,0,1,0] -> [1,0,0,0] = unity
-    kernfft = fftn(np.fft.ifftshift(bigkernel))
+        kernfft = None
+
+    if kernfft is None:
+        if tuple(newshape) == kernshape:
+            bigkernel = kernel
+        else:
+            if use_fft_cache:
+                bigkernel = fast_ffts.get_workspace(newshape, padtype, 'kernel')
+                bigkernel.fill(0)
+            else:
+                bigkernel = np.zeros(newshape, dtype=padtype)
+            bigkernel[kernslices] = kernel
+        # need to shift the kernel so that, e.g., [0,0,1,0] -> [1,0,0,0] = unity
+        kernfft = fftn(np.fft.ifftshift(bigkernel))
+        if use_fft_cache:
+            fast_ffts.kernel_cache.set(kernkey, kernfft)
 
 
     # for memory conservation's sake, do this all on one line
@@ -305,22 +353,34 @@ def convolvend(array, kernel, boundary='fill', fill_value=0,
     #print "Memory usage (line 294): ",heapy.heap().size/1024.**3
 
     if (interpolate_nan or ignore_edge_zeros) and kernel_is_normalized:
-        if ignore_edge_zeros:
-            bigimwt = np.zeros(newshape, dtype=complextype)
+        # without NaNs to interpolate over, the weights only depend on the
+        # kernel and the padding, so they can be cached with the kernel FFT
+        if use_fft_cache and not (interpolate_nan and nanmaskarray.any()):
+            wtkey = ('weights', kernkey, arrayshape, ignore_edge_zeros)
+            bigimwt = fast_ffts.kernel_cache.get(wtkey)
         else:
-            bigimwt = np.ones(newshape, dtype=complextype)
-        bigimwt[arrayslices] = 1.0-nanmaskarray*interpolate_nan
-        wtfft = fftn(bigimwt)
-        # I think this one HAS to be normalized (i.e., the weights can't be
-        # computed with a non-normalized kernel)
-        wtfftmult = wtfft*kernfft/kernel.sum()
-        wtsm = ifftn(wtfftmult)
-        # need to re-zero weights outside of the image (if it is padded, we
-        # still don't weight those regions)
-        bigimwt[arrayslices] = wtsm.real[arrayslices]
-        # curiously, at the floating-point limit, can get slightly negative numbers
-        # they break the min_wt=0 "flag" and must therefore be removed
-        bigimwt[bigimwt<0] = 0
+            wtkey = None
+            bigimwt = None
+
+        if bigimwt is None:
+            if ignore_edge_zeros:
+                bigimwt = np.zeros(newshape, dtype=padtype)
+            else:
+                bigimwt = np.ones(newshape, dtype=padtype)
+            bigimwt[arrayslices] = 1.0-nanmaskarray*interpolate_nan
+            wtfft = fftn(bigimwt)
+            # I think this one HAS to be normalized (i.e., the weights can't be
+            # computed with a non-normalized kernel)
+            wtfftmult = wtfft*kernfft/kernel.sum()
+            wtsm = ifftn(wtfftmult)
+            # need to re-zero weights outside of the image (if it is padded, we
+            # still don't weight those regions)
+            bigimwt[arrayslices] = wtsm.real[arrayslices]
+            # curiously, at the floating-point limit, can get slightly negative numbers
+            # they break the min_wt=0 "flag" and must therefore be removed
+            bigimwt[bigimwt<0] = 0
+            if wtkey is not None:
+                fast_ffts.kernel_cache.set(wtkey, bigimwt)
     else:
         bigimwt = 1
 
@@ -329,13 +389,10 @@ def convolvend(array, kernel, boundary='fill', fill_value=0,
         # this check should be unnecessary; call it an insanity check
         raise ValueError("Encountered NaNs in convolve.  This is disallowed.")
 
-    # restore nans in original image (they were modified inplace earlier)
-    # We don't have to worry about masked arrays - if input was masked, it was
-    # copied
-    array[nanmaskarray] = np.nan
-    kernel[nanmaskkernel] = np.nan
-
     if return_fft:
+        if use_rfft:
+            # fill in the negative frequencies for backwards compatibility
+            fftmult = fast_ffts.rfft_to_fft(fftmult, newshape)
         if fftshift: # default on
             if crop:
                 return np.fft.fftshift(fftmult)[arrayslices]
@@ -360,6 +417,317 @@ def convolvend(array, kernel, boundary='fill', fill_value=0,
         return rifft.real
 
 
+def convolve_1d_axis(array, kernel, axis=-1, center=None, direct_max=None,
+        nthreads=1):
+    """
+    Convolve `array` with the 1D `kernel` along one axis, treating everything
+    beyond the edges of the array as zero.  Returns an array with the same
+    shape as `array`.
+
+    Narrow kernels are applied directly (one shifted multiply-add per kernel
+    element, O(N k)); wider kernels use real FFTs along the axis, batched over
+    all of the other axes.
+
+    Parameters
+    ----------
+    center: int
+        Index of the kernel element that lines up with each output pixel.
+        Defaults to kernel.size//2, the same convention as `convolvend`.
+    direct_max: int
+        Largest kernel size to apply directly.  The default grows slowly with
+        the length of the axis.
+    nthreads: int
+        Threads for the FFTs (needs scipy.fft)
+
+    The result has the precision of `array` (e.g. float32 stays float32).
+    """
+    dtype = np.result_type(array.dtype, np.float32)
+    kernel = np.asarray(kernel, dtype=dtype)
+    ksize = kernel.size
+    if center is None:
+        center = ksize//2
+    axis = axis % array.ndim
+    npix = array.shape[axis]
+    if direct_max is None:
+        direct_max = 12*int(np.log2(npix + ksize))
+
+    def along_axis(sl):
+        return (slice(None),)*axis + (sl,)
+
+    if ksize <= direct_max:
+        try:
+            import scipy.ndimage
+        except ImportError:
+            scipy = None
+        if scipy is not None:
+            # pad the kernel with zeros so that `center` is its middle
+            # element; then correlating with the reversed kernel lines up
+            left, right = center, ksize-1-center
+            kernel = np.concatenate([np.zeros(max(right-left, 0), kernel.dtype),
+                kernel, np.zeros(max(left-right, 0), kernel.dtype)])
+            return scipy.ndimage.correlate1d(array, kernel[::-1], axis=axis,
+                    mode='constant', cval=0.0)
+        # y[p] = sum_j K[j] x[p - j + center]; pad so every index is valid
+        padwidth = [(0,0)]*array.ndim
+        padwidth[axis] = (ksize-1-center, center)
+        padded = np.pad(array, padwidth, mode='constant')
+        result = np.zeros(array.shape, dtype=np.result_type(array, kernel))
+        for jj in xrange(ksize):
+            if kernel[jj] != 0:
+                result += kernel[jj] * padded[along_axis(slice(ksize-1-jj,
+                    ksize-1-jj+npix))]
+        return result
+    else:
+        fftlen = fast_ffts.next_fast_len(npix + ksize - 1)
+        if fast_ffts.has_scipy_fft:
+            def rfft(arr, axis=-1):
+                return fast_ffts.scipy_fft.rfft(arr, fftlen, axis=axis,
+                        workers=nthreads)
+            def irfft(arr, axis=-1):
+                return fast_ffts.scipy_fft.irfft(arr, fftlen, axis=axis,
+                        workers=nthreads)
+        else:
+            def rfft(arr, axis=-1):
+                return np.fft.rfft(arr, fftlen, axis=axis)
+            def irfft(arr, axis=-1):
+                return np.fft.irfft(arr, fftlen, axis=axis)
+        kernfft = rfft(kernel)
+        kernfft = kernfft.reshape([-1 if ii == axis else 1
+            for ii in range(array.ndim)])
+        full = irfft(rfft(array, axis=axis) * kernfft, axis=axis)
+        return full[along_axis(slice(center, center+npix))].astype(dtype,
+                copy=False)
+
+def convolve_separable(array, kernels, interpolate_nan=False,
+        ignore_edge_zeros=False, min_wt=0.0, trim=1e-15, complextype=None,
+        nthreads=1, **kwargs):
+    """
+    Convolve an ndarray with a separable kernel, i.e. one that is the outer
+    product of the 1D `kernels` (one per axis), as a sequence of 1D
+    convolutions.  The result is the same as ``convolvend(array,
+    np.multiply.outer(*kernels), psf_pad=True)`` (boundary='fill',
+    fill_value=0), including the NaN and edge weighting, but costs O(N k)
+    instead of full-image FFTs for moderate kernel widths.
+
+    Parameters
+    ----------
+    array: `numpy.ndarray`
+    kernels: list of 1D `numpy.ndarray`
+        One kernel per axis of `array`, centered as in `convolvend`.  Use
+        ``[1.]`` for axes that should not be smoothed.
+    interpolate_nan, ignore_edge_zeros, min_wt:
+        As in `convolvend`.  The weights are only applied if the kernel is
+        normalized (the product of the 1D kernel sums is 1).
+    trim: float
+        Kernel elements further from the center than the last element larger
+        than `trim` times the peak are dropped (e.g. the far wings of a
+        Gaussian made as large as the image)
+    complextype: None, np.complex128 or np.complex64
+        Precision, as in `convolvend`: np.complex64 computes in float32 and
+        returns float32.  None keeps the precision of `array` (float32 stays
+        float32, anything else is float64).
+    nthreads: int
+        Threads for the FFTs of wide kernels (needs scipy.fft)
+    kwargs:
+        Passed to `convolve_1d_axis` (`direct_max`)
+    """
+    if complextype is None:
+        realtype = np.result_type(np.asarray(array).dtype, np.float32)
+        if realtype != np.float32:
+            realtype = np.dtype('float64')
+    else:
+        realtype = np.finfo(complextype).dtype
+    array = np.asarray(array, dtype=realtype)
+    if len(kernels) != array.ndim:
+        raise ValueError("Need one 1D kernel per dimension of the array")
+
+    trimmed = []
+    for kernel in kernels:
+        kernel = np.asarray(kernel, dtype=realtype).ravel()
+        center = kernel.size//2
+        keep = np.nonzero(np.abs(kernel) > trim*np.abs(kernel).max())[0]
+        if keep.size == 0:
+            keep = np.arange(kernel.size)
+        reach = max(center-keep.min(), keep.max()-center)
+        lo = max(center - reach, 0)
+        hi = min(center + reach + 1, kernel.size)
+        trimmed.append((kernel[lo:hi], center-lo))
+
+    def convolve_all_axes(data):
+        for axis, (kernel, center) in enumerate(trimmed):
+            if kernel.size == 1 and kernel[0] == 1:
+                # identity, e.g. along the spectral axis of a cube
+                continue
+            data = convolve_1d_axis(data, kernel, axis=axis, center=center,
+                    nthreads=nthreads, **kwargs)
+        return data
+
+    nanmaskarray = np.isnan(array)
+    hasnans = nanmaskarray.any()
+    if hasnans:
+        array = np.where(nanmaskarray, 0, array)
+    result = convolve_all_axes(array)
+
+    kernel_is_normalized = (np.abs(np.prod([np.sum(k, dtype='float') for k in
+        kernels]) - 1) < max(1e-8, 10*np.finfo(realtype).eps))
+    if (interpolate_nan or ignore_edge_zeros) and kernel_is_normalized:
+        if ignore_edge_zeros:
+            # zero weight beyond the edges, like the zero padding
+            weights = convolve_all_axes((1.0 -
+                nanmaskarray*interpolate_nan).astype(realtype))
+        elif interpolate_nan and hasnans:
+            # unit weight beyond the edges: 1 - (the smoothed NaN mask)
+            weights = 1.0 - convolve_all_axes(nanmaskarray.astype(realtype))
+        else:
+            return result
+        weights[weights < 0] = 0
+        result /= weights
+        result[weights < min_wt] = np.nan
+        if min_wt == 0.0:
+            result[weights == 0.0] = 0.0
+
+    return result
+
+
+def convolve_batched(array, kernel, axes=(-2,-1), interpolate_nan=False,
+        ignore_edge_zeros=False, min_wt=0.0, normalize_kernel=False,
+        chunksize=None, nthreads=1, complextype=np.complex128,
+        use_fft_cache=True, quiet=False):
+    """
+    Convolve every slice of `array` along `axes` (e.g. every spatial plane
+    of a cube) with the same `kernel`, using one kernel FFT and FFTs batched
+    over all of the other axes.  Equivalent to calling ``convolvend(plane,
+    kernel, psf_pad=True)`` (boundary='fill', fill_value=0) on each plane,
+    including the per-plane `interpolate_nan` weighting, but without a
+    Python-level loop over planes.
+
+    Parameters
+    ----------
+    array: `numpy.ndarray`
+        Real array, e.g. a [nchan, ny, nx] cube
+    kernel: `numpy.ndarray`
+        Real kernel with ``kernel.ndim == len(axes)``, centered as in
+        `convolvend`
+    axes: tuple
+        The axes to convolve along.  The FFTs are batched over the others.
+    chunksize: int or None
+        Number of slices to transform at once; the padded half-spectra of a
+        chunk are the main memory cost.  None picks a chunk of about 2 MB of
+        padded data, which keeps the batched FFTs cache-friendly.
+    complextype: np.complex128 or np.complex64
+        Precision (complex64 needs scipy.fft for single-precision FFTs)
+    interpolate_nan, ignore_edge_zeros, min_wt, normalize_kernel, nthreads,
+    use_fft_cache, quiet:
+        As in `convolvend`
+
+    Returns
+    -------
+    An array with the shape of `array`
+    """
+    realtype = np.finfo(complextype).dtype
+    array = np.asarray(array, dtype=realtype)
+    kernel = np.array(kernel, dtype=realtype)
+    axes = tuple(ax % array.ndim for ax in axes)
+    if kernel.ndim != len(axes):
+        raise ValueError("The kernel must have one dimension per convolution axis")
+
+    if fast_ffts.has_scipy_fft:
+        def rfftn(arr, s):
+            return fast_ffts.scipy_fft.rfftn(arr, s, axes=fftaxes,
+                    workers=nthreads)
+        def irfftn(arr, s):
+            return fast_ffts.scipy_fft.irfftn(arr, s, axes=fftaxes,
+                    workers=nthreads)
+    else:
+        def rfftn(arr, s):
+            return np.fft.rfftn(arr, s, axes=fftaxes)
+        def irfftn(arr, s):
+            return np.fft.irfftn(arr, s, axes=fftaxes).astype(realtype, copy=False)
+
+    nanmaskkernel = np.isnan(kernel)
+    kernel[nanmaskkernel] = 0
+    if normalize_kernel is True:
+        kernel = kernel / kernel.sum()
+    elif normalize_kernel:
+        kernel = kernel / normalize_kernel(kernel)
+    kernel_is_normalized = (np.abs(kernel.sum(dtype='float') - 1) <
+            max(1e-8, 10*np.finfo(realtype).eps))
+    use_weights = (interpolate_nan or ignore_edge_zeros) and kernel_is_normalized
+
+    # put the batch axes first, flattened to one, and the convolution axes last
+    otheraxes = [ax for ax in range(array.ndim) if ax not in axes]
+    transposed = array.transpose(otheraxes + list(axes))
+    planeshape = transposed.shape[len(otheraxes):]
+    planes = transposed.reshape((-1,) + planeshape)
+    fftaxes = tuple(range(1, len(axes)+1))
+
+    if np.isnan(planes).any() and not interpolate_nan and not quiet:
+        warnings.warn("NOT ignoring nan values even though they are present" +
+                " (they are treated as 0)")
+
+    # linear convolution: the data sit at the origin of the padded array and
+    # the kernel center is rolled to the origin
+    padshape = tuple(fast_ffts.next_fast_len(n+k)
+            for n, k in zip(planeshape, kernel.shape))
+    crop = (slice(None),) + tuple(slice(0, n) for n in planeshape)
+
+    kernkey = ('kernfft-batched', padshape, np.dtype(realtype).str,
+            fast_ffts.array_digest(kernel), nthreads)
+    kernfft = fast_ffts.kernel_cache.get(kernkey) if use_fft_cache else None
+    if kernfft is None:
+        bigkernel = np.zeros(padshape, dtype=realtype)
+        bigkernel[tuple(slice(0, k) for k in kernel.shape)] = kernel
+        for ii, k in enumerate(kernel.shape):
+            bigkernel = np.roll(bigkernel, -(k//2), axis=ii)
+        kernfft = rfftn(bigkernel[np.newaxis], padshape)
+        if use_fft_cache:
+            fast_ffts.kernel_cache.set(kernkey, kernfft)
+
+    def convolve_planes(data):
+        return irfftn(rfftn(data, padshape) * kernfft, padshape)[crop]
+
+    edgeweights = None
+    if use_weights and ignore_edge_zeros:
+        # without NaNs, every plane has the same edge weights
+        edgeweights = convolve_planes(np.ones((1,)+planeshape, dtype=realtype))
+        edgeweights[edgeweights < 0] = 0
+
+    result = np.empty(planes.shape, dtype=realtype)
+    nplanes = planes.shape[0]
+    if chunksize is None:
+        chunksize = int(2*1024**2 / (np.prod(padshape) * realtype.itemsize))
+    chunksize = max(chunksize, 1)
+    for start in xrange(0, nplanes, chunksize):
+        chunk = planes[start:start+chunksize]
+        nans = np.isnan(chunk)
+        hasnans = nans.any()
+        if hasnans:
+            chunk = np.where(nans, 0, chunk)
+        smoothed = convolve_planes(chunk)
+
+        if use_weights and (ignore_edge_zeros or (interpolate_nan and hasnans)):
+            if interpolate_nan and hasnans:
+                nanwt = convolve_planes(nans.astype(realtype))
+                if ignore_edge_zeros:
+                    weights = edgeweights - nanwt
+                else:
+                    weights = 1 - nanwt
+                weights[weights < 0] = 0
+            else:
+                weights = edgeweights
+            weights = np.broadcast_to(weights, smoothed.shape)
+            smoothed /= weights
+            smoothed[weights < min_wt] = np.nan
+            if min_wt == 0.0:
+                smoothed[weights == 0.0] = 0.0
+
+        result[start:start+chunksize] = smoothed
+
+    # undo the reshape and transpose
+    result = result.reshape(transposed.shape)
+    return result.transpose(np.argsort(otheraxes + list(axes)))
+
+
 import pytest
 import itertools
 params = list(itertools.product((True,False),(True,False),(True,False)))
@@ -0,0 +1,195 @@
+"""
+Tiled (overlap-save) FFT convolution for images that are too large to pad and
+FFT in one piece, e.g. memory-mapped survey mosaics.
+"""
+import itertools
+import mmap
+import warnings
+import numpy as np
+from convolve_nd import convolvend
+
+def _shared_empty(shape, dtype):
+    """
+    An uninitialized array backed by anonymous shared memory.  Processes
+    forked after its creation (e.g. by `parallel_map`) write into the same
+    memory as the parent.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    return np.frombuffer(mmap.mmap(-1, nbytes), dtype=dtype,
+            count=int(np.prod(shape))).reshape(shape)
+
+def _open_input(array):
+    """
+    Strings are treated as FITS file names and opened memory-mapped
+    """
+    if isinstance(array, basestring):
+        try:
+            import astropy.io.fits as pyfits
+        except ImportError:
+            import pyfits
+        return pyfits.getdata(array, memmap=True)
+    return array
+
+def tile_slices(shape, tilesize):
+    """
+    Return a list of slice tuples that cover an array of the given shape with
+    tiles no larger than `tilesize` (an int, or one int per axis)
+    """
+    if np.isscalar(tilesize):
+        tilesize = [tilesize] * len(shape)
+    starts = [range(0, n, t) for n, t in zip(shape, tilesize)]
+    return [tuple(slice(s, min(s+t, n)) for s, t, n in zip(start, tilesize, shape))
+            for start in itertools.product(*starts)]
+
+def convolve_tiled(array, kernel, output=None, tilesize=1024, numcores=1,
+        interpolate_nan=False, ignore_edge_zeros=False, min_wt=0.0,
+        normalize_kernel=False, preserve_nan=False, dtype=np.float64,
+        **kwargs):
+    """
+    Convolve an N-dimensional array with a (small) kernel one tile at a time.
+
+    Each output tile is computed from the tile plus a halo of half the kernel
+    width read from `array` (overlap-save), so only one tile-sized block is
+    ever padded and transformed per process.  The result is the same as
+    ``convolvend(array, kernel, boundary='fill', psf_pad=True)`` including
+    the `interpolate_nan`, `ignore_edge_zeros` and `min_wt` behavior: the
+    weight map is built from the full image extent, not from the tile edges.
+
+    Parameters
+    ----------
+    array: `numpy.ndarray`, `numpy.memmap` or str
+        The array to convolve.  A string is treated as a FITS file name and
+        opened with ``memmap=True``, so the image is never read in full.
+    kernel: `numpy.ndarray`
+        The kernel.  It should be much smaller than `tilesize`; the halo read
+        around every tile is half the kernel size on each side.
+
+    Options
+    -------
+    output: None, str, or `numpy.ndarray`
+        Where to write the result.  None allocates a new array, a string is
+        the name of a `.npy` file that is created and memory-mapped (use this
+        for results that do not fit in memory), and an array (or
+        `numpy.memmap`) of the right shape is filled in place.
+    tilesize: int or sequence
+        Size of the output tiles along each axis.  Tiles plus halo are padded
+        to a fast FFT length, so e.g. 1024 with a 65 pixel kernel transforms
+        1134x1134 blocks.
+    numcores: int
+        Number of processes (via `contributed.parallel_map`) to spread the
+        tiles over.  The workers write directly into the output memory.
+    preserve_nan: bool
+        Put NaNs from `array` back into the output (this is what `smooth`
+        does when `interpolate_nan` is off)
+    dtype:
+        Data type of a newly created output; use float32 (with
+        ``complextype=np.complex64``) for single precision.
+    interpolate_nan, ignore_edge_zeros, min_wt, normalize_kernel:
+        As in `convolvend`.
+    kwargs:
+        Passed to `convolvend` for each tile (e.g. `nthreads`, `complextype`,
+        `use_numpy_fft`)
+
+    Returns
+    -------
+    The convolved array (`output`, if it was given)
+    """
+    array = _open_input(array)
+    kernel = np.array(kernel, dtype='float')
+    if array.ndim != kernel.ndim:
+        raise ValueError("Image and kernel must " +
+            "have same number of dimensions")
+
+    kernel[np.isnan(kernel)] = 0
+    # the NaNs are zeroed here, so the tiles are always convolved quietly
+    kwargs.pop('quiet', None)
+    if normalize_kernel is True:
+        kernel = kernel / kernel.sum()
+    elif normalize_kernel:
+        kernel = kernel / normalize_kernel(kernel)
+    kernel_is_normalized = np.abs(kernel.sum() - 1) < 1e-8
+    use_weights = (interpolate_nan or ignore_edge_zeros)
+    if use_weights and not kernel_is_normalized:
+        warnings.warn("Kernel is not normalized, therefore ignore_edge_zeros"+
+                " and interpolate_nan will be ignored.")
+        use_weights = False
+
+    shape = array.shape
+    # number of pixels the kernel reaches on each side of an output pixel
+    halo = [k//2 + 1 for k in kernel.shape]
+
+    user_output = None
+    if output is None:
+        output = (_shared_empty(shape, dtype) if numcores > 1
+                else np.empty(shape, dtype=dtype))
+    elif isinstance(output, basestring):
+        output = np.lib.format.open_memmap(output, mode='w+', dtype=dtype,
+                shape=shape)
+    elif numcores > 1 and not isinstance(output, np.memmap):
+        # forked workers can't write into private memory; copy at the end
+        user_output = output
+        output = _shared_empty(shape, output.dtype)
+    if output.shape != shape:
+        raise ValueError("output must have the same shape as array")
+
+    tiles = tile_slices(shape, tilesize)
+
+    def convolve_one_tile(ii):
+        tile = tiles[ii]
+        # the tile plus halo, clipped to the array, and where it goes in the
+        # (zero-filled) block
+        source = tuple(slice(max(t.start-h, 0), min(t.stop+h, n))
+                for t, h, n in zip(tile, halo, shape))
+        blockshape = tuple(t.stop-t.start+2*h for t, h in zip(tile, halo))
+        dest = tuple(slice(s.start-(t.start-h), s.stop-(t.start-h))
+                for s, t, h in zip(source, tile, halo))
+        crop = tuple(slice(h, h+t.stop-t.start) for t, h in zip(tile, halo))
+
+        data = np.asarray(array[source], dtype='float')
+        nans = np.zeros(blockshape, dtype='bool')
+        nans[dest] = np.isnan(data)
+        block = np.zeros(blockshape)
+        block[dest] = data
+        block[nans] = 0
+
+        result = convolvend(block, kernel, boundary='fill', psf_pad=True,
+                normalize_kernel=False, quiet=True, **kwargs)[crop]
+
+        if use_weights:
+            # weights are 1 inside the image (except at NaNs, if they are
+            # interpolated over) and 0 or 1 beyond the image edge
+            if ignore_edge_zeros:
+                weights = np.zeros(blockshape)
+            else:
+                weights = np.ones(blockshape)
+            weights[dest] = 1.0 - nans[dest]*interpolate_nan
+            wtsm = convolvend(weights, kernel/kernel.sum(), boundary='fill',
+                    psf_pad=True, normalize_kernel=False, quiet=True,
+                    **kwargs)[crop]
+            wtsm[wtsm < 0] = 0
+            result = result / wtsm
+            result[wtsm < min_wt] = np.nan
+            if min_wt == 0.0:
+                result[wtsm == 0.0] = 0.0
+
+        if preserve_nan:
+            result[nans[crop]] = np.nan
+
+        output[tile] = result
+        return ii
+
+    if numcores > 1 and len(tiles) > 1:
+        from contributed import parallel_map
+        parallel_map(convolve_one_tile, range(len(tiles)), numcores=numcores)
+    else:
+        for ii in xrange(len(tiles)):
+            convolve_one_tile(ii)
+
+    if isinstance(output, np.memmap):
+        output.flush()
+    if user_output is not None:
+        user_output[...] = output
+        output = user_output
+
+    return output
@@ -21,6 +21,8 @@ def correlate2d(im1,im2, boundary='wrap', **kwargs):
             * 'fill' : set values outside the array boundary to fill_value
                        (default)
             * 'wrap' : periodic boundary
+    use_rfft - Default None: real images are correlated with real-to-complex
+        (half-spectrum) FFTs; see `convolvend`
 
     WARNING: Normalization may be arbitrary if you use the PSD
     """
@@ -1,39 +1,267 @@
 import numpy as np
 import warnings
+import hashlib
+from collections import OrderedDict
+
+class FFTCache(object):
+    """
+    A small least-recently-used cache for FFT plans, kernel FFTs, and padded
+    workspace arrays.  Entries are evicted (oldest first) whenever the total
+    size of the cached arrays exceeds `maxbytes` or the number of entries
+    exceeds `maxitems`.
+
+    The cached arrays are shared between calls, so the cache is *not*
+    thread-safe.  Each process (e.g., each `parallel_map` worker) gets its own
+    copy.
+    """
+
+    def __init__(self, maxbytes=256*1024**2, maxitems=32):
+        self.maxbytes = maxbytes
+        self.maxitems = maxitems
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Return the cached value for `key` (and mark it as most recently used)
+        """
+        if key not in self._entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        value, nbytes = self._entries.pop(key)
+        self._entries[key] = (value, nbytes)
+        return value
+
+    def set(self, key, value, nbytes=None):
+        """
+        Store `value` under `key`.  `nbytes` defaults to ``value.nbytes``.
+        Values larger than `maxbytes` are not stored.
+        """
+        if nbytes is None:
+            nbytes = getattr(value, 'nbytes', 0)
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        if nbytes > self.maxbytes:
+            return value
+        self._entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while self._entries and (self.nbytes > self.maxbytes or
+                len(self._entries) > self.maxitems):
+            oldkey, (oldvalue, oldnbytes) = self._entries.popitem(last=False)
+            self.nbytes -= oldnbytes
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+# fftw plans (and their in/out buffers), kernel FFTs, and padded workspaces
+plan_cache = FFTCache(maxbytes=256*1024**2, maxitems=16)
+kernel_cache = FFTCache(maxbytes=256*1024**2, maxitems=16)
+workspace_cache = FFTCache(maxbytes=512*1024**2, maxitems=8)
+
+def clear_caches():
+    """
+    Empty the plan, kernel FFT, and workspace caches
+    """
+    for cache in (plan_cache, kernel_cache, workspace_cache):
+        cache.clear()
+
+def array_digest(array):
+    """
+    A cheap identity for an array's contents (used to key cached kernel FFTs).
+    Two arrays with the same shape, dtype, and values share a digest.
+    """
+    array = np.ascontiguousarray(array)
+    return (array.shape, array.dtype.str,
+            hashlib.sha1(array.view(np.uint8)).hexdigest())
+
+def get_workspace(shape, dtype, name='workspace'):
+    """
+    Return an *uninitialized* array of the given shape and dtype that is
+    reused between calls.  The contents are overwritten by the next caller
+    requesting the same (name, shape, dtype), so never return a workspace to
+    a user.
+    """
+    key = (name, tuple(int(s) for s in shape), np.dtype(dtype).str)
+    workspace = workspace_cache.get(key)
+    if workspace is None:
+        workspace = workspace_cache.set(key, np.empty(key[1], dtype=dtype))
+    return workspace
+
+_fast_lengths = {}
+
+def next_fast_len(target, factors=(2,3,5,7)):
+    """
+    Return the smallest length >= `target` whose only prime factors are in
+    `factors`.  FFTs of these lengths are nearly as fast as 2^n, but the
+    padding is much smaller than rounding up to the next power of two (e.g.
+    1100 -> 1120 instead of 2048).
+    """
+    target = int(target)
+    key = (target, tuple(factors))
+    if key not in _fast_lengths:
+        length = max(target, 1)
+        while True:
+            remainder = length
+            for factor in factors:
+                while remainder % factor == 0:
+                    remainder //= factor
+            if remainder == 1:
+                break
+            length += 1
+        _fast_lengths[key] = length
+    return _fast_lengths[key]
+
+def _single_precision(dtype):
+    """
+    True if `dtype` is float32 or complex64
+    """
+    return np.dtype(dtype) in (np.dtype(np.float32), np.dtype(np.complex64))
 
 try:
     import fftw3
     has_fftw = True
+    try:
+        # single-precision FFTW, shipped alongside fftw3 by PyFFTW3
+        import fftw3f
+        has_fftw3f = True
+    except ImportError:
+        has_fftw3f = False
 
-    def fftwn(array, nthreads=1):
-        array = array.astype('complex').copy()
-        outarray = array.copy()
-        fft_forward = fftw3.Plan(array, outarray, direction='forward',
-                flags=['estimate'], nthreads=nthreads)
-        fft_forward.execute()
-        return outarray
-
-    def ifftwn(array, nthreads=1):
-        array = array.astype('complex').copy()
-        outarray = array.copy()
-        fft_backward = fftw3.Plan(array, outarray, direction='backward',
-                flags=['estimate'], nthreads=nthreads)
-        fft_backward.execute()
+    def _get_fftw_plan(shape, direction, nthreads=1, dtype=np.complex128):
+        """
+        Return a (plan, inarray, outarray) triplet for a complex transform of
+        the given shape.  Plans are cached so the planning step and the buffer
+        allocation only happen once per (shape, direction, nthreads, dtype).
+        """
+        dtype = np.dtype(dtype)
+        key = (tuple(shape), direction, nthreads, dtype.str)
+        planned = plan_cache.get(key)
+        if planned is None:
+            fftwmodule = fftw3f if _single_precision(dtype) else fftw3
+            inarray = np.zeros(shape, dtype=dtype)
+            outarray = np.zeros(shape, dtype=dtype)
+            plan = fftwmodule.Plan(inarray, outarray, direction=direction,
+                    flags=['estimate'], nthreads=nthreads)
+            planned = plan_cache.set(key, (plan, inarray, outarray),
+                    nbytes=inarray.nbytes+outarray.nbytes)
+        return planned
+
+    def fftwn(array, nthreads=1, dtype=np.complex128):
+        plan, inarray, outarray = _get_fftw_plan(np.shape(array), 'forward',
+                nthreads=nthreads, dtype=dtype)
+        inarray[...] = array
+        plan.execute()
+        return outarray.copy()
+
+    def ifftwn(array, nthreads=1, dtype=np.complex128):
+        plan, inarray, outarray = _get_fftw_plan(np.shape(array), 'backward',
+                nthreads=nthreads, dtype=dtype)
+        inarray[...] = array
+        plan.execute()
         return outarray / np.size(array)
+
+    def _get_rfftw_plan(shape, direction, nthreads=1, dtype=np.float64):
+        """
+        Like `_get_fftw_plan`, but for a real-to-complex ('forward') or
+        complex-to-real ('backward') transform of a real array of the given
+        shape.  The complex side only stores the non-negative frequencies of
+        the last axis.
+        """
+        dtype = np.dtype(dtype)
+        key = (tuple(shape), direction+'-real', nthreads, dtype.str)
+        planned = plan_cache.get(key)
+        if planned is None:
+            single = _single_precision(dtype)
+            fftwmodule = fftw3f if single else fftw3
+            halfshape = tuple(shape[:-1]) + (shape[-1]//2+1,)
+            realarray = np.zeros(shape, dtype=dtype)
+            halfarray = np.zeros(halfshape,
+                    dtype=np.complex64 if single else np.complex128)
+            if direction == 'forward':
+                inarray, outarray = realarray, halfarray
+            else:
+                inarray, outarray = halfarray, realarray
+            plan = fftwmodule.Plan(inarray, outarray, direction=direction,
+                    flags=['estimate'], nthreads=nthreads)
+            planned = plan_cache.set(key, (plan, inarray, outarray),
+                    nbytes=inarray.nbytes+outarray.nbytes)
+        return planned
+
+    def rfftwn(array, nthreads=1, dtype=np.float64):
+        plan, inarray, outarray = _get_rfftw_plan(np.shape(array), 'forward',
+                nthreads=nthreads, dtype=dtype)
+        inarray[...] = array
+        plan.execute()
+        return outarray.copy()
+
+    def irfftwn(array, s, nthreads=1, dtype=np.float64):
+        plan, inarray, outarray = _get_rfftw_plan(tuple(s), 'backward',
+                nthreads=nthreads, dtype=dtype)
+        # c2r transforms overwrite their input, but it is our buffer anyway
+        inarray[...] = array
+        plan.execute()
+        return outarray / np.prod(s)
 except ImportError:
     fftn = np.fft.fftn
     ifftn = np.fft.ifftn
     has_fftw = False
+    has_fftw3f = False
 # I performed some fft speed tests and found that scipy is slower than numpy
 # http://code.google.com/p/agpy/source/browse/trunk/tests/test_ffts.py However,
 # the speed varied on machines - YMMV.  If someone finds that scipy's fft is
 # faster, we should add that as an option here... not sure how exactly
 
-def get_ffts(nthreads=1, use_numpy_fft=not has_fftw):
+try:
+    # scipy >= 1.4: transforms float32/complex64 natively (numpy.fft always
+    # works in double precision)
+    import scipy.fft as scipy_fft
+    has_scipy_fft = True
+except ImportError:
+    has_scipy_fft = False
+
+def get_ffts(nthreads=1, use_numpy_fft=not has_fftw, dtype=np.complex128):
     """
     Returns fftn,ifftn using either numpy's fft or fftw
+
+    If `dtype` is complex64, the transforms return complex64: they use
+    single-precision FFTW (fftw3f) or scipy.fft if either is available, and
+    otherwise transform in double precision with numpy and cast the result.
     """
-    if has_fftw and not use_numpy_fft:
+    if _single_precision(dtype):
+        if has_fftw3f and not use_numpy_fft:
+            def fftn(array):
+                return fftwn(array, nthreads=nthreads, dtype=np.complex64)
+
+            def ifftn(array):
+                return ifftwn(array, nthreads=nthreads, dtype=np.complex64)
+        elif has_scipy_fft:
+            def fftn(array):
+                return scipy_fft.fftn(np.asarray(array, dtype=np.complex64),
+                        workers=nthreads)
+
+            def ifftn(array):
+                return scipy_fft.ifftn(np.asarray(array, dtype=np.complex64),
+                        workers=nthreads)
+        else:
+            def fftn(array):
+                return np.fft.fftn(array).astype(np.complex64)
+
+            def ifftn(array):
+                return np.fft.ifftn(array).astype(np.complex64)
+    elif has_fftw and not use_numpy_fft:
         def fftn(*args, **kwargs):
             return fftwn(*args, nthreads=nthreads, **kwargs)
 
@@ -48,3 +276,92 @@ def get_ffts(nthreads=1, use_numpy_fft=not has_fftw):
         ifftn = np.fft.ifftn
 
     return fftn,ifftn
+
+def get_batched_ffts(nthreads=1, dtype=np.complex128, axes=(-2,-1)):
+    """
+    Returns fftn,ifftn that transform only the given `axes` of their input,
+    e.g. every plane of an [nplanes, ny, nx] stack at once with the default
+    axes=(-2,-1).  They use scipy.fft (multithreaded over `nthreads`, and in
+    single precision for complex64) if it is available, and numpy otherwise.
+    """
+    axes = tuple(axes)
+    if has_scipy_fft:
+        def fftn(array):
+            return scipy_fft.fftn(np.asarray(array, dtype=dtype), axes=axes,
+                    workers=nthreads)
+
+        def ifftn(array):
+            return scipy_fft.ifftn(np.asarray(array, dtype=dtype), axes=axes,
+                    workers=nthreads)
+    else:
+        def fftn(array):
+            return np.fft.fftn(array, axes=axes).astype(dtype, copy=False)
+
+        def ifftn(array):
+            return np.fft.ifftn(array, axes=axes).astype(dtype, copy=False)
+
+    return fftn,ifftn
+
+def get_rffts(nthreads=1, use_numpy_fft=not has_fftw, dtype=np.float64):
+    """
+    Returns rfftn,irfftn (real-to-complex and complex-to-real transforms)
+    using either numpy's fft or fftw.  irfftn takes the full real output
+    shape as its second argument.
+
+    If `dtype` is float32, the transforms return complex64 / float32 (see
+    `get_ffts`).
+    """
+    if _single_precision(dtype):
+        if has_fftw3f and not use_numpy_fft:
+            def rfftn(array):
+                return rfftwn(array, nthreads=nthreads, dtype=np.float32)
+
+            def irfftn(array, s):
+                return irfftwn(array, s, nthreads=nthreads, dtype=np.float32)
+        elif has_scipy_fft:
+            def rfftn(array):
+                return scipy_fft.rfftn(np.asarray(array, dtype=np.float32),
+                        workers=nthreads)
+
+            def irfftn(array, s):
+                return scipy_fft.irfftn(np.asarray(array, dtype=np.complex64),
+                        s, workers=nthreads)
+        else:
+            def rfftn(array):
+                return np.fft.rfftn(array).astype(np.complex64)
+
+            def irfftn(array, s):
+                return np.fft.irfftn(array, s).astype(np.float32)
+    elif has_fftw and not use_numpy_fft:
+        def rfftn(array):
+            return rfftwn(array, nthreads=nthreads)
+
+        def irfftn(array, s):
+            return irfftwn(array, s, nthreads=nthreads)
+    else:
+        rfftn = np.fft.rfftn
+        def irfftn(array, s):
+            return np.fft.irfftn(array, s)
+
+    return rfftn,irfftn
+
+def rfft_to_fft(halffft, shape):
+    """
+    Expand the half spectrum returned by `rfftn` of a real array with the
+    given shape into the full `fftn` spectrum, using the Hermitian symmetry
+    F[-k] = conj(F[k])
+    """
+    shape = tuple(int(s) for s in shape)
+    nhalf = halffft.shape[-1]
+    full = np.empty(shape, dtype=halffft.dtype)
+    full[..., :nhalf] = halffft
+    nmissing = shape[-1] - nhalf
+    if nmissing > 0:
+        # frequencies k = nhalf..n-1 are the conjugates of n-k = nmissing..1,
+        # with every other axis reflected (index j -> -j mod m)
+        mirror = halffft[..., nmissing:0:-1]
+        for axis in range(len(shape)-1):
+            mirror = np.roll(mirror[(slice(None),)*axis + (slice(None,None,-1),)],
+                    1, axis=axis)
+        full[..., nhalf:] = np.conj(mirror)
+    return full
@@ -9,7 +9,8 @@ try:
 except ImportError:
     pyplotOK = False
 from correlate2d import correlate2d
-from AG_image_tools.radialprofile import azimuthalAverageBins,radialAverageBins
+import fast_ffts
+from AG_image_tools.radialprofile import azimuthalAverageBins,radialAverageBins,get_binner
 
 def hanning2d(M, N):
     """
@@ -33,7 +34,8 @@ def power_spectrum(*args,**kwargs):
 def PSD2(image, image2=None, oned=False, 
         fft_pad=False, real=False, imag=False,
         binsize=1.0, radbins=1, azbins=1, radial=False, hanning=False, 
-        wavnum_scale=False, twopi_scale=False, **kwargs):
+        wavnum_scale=False, twopi_scale=False, complextype=numpy.complex128,
+        **kwargs):
     """
     Two-dimensional Power Spectral Density.
     NAN values are treated as zero.
@@ -50,6 +52,7 @@ def PSD2(image, image2=None, oned=False,
         Reduces edge effects.  This idea courtesy Paul Ricchiazzia (May 1993), author of the
         IDL astrolib psd.pro
     wavnum_scale - multiply the FFT^2 by the wavenumber when computing the PSD?
+        (see `wavenumber_scale`)
     twopi_scale - multiply the FFT^2 by 2pi?
     azbins - Number of azimuthal (angular) bins to include.  Default is 1, or
         all 360 degrees.  If azbins>1, the data will be split into [azbins]
@@ -60,40 +63,39 @@ def PSD2(image, image2=None, oned=False,
     radial - An option to return the *azimuthal* power spectrum (i.e., the spectral power as a function 
         of angle).  Not commonly used.
     radbins - number of radial bins (you can compute the azimuthal power spectrum in different annuli)
+    complextype - numpy.complex64 computes the PSD in single precision
+        (float32 output, ~1e-6 relative accuracy); see `convolvend`
     """
     
+    realtype = numpy.finfo(complextype).dtype
+
     # prevent modification of input image (i.e., the next two lines of active code)
-    image = image.copy()
+    image = numpy.array(image, dtype=complextype if numpy.iscomplexobj(image) else realtype)
 
     # remove NANs (but not inf's)
     image[image!=image] = 0
 
     if hanning:
-        image = hanning2d(*image.shape) * image
+        image = hanning2d(*image.shape).astype(realtype) * image
 
     if image2 is None:
         image2 = image
     else:
-        image2 = image2.copy()
+        image2 = numpy.array(image2, dtype=complextype if numpy.iscomplexobj(image2) else realtype)
         image2[image2!=image2] = 0
         if hanning:
-            image2 = hanning2d(*image2.shape) * image2
+            image2 = hanning2d(*image2.shape).astype(realtype) * image2
 
     if real:
-        psd2 = numpy.real( correlate2d(image,image2,return_fft=True,fft_pad=fft_pad) ) 
+        psd2 = numpy.real( correlate2d(image,image2,return_fft=True,fft_pad=fft_pad,complextype=complextype) ) 
     elif imag:
-        psd2 = numpy.imag( correlate2d(image,image2,return_fft=True,fft_pad=fft_pad) ) 
+        psd2 = numpy.imag( correlate2d(image,image2,return_fft=True,fft_pad=fft_pad,complextype=complextype) ) 
     else: # default is absolute value
-        psd2 = numpy.abs( correlate2d(image,image2,return_fft=True,fft_pad=fft_pad) ) 
+        psd2 = numpy.abs( correlate2d(image,image2,return_fft=True,fft_pad=fft_pad,complextype=complextype) ) 
     # normalization is approximately (numpy.abs(image).sum()*numpy.abs(image2).sum())
 
     if wavnum_scale:
-        wx = numpy.concatenate([ numpy.arange(image.shape[0]/2,dtype='float') , image.shape[0]/2 - numpy.arange(image.shape[0]/2,dtype='float') -1 ]) / (image.shape[0]/2.)
-        wy = numpy.concatenate([ numpy.arange(image.shape[1]/2,dtype='float') , image.shape[1]/2 - numpy.arange(image.shape[1]/2,dtype='float') -1 ]) / (image.shape[1]/2.)
-        wx/=wx.max()
-        wy/=wy.max()
-        wavnum = numpy.sqrt( numpy.outer(wx,numpy.ones(wx.shape))**2 + numpy.outer(numpy.ones(wy.shape),wx)**2 )
-        psd2 *= wavnum
+        psd2 *= wavenumber_scale(psd2.shape)
 
     if twopi_scale:
         psd2 *= numpy.pi * 2
@@ -149,3 +151,147 @@ def pspec(psd2, return_index=True, wavenumber=False, return_stddev=False, azbins
         pyplot.ylabel("Spectral Power")
 
     return return_vals
+
+def wavenumber_scale(shape):
+    """
+    The magnitude of the wavenumber of each pixel of a (shifted, so that the
+    zero frequency is at [ny/2,nx/2]) 2D PSD of the given shape, with each
+    axis's highest frequency scaled to 1
+    """
+    ky, kx = [numpy.fft.fftshift(numpy.fft.fftfreq(n)) for n in shape[-2:]]
+    if len(ky) > 1:
+        ky /= numpy.abs(ky).max()
+    if len(kx) > 1:
+        kx /= numpy.abs(kx).max()
+    return numpy.hypot(ky[:,None], kx[None,:])
+
+def _full_power(halfpower, shape):
+    """
+    Expand the half-plane power spectra (last two axes; the last one halved
+    by rfftn) of real images of the given 2D shape to the full plane, using
+    P[-k] = P[k]
+    """
+    nhalf = halfpower.shape[-1]
+    full = numpy.empty(halfpower.shape[:-1] + (shape[-1],), dtype=halfpower.dtype)
+    full[..., :nhalf] = halfpower
+    nmissing = shape[-1] - nhalf
+    if nmissing > 0:
+        # columns nhalf..n-1 are columns n-k = nmissing..1 with the rows
+        # reflected (j -> -j mod m)
+        mirror = halfpower[..., ::-1, nmissing:0:-1]
+        full[..., nhalf:] = numpy.roll(mirror, 1, axis=-2)
+    return full
+
+def PSD2_stack(stack, stack2=None, oned=False, axes=(-2,-1), hanning=False,
+        binsize=1.0, wavnum_scale=False, twopi_scale=False, interpnan=True,
+        return_stddev=False, nthreads=1, complextype=numpy.complex128,
+        chunksize=None):
+    """
+    The 2D power spectral densities (and, optionally, 1D power spectra) of
+    every plane of a stack of images or of a cube, computed directly from
+    real FFTs batched over the planes.
+
+    For each plane this gives the same result as `PSD2` with its default
+    (absolute value) options: NaNs are treated as zero, the window is
+    applied once to the whole stack, and with `stack2` the cross-power
+    |FFT(a)| |FFT(b)| is computed.  The real/imag options of `PSD2` (which
+    depend on the phase convention of `correlate2d`) are not supported.
+
+    stack - the images, e.g. an [nimages, ny, nx] stack or a cube
+    stack2 - a second stack of the same shape for cross-power spectra
+    oned - return the 1D power spectra (radial profiles of the PSDs, as
+        `pspec` computes them) instead of the PSDs
+    axes - the two image axes; the PSDs are computed for every index of
+        the other axes
+    hanning, wavnum_scale, twopi_scale, binsize - as in `PSD2`
+    interpnan - interpolate over empty bins of the 1D spectra, as `pspec`
+        does
+    return_stddev - also return the azimuthal standard deviation of each 1D
+        spectrum (with oned)
+    nthreads - number of threads for the FFTs (needs scipy.fft)
+    complextype - numpy.complex64 computes in single precision
+    chunksize - number of planes to transform at once (default: ~8 MB of
+        transforms)
+
+    Returns
+    -------
+    The PSDs, shaped like `stack` (with the zero frequency at the center of
+    each plane, as for `PSD2`), or if oned,
+    (frequency, spectra[, stddev]), where frequency (as returned by `pspec`)
+    is shared by all planes and spectra has the shape of the non-image axes
+    of stack plus the number of frequency bins.
+    """
+    realtype = numpy.finfo(complextype).dtype
+    stack = numpy.asarray(stack)
+    axes = tuple(ax % stack.ndim for ax in axes)
+    otheraxes = [ax for ax in range(stack.ndim) if ax not in axes]
+    order = otheraxes + list(axes)
+
+    def as_planes(arr):
+        arr = numpy.asarray(arr).transpose(order)
+        return arr.reshape((-1,) + arr.shape[-2:])
+    planes = as_planes(stack)
+    planes2 = None if stack2 is None else as_planes(stack2)
+    othershape = tuple(stack.shape[ax] for ax in otheraxes)
+    shape = planes.shape[1:]
+
+    if fast_ffts.has_scipy_fft:
+        def rfft2(arr):
+            return fast_ffts.scipy_fft.rfft2(arr, workers=nthreads)
+    else:
+        def rfft2(arr):
+            return numpy.fft.rfft2(arr)
+
+    window = None
+    if hanning:
+        window = hanning2d(*shape).astype(realtype)
+
+    def transform(chunk):
+        chunk = numpy.array(chunk, dtype=realtype)
+        chunk[chunk!=chunk] = 0
+        if window is not None:
+            chunk *= window
+        return rfft2(chunk)
+
+    if chunksize is None:
+        chunksize = int(8*1024**2 / (numpy.prod(shape) * 2 *
+            numpy.dtype(complextype).itemsize))
+    chunksize = max(chunksize, 1)
+
+    psd2 = numpy.empty(planes.shape, dtype=realtype)
+    for start in xrange(0, len(planes), chunksize):
+        chunkfft = transform(planes[start:start+chunksize])
+        if planes2 is None:
+            halfpower = chunkfft.real**2 + chunkfft.imag**2
+        else:
+            chunkfft2 = transform(planes2[start:start+chunksize])
+            halfpower = numpy.abs(chunkfft) * numpy.abs(chunkfft2)
+        psd2[start:start+chunksize] = numpy.fft.fftshift(
+                _full_power(halfpower, shape), axes=(-2,-1))
+
+    if wavnum_scale:
+        psd2 *= wavenumber_scale(shape)
+
+    if twopi_scale:
+        psd2 *= numpy.pi * 2
+
+    if not oned:
+        psd2 = psd2.reshape(othershape + shape)
+        return psd2.transpose(numpy.argsort(order))
+
+    binner = get_binner(shape, binsize=binsize)
+    freq = binner.bin_centers.astype('float')
+
+    def spectra(statistic):
+        zz = binner.profiles(psd2, statistic)
+        if interpnan:
+            for row in zz:
+                good = row==row
+                if not good.all():
+                    row[:] = numpy.interp(freq, freq[good], row[good])
+        return zz.reshape(othershape + (len(freq),))
+
+    return_vals = [freq/len(freq), spectra('mean')]
+    if return_stddev:
+        return_vals.append(spectra('stddev'))
+    return return_vals
@@ -0,0 +1,172 @@
+"""
+Sub-pixel registration of a stack of images against one reference by FFT
+cross-correlation (Guizar-Sicairos, Thurman & Fienup 2008, the algorithm
+behind `upsample.dftups`):
+
+    * the reference FFT is computed once (and cached, see
+      `fast_ffts.kernel_cache`) and every frame is transformed once,
+    * the integer offset is the peak of the inverse FFT of the cross-power
+      spectrum, computed for a whole chunk of frames at a time,
+    * the sub-pixel offset is refined with a small upsampled DFT (`dftups`)
+      around that peak, and
+    * the frames are aligned by multiplying the same frame FFTs by separable
+      phase ramps (`shift.stack_phase_ramps`) and inverse transforming them in
+      batch.
+
+Example::
+
+    >>> aligned, offsets = register_stack(frames, usfac=20)
+    >>> # or, to register several stacks against the same reference:
+    >>> registration = Registration(reference, usfac=20)
+    >>> aligned, offsets = registration.register(frames)
+"""
+import numpy as np
+import fast_ffts
+from upsample import dftups
+from shift import stack_phase_ramps
+
+class Registration(object):
+    """
+    Register images against a fixed reference.
+
+    Parameters
+    ----------
+    reference: `numpy.ndarray`
+        The 2D reference image.  NaNs are treated as zero.
+    usfac: int
+        Upsampling factor: offsets are found to 1/usfac of a pixel.  1 finds
+        integer offsets only.
+    nthreads: int
+        Threads for the FFTs (needs scipy.fft)
+    complextype: np.complex128 or np.complex64
+        Precision of the transforms
+    """
+    def __init__(self, reference, usfac=10, nthreads=1,
+            complextype=np.complex128):
+        self.usfac = int(usfac)
+        self.nthreads = nthreads
+        self.complextype = complextype
+        self.realtype = np.finfo(complextype).dtype
+        self.fft2, self.ifft2 = fast_ffts.get_batched_ffts(nthreads=nthreads,
+                dtype=complextype)
+
+        reference = np.nan_to_num(np.asarray(reference, dtype=self.realtype))
+        self.shape = reference.shape
+        key = ('reference-fft', fast_ffts.array_digest(reference),
+                np.dtype(complextype).str)
+        reffft = fast_ffts.kernel_cache.get(key)
+        if reffft is None:
+            reffft = fast_ffts.kernel_cache.set(key, self.fft2(reference))
+        self.reffft = reffft
+
+    def _transform(self, frames):
+        frames = np.array(frames, dtype=self.realtype)
+        frames[frames!=frames] = 0
+        return self.fft2(frames)
+
+    def _offsets(self, framefft):
+        """
+        (dx, dy) offsets of each frame, given the frame FFTs
+        """
+        nr, nc = self.shape
+        cross = self.reffft * np.conj(framefft)
+        cc = np.abs(self.ifft2(cross)).reshape(len(cross), -1)
+        rloc, cloc = np.unravel_index(np.argmax(cc, axis=1), self.shape)
+        md2, nd2 = np.fix(nr/2), np.fix(nc/2)
+        row_shift = np.where(rloc > md2, rloc - nr, rloc).astype('float')
+        col_shift = np.where(cloc > nd2, cloc - nc, cloc).astype('float')
+
+        if self.usfac > 1:
+            usfac = self.usfac
+            # refine within 1.5 pixels of the integer peak
+            nups = int(np.ceil(usfac*1.5))
+            dftshift = np.fix(nups/2)
+            for ii in xrange(len(cross)):
+                roff = dftshift - row_shift[ii]*usfac
+                coff = dftshift - col_shift[ii]*usfac
+                upsampled = np.abs(dftups(np.conj(cross[ii]), nups, nups,
+                    usfac, roff, coff, complextype=self.complextype,
+                    use_cache=False))
+                uprow, upcol = np.unravel_index(np.argmax(upsampled),
+                        upsampled.shape)
+                row_shift[ii] += (uprow - dftshift) / float(usfac)
+                col_shift[ii] += (upcol - dftshift) / float(usfac)
+
+        return np.array([col_shift, row_shift]).T
+
+    def _shift(self, framefft, offsets):
+        """
+        Apply (dx, dy) offsets to frames, given their FFTs, in batch
+        """
+        ramps = stack_phase_ramps(offsets[:,0], offsets[:,1], self.shape,
+                complextype=self.complextype)
+        return np.real(self.ifft2(framefft * ramps))
+
+    def register(self, stack, return_aligned=True, chunksize=None):
+        """
+        Find the offsets of every frame of a stack (or of one image), and
+        align them with the reference.
+
+        Parameters
+        ----------
+        stack: `numpy.ndarray`
+            [nframes, ny, nx] frames of the reference's shape (or one image)
+        return_aligned: bool
+            Shift the frames into alignment?  Otherwise only the offsets are
+            returned.
+        chunksize: int or None
+            Number of frames to transform at once (default: ~32 MB of
+            transforms)
+
+        Returns
+        -------
+        aligned, offsets: the aligned frames (if return_aligned) and an
+        [nframes, 2] array of (dx, dy) such that
+        ``shift.shift(frame, dx, dy)`` aligns each frame with the reference
+        """
+        stack = np.asarray(stack)
+        oneimage = stack.ndim == 2
+        if oneimage:
+            stack = stack[np.newaxis]
+        if stack.shape[1:] != self.shape:
+            raise ValueError("The frames must have the shape of the reference")
+
+        if chunksize is None:
+            chunksize = int(32*1024**2 / (np.prod(self.shape) *
+                np.dtype(self.complextype).itemsize))
+        chunksize = max(chunksize, 1)
+
+        offsets = np.empty((len(stack), 2))
+        aligned = np.empty(stack.shape, dtype=self.realtype) if return_aligned else None
+        for start in xrange(0, len(stack), chunksize):
+            framefft = self._transform(stack[start:start+chunksize])
+            offsets[start:start+chunksize] = self._offsets(framefft)
+            if return_aligned:
+                aligned[start:start+chunksize] = self._shift(framefft,
+                        offsets[start:start+chunksize])
+
+        if oneimage:
+            offsets = offsets[0]
+            if return_aligned:
+                aligned = aligned[0]
+        if return_aligned:
+            return aligned, offsets
+        return offsets
+
+def register_stack(stack, reference=None, usfac=10, return_aligned=True,
+        nthreads=1, complextype=np.complex128, chunksize=None):
+    """
+    Register every frame of a stack against a reference (default: the first
+    frame).  See `Registration`.
+
+    Returns
+    -------
+    aligned, offsets: the aligned stack (if return_aligned) and the [nframes,
+    2] (dx, dy) offsets applied to each frame
+    """
+    if reference is None:
+        reference = stack[0]
+    registration = Registration(reference, usfac=usfac, nthreads=nthreads,
+            complextype=complextype)
+    return registration.register(stack, return_aligned=return_aligned,
+            chunksize=chunksize)
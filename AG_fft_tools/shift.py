@@ -1,24 +1,169 @@
 import fast_ffts
 import numpy as np
 
+_frequency_cache = {}
+
+def fourier_frequencies(n):
+    """
+    The (unshifted) FFT frequencies of a length-n axis, in units of 1/n cycles
+    per pixel, that the phase ramps are built from.  They are cached per
+    length and returned read-only.
+    """
+    freqs = _frequency_cache.get(n)
+    if freqs is None:
+        if len(_frequency_cache) > 64:
+            _frequency_cache.clear()
+        freqs = np.fft.ifftshift(np.linspace(-np.fix(n/2),np.ceil(n/2)-1,n))
+        freqs.flags.writeable = False
+        _frequency_cache[n] = freqs
+    return freqs
+
+def phase_ramps(offsets, n, complextype=np.complex128):
+    """
+    [len(offsets), n] 1D phase ramps exp(-2 pi i offset N / n) that shift a
+    length-n axis by each offset
+    """
+    offsets = np.asarray(offsets, dtype='float').reshape(-1,1)
+    realtype = np.finfo(complextype).dtype
+    return np.exp(1j*(-2*np.pi*offsets*fourier_frequencies(n)/n).astype(realtype)
+            ).astype(complextype, copy=False)
+
+def stack_phase_ramps(deltax, deltay, shape, phase=0,
+        complextype=np.complex128):
+    """
+    [nplanes, ny, nx] phase ramps that shift plane i by (deltax[i],
+    deltay[i]), built as the outer products of 1D ramps along each axis
+    """
+    ny,nx = shape
+    deltax,deltay,phase = np.broadcast_arrays(np.atleast_1d(deltax),
+            np.atleast_1d(deltay), np.atleast_1d(phase))
+    ramp_x = phase_ramps(deltax, nx, complextype)
+    ramp_y = phase_ramps(deltay, ny, complextype)
+    if np.any(phase):
+        ramp_y *= np.exp(-1j*phase).astype(complextype)[:,np.newaxis]
+    return ramp_y[:,:,np.newaxis] * ramp_x[:,np.newaxis,:]
+
+def _shift_chunks(planes, ramps, axes, nthreads, return_abs, return_real,
+        complextype, chunksize):
+    """
+    Transform `planes` (NaNs set to zero) a chunk at a time over `axes`,
+    multiply by ``ramps(start, stop)`` and transform back
+    """
+    fftn,ifftn = fast_ffts.get_batched_ffts(nthreads=nthreads,
+            dtype=complextype, axes=axes)
+    if chunksize is None:
+        # ~32 MB of transforms at a time
+        chunksize = int(32*1024**2 / (np.prod(planes.shape[1:]) *
+            np.dtype(complextype).itemsize))
+    chunksize = max(chunksize, 1)
+
+    if return_real or return_abs:
+        outtype = np.finfo(complextype).dtype
+    else:
+        outtype = complextype
+    output = np.empty(planes.shape, dtype=outtype)
+    for start in xrange(0, len(planes), chunksize):
+        stop = min(start+chunksize, len(planes))
+        chunk = np.asarray(planes[start:stop])
+        if np.isnan(chunk).any():
+            chunk = np.nan_to_num(chunk)
+        chunkfft = fftn(chunk)
+        chunkfft *= ramps(start, stop)
+        gg = ifftn(chunkfft)
+        if return_real:
+            output[start:stop] = np.real(gg)
+        elif return_abs:
+            output[start:stop] = np.abs(gg)
+        else:
+            output[start:stop] = gg
+    return output
+
+def shift_stack(stack, deltax, deltay, phase=0, nthreads=1,
+        return_abs=False, return_real=True, complextype=np.complex128,
+        chunksize=None):
+    """
+    FFT-based sub-pixel shift of every plane of a [nplanes, ny, nx] stack by
+    its own offset: plane i is shifted by (deltax[i], deltay[i]) (scalars
+    shift all planes alike), as ``shift(stack[i], deltax[i], deltay[i])``
+    would.
+
+    The frequency grids are cached per shape, the phase ramps are outer
+    products of 1D ramps, and the FFTs are done over `chunksize` planes at a
+    time (default: ~32 MB of transforms) with
+    `fast_ffts.get_batched_ffts`, which is multithreaded over `nthreads` if
+    scipy.fft is available.
+
+    Will turn NaNs into zeros
+
+    complextype - np.complex64 does the whole computation in single precision
+    """
+    stack = np.asarray(stack)
+    nplanes = len(stack)
+    deltax,deltay,phase = [np.broadcast_to(np.asarray(d, dtype='float'),
+        (nplanes,)) for d in (deltax, deltay, phase)]
+
+    def ramps(start, stop):
+        return stack_phase_ramps(deltax[start:stop], deltay[start:stop],
+                stack.shape[1:], phase[start:stop], complextype=complextype)
+
+    return _shift_chunks(stack, ramps, (-2,-1), nthreads, return_abs,
+            return_real, complextype, chunksize)
+
+def shift1d_stack(data, deltax, phase=0, axis=-1, nthreads=1,
+        return_abs=False, return_real=True, complextype=np.complex128,
+        chunksize=None):
+    """
+    FFT-based sub-pixel shift of many 1D arrays (e.g. the timestreams of all
+    bolometers) along `axis`, each by its own offset: `deltax` (and `phase`)
+    must broadcast to the shape of `data` without `axis`.  See `shift_stack`.
+
+    Will turn NaNs into zeros
+    """
+    data = np.rollaxis(np.asarray(data), axis, np.ndim(data))
+    outshape = data.shape
+    nx = outshape[-1]
+    planes = data.reshape(-1, nx)
+    deltax,phase = [np.broadcast_to(np.asarray(d, dtype='float'),
+        outshape[:-1]).ravel() for d in (deltax, phase)]
+
+    def ramps(start, stop):
+        ramp = phase_ramps(deltax[start:stop], nx, complextype)
+        if np.any(phase):
+            ramp *= np.exp(-1j*phase[start:stop]).astype(complextype)[:,np.newaxis]
+        return ramp
+
+    output = _shift_chunks(planes, ramps, (-1,), nthreads, return_abs,
+            return_real, complextype, chunksize)
+    return np.rollaxis(output.reshape(outshape), len(outshape)-1,
+            axis % len(outshape))
+
 def shift(data, deltax, deltay, phase=0, nthreads=1, use_numpy_fft=False,
-        return_abs=False, return_real=True):
+        return_abs=False, return_real=True, complextype=np.complex128):
     """
     FFT-based sub-pixel image shift
     http://www.mathworks.com/matlabcentral/fileexchange/18401-efficient-subpixel-image-registration-by-cross-correlation/content/html/efficient_subpixel_registration.html
 
     Will turn NaNs into zeros
+
+    complextype - np.complex64 keeps the data, the FFTs and the phase ramp in
+        single precision (the output is then float32/complex64)
     """
 
-    fftn,ifftn = fast_ffts.get_ffts(nthreads=nthreads, use_numpy_fft=use_numpy_fft)
+    fftn,ifftn = fast_ffts.get_ffts(nthreads=nthreads,
+            use_numpy_fft=use_numpy_fft, dtype=complextype)
 
     if np.any(np.isnan(data)):
         data = np.nan_to_num(data)
+    data = np.asarray(data, dtype=complextype)
     ny,nx = data.shape
-    Nx = np.fft.ifftshift(np.linspace(-np.fix(nx/2),np.ceil(nx/2)-1,nx))
-    Ny = np.fft.ifftshift(np.linspace(-np.fix(ny/2),np.ceil(ny/2)-1,ny))
-    Nx,Ny = np.meshgrid(Nx,Ny)
-    gg = ifftn( fftn(data)* np.exp(1j*2*np.pi*(-deltax*Nx/nx-deltay*Ny/ny)) * np.exp(-1j*phase) )
+    Nx = fourier_frequencies(nx)
+    Ny = fourier_frequencies(ny)
+    # the phase ramp is separable: exp(-2pi i (dx Nx/nx + dy Ny/ny)) is the
+    # outer product of two 1D ramps, so only build it at the data precision
+    ramp_x = np.exp(-1j*2*np.pi*deltax*Nx/nx).astype(complextype)
+    ramp_y = np.exp(-1j*2*np.pi*deltay*Ny/ny).astype(complextype)
+    ramp = np.outer(ramp_y * np.exp(-1j*phase).astype(complextype), ramp_x)
+    gg = ifftn( fftn(data) * ramp )
     if return_real:
         return np.real(gg)
     elif return_abs:
@@ -40,7 +185,7 @@ def shift1d(data, deltax, phase=0, nthreads=1, use_numpy_fft=False,
     if np.any(np.isnan(data)):
         data = np.nan_to_num(data)
     nx = data.size
-    Nx = np.fft.ifftshift(np.linspace(-np.fix(nx/2),np.ceil(nx/2)-1,nx))
+    Nx = fourier_frequencies(nx)
     gg = ifftn( fftn(data)* np.exp(1j*2*np.pi*(-deltax*Nx/nx)) * np.exp(-1j*phase) )
     if return_real:
         return np.real(gg)
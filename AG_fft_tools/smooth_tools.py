@@ -1,13 +1,15 @@
 import numpy as np
 from AG_image_tools.downsample import downsample as downsample_2d
 from convolve_nd import convolvend as convolve
+from convolve_nd import convolve_separable, convolve_batched
+from convolve_tiled import convolve_tiled
 from astropy.convolution import convolve as convolve_cy
 
 def smooth(image, kernelwidth=3, kerneltype='gaussian', trapslope=None,
         silent=True, psf_pad=True, interpolate_nan=False, nwidths='max',
         min_nwidths=6, return_kernel=False, normalize_kernel=np.sum,
         downsample=False, downsample_factor=None, ignore_edge_zeros=False,
-        use_fft=True,
+        use_fft=True, separable=True, tilesize=None, output=None, numcores=1,
         **kwargs):
     """
     Returns a smoothed image using a gaussian, boxcar, or tophat kernel
@@ -57,15 +59,44 @@ def smooth(image, kernelwidth=3, kerneltype='gaussian', trapslope=None,
         the kernel area on the edges but will not re-normalize the kernel.
         This parameter may result in 'edge-brightening' effects if you're using
         a normalized kernel
+    separable: [True]
+        Gaussian and boxcar kernels are outer products of 1D kernels, so
+        smooth them with a sequence of 1D convolutions along each axis
+        (`convolve_separable`; direct for narrow kernels, FFT otherwise)
+        instead of a full 2D FFT convolution.  NaN interpolation and
+        `ignore_edge_zeros` work the same way.  Only used with the default
+        'fill' boundary, psf_pad and sum or peak normalization.
+    tilesize: [None]
+        If set, smooth the image in tiles of this size with `convolve_tiled`
+        (overlap-save) instead of padding and transforming the whole image.
+        Use this for mosaics that are too large to FFT in memory; `image` can
+        be a `numpy.memmap` (or a FITS file name) and is never copied.  The
+        kernel is then limited to `min_nwidths` widths if `nwidths`='max'.
+    output: [None]
+        Only with `tilesize`: a `.npy` file name (or array) to write the
+        smoothed image into; see `convolve_tiled`
+    numcores: [1]
+        Only with `tilesize`: number of processes to smooth tiles with
+    complextype: [np.complex128]
+        Passed to `convolvend`.  Use np.complex64 to smooth in single
+        precision (float32 result, about half the memory; accurate to ~1e-6
+        of the image peak)
 
     Note that the kernel is forced to be even sized on each axis to assure no
     offset when smoothing.
     """
 
+    if tilesize is not None and isinstance(image, basestring):
+        from convolve_tiled import _open_input
+        image = _open_input(image)
+
     if (kernelwidth*min_nwidths > image.shape[0] or kernelwidth*min_nwidths > image.shape[1]):
         nwidths = min_nwidths
+    if tilesize is not None and nwidths == 'max':
+        # a full-image kernel would make every tile as big as the image
+        nwidths = min_nwidths
     if (nwidths!='max'):# and kernelwidth*nwidths < image.shape[0] and kernelwidth*nwidths < image.shape[1]):
-        dimsize = np.ceil(kernelwidth*nwidths)
+        dimsize = int(np.ceil(kernelwidth*nwidths))
         dimsize += dimsize % 2
         yy,xx = np.indices([dimsize,dimsize])
         szY,szX = dimsize,dimsize
@@ -77,11 +108,55 @@ def smooth(image, kernelwidth=3, kerneltype='gaussian', trapslope=None,
     shape = (szY,szX)
     if not silent: print "Kernel size set to ",shape
 
+    # the separable path is the psf_pad=True, boundary='fill' convolution;
+    # anything else (e.g. return_fft) needs convolvend
+    use_separable = (separable and use_fft and tilesize is None and psf_pad
+            and kerneltype in ('gaussian','boxcar')
+            and kwargs.get('boundary','fill') == 'fill'
+            and kwargs.get('fill_value',0) == 0
+            and kwargs.get('crop',True) and not kwargs.get('return_fft',False)
+            and (normalize_kernel is True or normalize_kernel in (np.sum, np.max)))
+
+    if use_separable:
+        # both kernels are outer products of the same kernel along each axis
+        kernels = [make_kernel((n,), kernelwidth=kernelwidth,
+            kerneltype=kerneltype, normalize_kernel=normalize_kernel)
+            for n in shape]
+        if return_kernel:
+            kernel = np.multiply.outer(*kernels)
+        if not silent: print "Separable kernel of type %s normalized with %s has peak %g" % (kerneltype, normalize_kernel, np.prod([k.max() for k in kernels]))
+
+        temp = convolve_separable(image, kernels,
+                interpolate_nan=interpolate_nan,
+                ignore_edge_zeros=ignore_edge_zeros,
+                min_wt=kwargs.get('min_wt',0.0),
+                complextype=kwargs.get('complextype',np.complex128),
+                nthreads=kwargs.get('nthreads',1))
+        if interpolate_nan is False: temp[image != image] = np.nan
+
+        if downsample:
+            if downsample_factor is None: downsample_factor = kernelwidth
+            if return_kernel: return downsample_2d(temp,downsample_factor),downsample_2d(kernel,downsample_factor)
+            else: return downsample_2d(temp,downsample_factor)
+        else:
+            if return_kernel: return temp,kernel
+            else: return temp
+
     kernel = make_kernel(shape, kernelwidth=kernelwidth, kerneltype=kerneltype,
             normalize_kernel=normalize_kernel, trapslope=trapslope)
 
     if not silent: print "Kernel of type %s normalized with %s has peak %g" % (kerneltype, normalize_kernel, kernel.max())
 
+    if tilesize is not None:
+        if downsample or not use_fft:
+            raise ValueError("tilesize cannot be combined with downsample or use_fft=False")
+        temp = convolve_tiled(image, kernel, output=output, tilesize=tilesize,
+                numcores=numcores, interpolate_nan=interpolate_nan,
+                ignore_edge_zeros=ignore_edge_zeros, normalize_kernel=False,
+                preserve_nan=not interpolate_nan, **kwargs)
+        if return_kernel: return temp,kernel
+        else: return temp
+
     bad = (image != image)
     temp = image.copy() # to preserve NaN values
     # convolve does this already temp[bad] = 0
@@ -109,6 +184,114 @@ def smooth(image, kernelwidth=3, kerneltype='gaussian', trapslope=None,
         if return_kernel: return temp,kernel
         else: return temp
 
+# keywords smooth_planes passes on to convolve_batched
+batched_keywords = ('nthreads', 'complextype', 'use_fft_cache', 'quiet')
+# smooth keywords smooth_planes accepts, and smooth keywords it can drop when
+# they have their default value
+planes_keywords = ('kernelwidth', 'kerneltype', 'trapslope', 'silent',
+        'interpolate_nan', 'nwidths', 'min_nwidths', 'normalize_kernel',
+        'ignore_edge_zeros', 'min_wt', 'separable', 'chunksize') + batched_keywords
+planes_defaults = {'psf_pad':True, 'use_fft':True, 'downsample':False,
+        'boundary':'fill', 'fill_value':0, 'tilesize':None}
+
+def smooth_planes_kwargs(kwargs):
+    """
+    Translate `smooth` keyword arguments for `smooth_planes`.  Returns None
+    if any of them needs `smooth` itself (e.g. downsample, use_fft=False,
+    another boundary), in which case the planes must be smoothed one at a
+    time.
+    """
+    planes_kwargs = {}
+    for key, value in kwargs.items():
+        if key in planes_keywords:
+            planes_kwargs[key] = value
+        elif key in planes_defaults and np.all(value == planes_defaults[key]):
+            continue
+        else:
+            return None
+    return planes_kwargs
+
+def smooth_planes(cube, kernelwidth=3, kerneltype='gaussian', axes=(-2,-1),
+        trapslope=None, silent=True, interpolate_nan=False, nwidths='max',
+        min_nwidths=6, return_kernel=False, normalize_kernel=np.sum,
+        ignore_edge_zeros=False, min_wt=0.0, separable=True, chunksize=None,
+        psf_pad=True, **kwargs):
+    """
+    Smooth every plane of a cube (every slice along `axes`) with the same
+    kernel in one vectorized operation.  The result is the same as running
+    `smooth` on each plane, but the kernel is built and transformed once and
+    the FFTs (or, for separable kernels, the 1D convolutions) run over the
+    whole cube at once instead of once per plane.
+
+    Parameters
+    ----------
+    cube: `numpy.ndarray`
+        e.g. a [nchan, ny, nx] cube
+    axes: tuple of two ints
+        The (spatial) axes to smooth along; the remaining axis is the
+        "channel" axis the planes are stacked along
+    chunksize: int or None
+        Number of planes to FFT at once for non-separable kernels (see
+        `convolve_batched`)
+    kernelwidth, kerneltype, trapslope, silent, interpolate_nan, nwidths,
+    min_nwidths, return_kernel, normalize_kernel, ignore_edge_zeros,
+    separable:
+        As in `smooth`.  `psf_pad` is accepted for compatibility; the planes
+        are always padded (boundary='fill').
+    min_wt, kwargs:
+        Passed to `convolve_batched`: `nthreads`, `complextype`,
+        `use_fft_cache`, `quiet`.  Other `smooth` options are not supported
+        (see `smooth_planes_kwargs`).
+    """
+    unknown = [key for key in kwargs if key not in batched_keywords]
+    if unknown:
+        raise TypeError("smooth_planes() got unsupported keyword arguments: %s"
+                % ", ".join(sorted(unknown)))
+    axes = tuple(ax % cube.ndim for ax in axes)
+    imshape = [cube.shape[ax] for ax in axes]
+
+    if any(kernelwidth*min_nwidths > n for n in imshape):
+        nwidths = min_nwidths
+    if (nwidths!='max'):
+        dimsize = int(np.ceil(kernelwidth*nwidths))
+        dimsize += dimsize % 2
+        shape = (dimsize,)*len(axes)
+    else:
+        shape = tuple(n + n % 2 for n in imshape)
+    if not silent: print "Kernel size set to ",shape
+
+    use_separable = (separable and kerneltype in ('gaussian','boxcar') and
+            (normalize_kernel is True or normalize_kernel in (np.sum, np.max)))
+
+    if use_separable:
+        kernels = [make_kernel((n,), kernelwidth=kernelwidth,
+            kerneltype=kerneltype, normalize_kernel=normalize_kernel)
+            for n in shape]
+        kernel = np.multiply.outer(*kernels) if return_kernel else None
+        # identity along the axes that are not smoothed
+        allkernels = [np.ones(1)]*cube.ndim
+        for ax, kern in zip(axes, kernels):
+            allkernels[ax] = kern
+        smoothcube = convolve_separable(cube, allkernels,
+                interpolate_nan=interpolate_nan,
+                ignore_edge_zeros=ignore_edge_zeros, min_wt=min_wt,
+                complextype=kwargs.get('complextype',np.complex128),
+                nthreads=kwargs.get('nthreads',1))
+    else:
+        kernel = make_kernel(shape, kernelwidth=kernelwidth,
+                kerneltype=kerneltype, normalize_kernel=normalize_kernel,
+                trapslope=trapslope)
+        smoothcube = convolve_batched(cube, kernel, axes=axes,
+                interpolate_nan=interpolate_nan,
+                ignore_edge_zeros=ignore_edge_zeros, min_wt=min_wt,
+                normalize_kernel=False, chunksize=chunksize, quiet=True,
+                **kwargs)
+
+    if interpolate_nan is False: smoothcube[cube != cube] = np.nan
+
+    if return_kernel: return smoothcube,kernel
+    else: return smoothcube
+
 def make_kernel(kernelshape, kernelwidth=3, kerneltype='gaussian',
         trapslope=None, normalize_kernel=np.sum, force_odd=False):
     """
@@ -169,7 +352,7 @@ def make_kernel(kernelshape, kernelwidth=3, kerneltype='gaussian',
         for dimsize in kernelshape:
             center = dimsize - (dimsize+1)//2
             kernelslices += [slice(center - (kernelwidth)//2, center + (kernelwidth+1)//2)]
-        kernel[kernelslices] = 1.0
+        kernel[tuple(kernelslices)] = 1.0
         kernel /= normalize_kernel(kernel)
     elif kerneltype == 'tophat':
         rr = np.sum([(x-(x.max())/2.)**2 for x in np.indices(kernelshape)],axis=0)**0.5
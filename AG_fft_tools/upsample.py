@@ -3,7 +3,72 @@ import warnings
 import numpy as np
 import shift
 
-def dftups(inp,nor=None,noc=None,usfac=1,roff=0,coff=0):
+def _dft_frequencies(n):
+    """ Frequency of each element of an unshifted FFT of length n, as dftups
+    uses them: ifftshift(arange(n)) - floor(n/2) """
+    return np.fft.ifftshift(np.arange(n)) - np.floor(n/2)
+
+def _dft_kernel(n, nout, usfac, off, complextype, use_cache=True):
+    """
+    The (n, nout) matrix of the upsampled DFT along one axis,
+    exp(-2 pi i f_m (k - off) / (n usfac)), cached in fast_ffts.kernel_cache
+    """
+    key = ('dftups-kernel', n, nout, float(usfac), float(off),
+            np.dtype(complextype).str)
+    kernel = fast_ffts.kernel_cache.get(key) if use_cache else None
+    if kernel is None:
+        # (the phases are computed as reals at the output precision so that
+        # the complex exponentials are never built in double precision for
+        # complex64)
+        realtype = np.finfo(complextype).dtype
+        phase = ((-2*np.pi/(n*usfac)) * _dft_frequencies(n)[:,np.newaxis] *
+                (np.arange(nout) - off)[np.newaxis,:]).astype(realtype)
+        kernel = np.exp(1j*phase).astype(complextype, copy=False)
+        if use_cache:
+            fast_ffts.kernel_cache.set(key, kernel)
+    return kernel
+
+def _czt_axis(inp, nout, usfac, off, axis, complextype, use_cache=True):
+    """
+    The upsampled DFT along one axis (the same as multiplying by
+    `_dft_kernel`) as a chirp-z transform: Bluestein's algorithm turns it into
+    a convolution done with FFTs of length ~n+nout, so the cost grows as
+    (n+nout) log(n+nout) per line instead of n*nout.
+    """
+    inp = np.rollaxis(inp, axis, inp.ndim)
+    n = inp.shape[-1]
+    nfft = fast_ffts.next_fast_len(n + nout - 1)
+    realtype = np.finfo(complextype).dtype
+    h = np.floor(n/2)
+    # sort the input by frequency, p = 0..n-1 <-> f = p - h, so that
+    # sum_p x_p W^((p-h)(k-off)) = W^(h off - h k) sum_p (x_p W^(-p off)) W^(pk)
+    # with W = exp(-2 pi i / (n usfac)) and pk = (p^2 + k^2 - (k-p)^2)/2
+    key = ('dftups-czt', n, nout, float(usfac), float(off),
+            np.dtype(complextype).str)
+    chirps = fast_ffts.kernel_cache.get(key) if use_cache else None
+    if chirps is None:
+        scale = -2*np.pi/(n*usfac)
+        p = np.arange(n, dtype='float')
+        k = np.arange(nout, dtype='float')
+        pre = np.exp(1j*scale*(p**2/2. - p*off))
+        post = np.exp(1j*scale*(k**2/2. + h*off - h*k))
+        m = np.arange(-(n-1), nout, dtype='float')
+        chirp = np.zeros(nfft, dtype='complex')
+        chirp[:len(m)] = np.exp(-1j*scale*m**2/2.)
+        chirps = (pre.astype(complextype), post.astype(complextype),
+                np.fft.fft(chirp).astype(complextype))
+        if use_cache:
+            fast_ffts.kernel_cache.set(key, chirps,
+                    nbytes=sum(c.nbytes for c in chirps))
+    pre, post, chirpfft = chirps
+
+    ordered = np.fft.fftshift(inp, axes=-1) * pre
+    conv = np.fft.ifft(np.fft.fft(ordered, nfft, axis=-1) * chirpfft, axis=-1)
+    out = (conv[..., n-1:n-1+nout] * post).astype(complextype, copy=False)
+    return np.rollaxis(out, out.ndim-1, axis)
+
+def dftups(inp,nor=None,noc=None,usfac=1,roff=0,coff=0,complextype=np.complex128,
+        method='auto', tilesize=1024, use_cache=True):
     """
     *translated from matlab*
     http://www.mathworks.com/matlabcentral/fileexchange/18401-efficient-subpixel-image-registration-by-cross-correlation/content/html/efficient_subpixel_registration.html
@@ -30,31 +95,58 @@ def dftups(inp,nor=None,noc=None,usfac=1,roff=0,coff=0):
     It achieves this result by computing the DFT in the output array without
     the need to zeropad. Much faster and memory efficient than the
     zero-padded FFT approach if [nor noc] are much smaller than [nr*usfac nc*usfac]
-    """
-    # this function is translated from matlab, so I'm just going to pretend
-    # it is matlab/pylab
-    from numpy.fft import ifftshift
-    from numpy import pi,newaxis,floor
 
+    complextype: np.complex64 builds the kernels and does the matrix products
+    in single precision
+    method: 'matrix' uses the dense DFT kernels; 'czt' uses chirp-z
+        transforms (FFTs of length ~nr+nor and nc+noc), which is much faster
+        and smaller for large outputs, e.g. whole upsampled images; 'auto'
+        picks czt when an output dimension is larger than tilesize
+    tilesize: the matrix method computes the output in tiles of at most
+        tilesize x tilesize, so the kernels never exceed n x tilesize
+    use_cache: keep the kernels (per shape, usfac and offset) in
+        `fast_ffts.kernel_cache` for the next call
+    """
     nr,nc=np.shape(inp);
     # Set defaults
     if noc is None: noc=nc;
     if nor is None: nor=nr;
-    # Compute kernels and obtain DFT by matrix products
-    kernc=np.exp((-1j*2*pi/(nc*usfac))*( ifftshift(np.arange(nc) - floor(nc/2)).T[:,newaxis] )*( np.arange(noc) - coff  )[newaxis,:]);
-    kernr=np.exp((-1j*2*pi/(nr*usfac))*( np.arange(nor).T - roff )[:,newaxis]*( ifftshift(np.arange(nr)) - floor(nr/2) )[newaxis,:]);
+    inp = np.asarray(inp, dtype=complextype)
+
+    if method == 'auto':
+        method = 'czt' if max(nor, noc) > tilesize else 'matrix'
+    if method == 'czt':
+        out = _czt_axis(inp, noc, usfac, coff, 1, complextype, use_cache)
+        return _czt_axis(out, nor, usfac, roff, 0, complextype, use_cache)
+    elif method != 'matrix':
+        raise ValueError("method must be 'matrix', 'czt' or 'auto'")
+
+    # Compute kernels and obtain DFT by matrix products, a tile at a time
     #kernc=exp((-i*2*pi/(nc*usfac))*( ifftshift([0:nc-1]).' - floor(nc/2) )*( [0:noc-1] - coff ));
     #kernr=exp((-i*2*pi/(nr*usfac))*( [0:nor-1].' - roff )*( ifftshift([0:nr-1]) - floor(nr/2)  ));
-    out=np.dot(np.dot(kernr,inp),kernc);
+    out = np.empty((nor, noc), dtype=complextype)
+    for r0 in xrange(0, nor, tilesize):
+        rows = min(tilesize, nor-r0)
+        kernr = _dft_kernel(nr, rows, usfac, roff-r0, complextype, use_cache).T
+        partial = np.dot(kernr, inp)
+        for c0 in xrange(0, noc, tilesize):
+            cols = min(tilesize, noc-c0)
+            kernc = _dft_kernel(nc, cols, usfac, coff-c0, complextype, use_cache)
+            out[r0:r0+rows, c0:c0+cols] = np.dot(partial, kernc)
     #return np.roll(np.roll(out,-1,axis=0),-1,axis=1)
     return out 
 
 def upsample_image(image, upsample_factor=1, output_size=None, nthreads=1, use_numpy_fft=False,
-        xshift=0, yshift=0):
+        xshift=0, yshift=0, complextype=np.complex128, method='auto'):
     """
     Use dftups to upsample an image (but takes an image and returns an image with all reals)
+
+    complextype=np.complex64 does the whole computation in single precision
+    and returns a float32 image
+    method - passed to dftups; large outputs use the chirp-z transform
     """
-    fftn,ifftn = fast_ffts.get_ffts(nthreads=nthreads, use_numpy_fft=use_numpy_fft)
+    fftn,ifftn = fast_ffts.get_ffts(nthreads=nthreads,
+            use_numpy_fft=use_numpy_fft, dtype=complextype)
 
     imfft = ifftn(image)
 
@@ -68,7 +160,8 @@ def upsample_image(image, upsample_factor=1, output_size=None, nthreads=1, use_n
         s1 = output_size
         s2 = output_size
 
-    ups = dftups(imfft, s1, s2, upsample_factor, roff=yshift, coff=xshift)
+    ups = dftups(imfft, s1, s2, upsample_factor, roff=yshift, coff=xshift,
+            complextype=complextype, method=method)
 
     return np.abs(ups)
 
@@ -4,8 +4,8 @@ warnings.warn("agpy.AG_image_tools is deprecated."
               "https://github.com/keflavich/image_tools",
               DeprecationWarning)
 import radialprofile
-from radialprofile import azimuthalAverage,azimuthalAverageBins,radialAverage,radialAverageBins
-from drizzle import drizzle
+from radialprofile import azimuthalAverage,azimuthalAverageBins,radialAverage,radialAverageBins,ProfileBinner,get_binner
+from drizzle import drizzle,PointingMatrix
 import downsample
 from downsample import downsample,downsample_1d,downsample_cube
 #from cross_correlation_shifts import cross_correlation_shifts_FITS,cross_correlation_shifts
@@ -1,4 +1,14 @@
+"""
+Drizzle timestreams onto maps (and sample maps back into timestreams) through
+the timestream -> map pointing, `tstomap`.
+
+`drizzle` does a single mapping.  For repeated mappings with the same
+pointing (e.g. re-mapping an observation after every flagging step), build a
+`PointingMatrix` once and use its methods, which can also update the maps
+incrementally when only a few samples change.
+"""
 import numpy
+from multiprocessing.pool import ThreadPool
 
 def masktozero(arr):
     """
@@ -12,6 +22,226 @@ def masktozero(arr):
 
     return numpy.array(arr)
 
+def _zero_nans(arr):
+    """
+    Set NaNs and masked elements of a freshly computed array to zero in
+    place, and return it as a plain numpy array (a faster `masktozero`)
+    """
+    if hasattr(arr,'mask'):
+        arr = arr.filled(0)
+    nans = numpy.isnan(arr)
+    if nans.any():
+        arr[nans] = 0
+    return arr
+
+class PointingMatrix(object):
+    """
+    The sparse (one nonzero per timestream sample) matrix that maps a
+    timestream to a map, built once from `tstomap`.
+
+    Parameters
+    ----------
+    tstomap: `numpy.ndarray`
+        The flat map pixel index of each timestream sample (any shape; the
+        timestreams passed to the methods must have the same size)
+    mapshape: tuple
+        [ny,nx] shape of the map.  Every pixel in tstomap must be inside it.
+    nthreads: int
+        Number of threads to spread the map sums and the map -> timestream
+        sampling over.  The threaded sums sort the samples by map pixel
+        (CSR order) the first time they are needed.
+
+    Example::
+
+        >>> pointing = PointingMatrix(tstomap, mapshape)
+        >>> summap, weightmap = pointing.sums(ts, weights, flags=flags)
+        >>> newmap = summap / weightmap
+        >>> # after flagging the samples in `newflags`:
+        >>> pointing.add(summap, weightmap, ts, weights, samples=newflags,
+        ...              sign=-1)
+        >>> model_ts = pointing.totimestream(newmap)
+    """
+    def __init__(self, tstomap, mapshape, nthreads=1):
+        tstomap = numpy.asarray(tstomap)
+        self.shape = tstomap.shape
+        self.mapshape = tuple(mapshape)
+        self.npix = int(numpy.prod(self.mapshape))
+        self.flat = tstomap.ravel().astype(numpy.intp, copy=False)
+        self.nsamples = self.flat.size
+        if self.nsamples and (self.flat.min() < 0 or self.flat.max() >= self.npix):
+            raise ValueError("tstomap points outside of the map")
+        self.nthreads = nthreads
+        self._hits = None
+        self._order = None
+        self._indptr = None
+
+    @property
+    def hits(self):
+        """ Number of samples in each map pixel (flat) """
+        if self._hits is None:
+            self._hits = numpy.bincount(self.flat, minlength=self.npix)
+        return self._hits
+
+    def _csr(self):
+        """ The samples sorted by pixel and each pixel's start in that order """
+        if self._order is None:
+            self._order = numpy.argsort(self.flat, kind='mergesort')
+            self._indptr = numpy.concatenate([[0], numpy.cumsum(self.hits)])
+        return self._order, self._indptr
+
+    def _threaded(self, function, nitems):
+        """
+        Call function(start, stop) on ~4*nthreads blocks of range(nitems).
+        numpy releases the GIL in the take and reduceat calls they do.
+        """
+        bounds = numpy.linspace(0, nitems, 4*self.nthreads+1).astype('int')
+        pool = ThreadPool(self.nthreads)
+        try:
+            pool.map(lambda ii: function(bounds[ii], bounds[ii+1]),
+                    range(len(bounds)-1))
+        finally:
+            pool.close()
+
+    def _pixel_sums(self, values):
+        """ Sum of `values` (one per sample) in each map pixel (flat) """
+        if self.nthreads <= 1:
+            return numpy.bincount(self.flat, values, minlength=self.npix)
+
+        order, indptr = self._csr()
+        sums = numpy.zeros(self.npix)
+        hits = self.hits
+        # split the pixels into blocks with about equal numbers of samples
+        bounds = numpy.searchsorted(indptr,
+                numpy.linspace(0, self.nsamples, 4*self.nthreads+1))
+        bounds[-1] = self.npix
+        def block(b0, b1):
+            p0, p1 = bounds[b0], bounds[b1]
+            filled = numpy.flatnonzero(hits[p0:p1]) + p0
+            if len(filled):
+                start = indptr[p0]
+                samples = values.take(order[start:indptr[p1]])
+                sums[filled] = numpy.add.reduceat(samples,
+                        indptr[filled] - start)
+        self._threaded(block, len(bounds)-1)
+        return sums
+
+    def _values(self, ts, weights, flags, samples=None):
+        """ Flat (ts*weights, weights) of the samples, with NaNs set to zero
+        and masked or flagged samples (or weights) given zero weight """
+        ts = numpy.ravel(ts) if samples is None else numpy.ravel(ts)[samples]
+        masked = numpy.ma.getmask(ts)
+        if numpy.isscalar(weights):
+            if flags is None and masked is numpy.ma.nomask:
+                return _zero_nans(ts*weights), weights
+            weights = numpy.repeat(float(weights), self.nsamples)
+        weights = numpy.ravel(weights)
+        if samples is not None:
+            weights = weights[samples]
+        # a copy, so the caller's weights are not modified
+        weights = _zero_nans(numpy.array(numpy.ma.filled(weights, 0),
+            dtype='float'))
+        if masked is not numpy.ma.nomask:
+            weights[masked] = 0
+        if flags is not None:
+            flags = numpy.ravel(flags)
+            weights[flags if samples is None else flags[samples]] = 0
+        return _zero_nans(ts*weights), weights
+
+    def weightmap(self, weights=1, flags=None):
+        """
+        The map of the summed weights (the drizzle denominator).  Flagged
+        (True) samples get zero weight.
+        """
+        if numpy.isscalar(weights) and flags is None:
+            return (self.hits * float(weights)).reshape(self.mapshape)
+        return self.sums(numpy.zeros(self.shape), weights, flags)[1]
+
+    def sums(self, ts, weights=1, flags=None):
+        """
+        Returns the maps of the summed ts*weights and of the summed weights,
+        whose ratio is the drizzled map.  NaN samples are treated as zero but
+        keep their weight; masked samples (of ts or of weights) and flagged
+        (True) samples are left out.
+        """
+        values, weights = self._values(ts, weights, flags)
+        summap = self._pixel_sums(values).reshape(self.mapshape)
+        if numpy.isscalar(weights):
+            weightmap = self.weightmap(weights)
+        else:
+            weightmap = self._pixel_sums(weights).reshape(self.mapshape)
+        return summap, weightmap
+
+    def drizzle(self, ts, weights=1, flags=None, weightmap=None):
+        """
+        The map of the weighted average per pixel of the timestream (NaN
+        where there are no samples).  See `drizzle`.
+        """
+        if weightmap is None:
+            summap, weightmap = self.sums(ts, weights, flags)
+        else:
+            values = self._values(ts, weights, flags)[0]
+            summap = self._pixel_sums(values).reshape(self.mapshape)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return summap / weightmap
+
+    def add(self, summap, weightmap, ts, weights=1, samples=None, sign=1):
+        """
+        Add (sign=1) or remove (sign=-1) the contribution of some samples to
+        the maps returned by `sums`, in place.  The work is proportional to
+        the number of samples, so e.g. flagging a box of samples only
+        touches the pixels they map to.
+
+        Parameters
+        ----------
+        summap, weightmap: `numpy.ndarray`
+            The maps to update
+        ts, weights:
+            The full timestream and its weights (as passed to `sums`)
+        samples:
+            Flat indices, or a boolean array of the timestream's shape, of
+            the samples to add or remove (default: all)
+        """
+        if samples is not None:
+            samples = numpy.asarray(samples)
+            if samples.dtype == bool:
+                samples = numpy.flatnonzero(samples)
+            else:
+                samples = samples.ravel()
+            pix = self.flat[samples]
+        else:
+            pix = self.flat
+        if pix.size == 0:
+            return summap, weightmap
+        values, weights = self._values(ts, weights, None, samples)
+        pixels, inverse = numpy.unique(pix, return_inverse=True)
+        if numpy.isscalar(weights):
+            dweight = sign * weights * numpy.bincount(inverse)
+        else:
+            dweight = sign * numpy.bincount(inverse, weights)
+        summap.flat[pixels] += sign * numpy.bincount(inverse, values)
+        weightmap.flat[pixels] += dweight
+        # pixels whose samples have all been removed are left with rounding
+        # errors; make them exactly empty again
+        emptied = numpy.abs(weightmap.flat[pixels]) <= 1e-10*numpy.abs(dweight)
+        if sign < 0 and emptied.any():
+            summap.flat[pixels[emptied]] = 0
+            weightmap.flat[pixels[emptied]] = 0
+        return summap, weightmap
+
+    def totimestream(self, map):
+        """
+        Sample a map at every timestream position (the transpose mapping,
+        map -> timestream), returning an array of tstomap's shape
+        """
+        map = numpy.asarray(map).ravel()
+        if self.nthreads <= 1:
+            return map.take(self.flat).reshape(self.shape)
+        ts = numpy.empty(self.nsamples, dtype=map.dtype)
+        def block(start, stop):
+            map.take(self.flat[start:stop], out=ts[start:stop])
+        self._threaded(block, self.nsamples)
+        return ts.reshape(self.shape)
+
 def drizzle(tstomap,ts,mapshape,weights=1,weightmap=None):
     """
     Drizzle a timestream onto a map.  Returns the map of the weighted average
@@ -28,39 +258,8 @@ def drizzle(tstomap,ts,mapshape,weights=1,weightmap=None):
         includes all points mapped to
 
     You can specify a weightmap to increase efficiency instead of computing it
-    """
-    newmap = numpy.zeros(mapshape)
-    # don't need to mask out when adding zero; simplifies indexing to have no masks
-    ts_to_index = masktozero((ts*weights).ravel())
-
-    if len(tstomap.shape) > 1: # tstomap must be flat
-        tstomap = tstomap.ravel()
-
-    tsmapped = numpy.bincount(tstomap,ts_to_index)
-
-    # bincount has length = argmax(tstomap), but the x/y index arrays
-    # go all the way to the full map size.  Append zeros to fill
-    maxind = mapshape[0]*mapshape[1]
-    if tsmapped.shape[0] < maxind:
-        tsmapped = numpy.concatenate([tsmapped,
-            numpy.zeros(maxind-tsmapped.shape[0])])
-    xinds,yinds = (a.ravel() for a in numpy.indices(mapshape))
-    newmap[xinds,yinds] = tsmapped
-
-    # do the same for weights unless a weightmap is specified
-    if weightmap is None: 
-        wm = numpy.zeros(mapshape)
-        if numpy.isscalar(weights): 
-            weights_to_index = numpy.ones(ts_to_index.shape)*weights
-        else:
-            weights_to_index = masktozero((weights).ravel())
-
-        tsweights = numpy.bincount(tstomap,weights_to_index)
-        if tsweights.shape[0] < maxind:
-            tsweights = numpy.concatenate([tsweights,
-                numpy.zeros(maxind-tsweights.shape[0])])
-        wm[xinds,yinds] = tsweights
-    else:
-        wm = weightmap
 
-    return newmap/wm
+    To map the same pointing repeatedly, use a `PointingMatrix`.
+    """
+    return PointingMatrix(tstomap, mapshape).drizzle(ts, weights,
+            weightmap=weightmap)
@@ -1,8 +1,258 @@
+import collections
 import numpy as np
 
+def _sorted_median(whichbin, values, nbins):
+    """
+    Median of values in each of bins 1..nbins, from one sort of the
+    (bin, value) pairs.  Bins containing a NaN get NaN, as for np.median.
+    """
+    order = np.lexsort((values, whichbin))
+    svalues = values[order]
+    counts = np.bincount(whichbin, minlength=nbins+1)
+    starts = np.cumsum(counts) - counts
+    counts, starts = counts[1:nbins+1], starts[1:nbins+1]
+    median = np.empty(nbins)
+    median.fill(np.nan)
+    full = counts > 0
+    lo = starts[full] + (counts[full]-1)//2
+    hi = starts[full] + counts[full]//2
+    median[full] = (svalues[lo] + svalues[hi]) / 2.
+    hasnan = np.bincount(whichbin, weights=np.isnan(values),
+            minlength=nbins+1)[1:nbins+1] > 0
+    median[hasnan] = np.nan
+    return median
+
+def binned_statistic(whichbin, values, nbins, statistic='mean', weights=None):
+    """
+    Compute a statistic of values in each of the bins 1..nbins in one
+    vectorized pass (points with whichbin of 0 or > nbins are ignored, as
+    for the output of np.digitize).
+
+    whichbin - integer bin number of each value
+    values - the values (same shape as whichbin)
+    nbins - number of bins
+    statistic - 'mean' (weighted, if weights are given), 'stddev' (the
+        population standard deviation, like np.std), 'median', or 'mad' (the
+        median absolute deviation from the median, divided by 0.6745 to
+        estimate the standard deviation as in `agpy.mad.MAD`)
+
+    Returns an array of nbins values, NaN for empty bins.  NaN values make
+    their bin NaN.
+    """
+    whichbin = np.ravel(whichbin)
+    values = np.ravel(values)
+    if weights is not None and statistic != 'mean':
+        raise ValueError("Weighted %s is not defined." % statistic)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if statistic == 'mean':
+            if weights is None:
+                weights = np.ones(values.shape)
+            weights = np.ravel(weights)
+            total = np.bincount(whichbin, weights=values*weights,
+                    minlength=nbins+1)[1:nbins+1]
+            return total / np.bincount(whichbin, weights=weights,
+                    minlength=nbins+1)[1:nbins+1]
+        elif statistic == 'stddev':
+            counts = np.bincount(whichbin, minlength=nbins+1)
+            mean = np.bincount(whichbin, weights=values,
+                    minlength=nbins+1) / counts
+            # second pass about the mean rather than sum of squares, which
+            # loses precision when the mean is large compared to the spread
+            deviation = values - mean[whichbin]
+            variance = np.bincount(whichbin, weights=deviation**2,
+                    minlength=nbins+1) / counts
+            return np.sqrt(variance[1:nbins+1])
+        elif statistic in ('median','mad'):
+            median = _sorted_median(whichbin, values, nbins)
+            if statistic == 'median':
+                return median
+            inbin = (whichbin > 0) & (whichbin <= nbins)
+            deviation = np.abs(values[inbin] - median[whichbin[inbin]-1])
+            return _sorted_median(whichbin[inbin], deviation, nbins) / 0.6745
+        else:
+            raise ValueError("Unknown statistic %s" % statistic)
+
+def _statistic_name(stddev=False, median=False, mad=False):
+    if stddev + median + mad > 1:
+        raise ValueError("Only one of stddev, median and mad can be set.")
+    return 'stddev' if stddev else 'median' if median else 'mad' if mad else 'mean'
+
+class ProfileBinner(object):
+    """
+    The assignment of the pixels of images of one shape to the bins of a
+    radial profile (as for `azimuthalAverage`), or of an azimuthal profile
+    (as for `radialAverage`, with coordinate='azimuth'), computed once so
+    that profiles of any number of same-shaped images (e.g. power spectral
+    densities) only cost a couple of `np.bincount` calls each.
+
+    If azbins (an array of angles in degrees, as for `azimuthalAverageBins`)
+    is given, the profiles are computed separately for each angular range.
+
+    Binners are cached by `get_binner`, which the profile functions use, so
+    it is usually simplest to use that:
+
+    >>> binner = get_binner(psds[0].shape, binsize=1.0)
+    >>> profiles = binner.profiles(psds)   # psds is a 3D stack
+    """
+    def __init__(self, shape, center=None, binsize=0.5, azbins=None,
+            symmetric=None, coordinate='radius'):
+        self.shape = tuple(shape)
+        y, x = np.indices(self.shape)
+
+        if center is None:
+            center = np.array([(x.max()-x.min())/2.0, (y.max()-y.min())/2.0])
+        self.center = center
+
+        self.r = np.hypot(x - center[0], y - center[1])
+
+        if coordinate == 'radius' and azbins is None:
+            theta_deg = None
+        else:
+            theta = np.arctan2(x - center[0], y - center[1])
+            theta[theta < 0] += 2*np.pi
+            theta_deg = theta*180.0/np.pi
+            # allow for symmetries
+            if symmetric == 2:
+                theta_deg = theta_deg % 90
+            elif symmetric == 1:
+                theta_deg = theta_deg % 180
+
+        # the 'bins' as initially defined are lower/upper bounds for each bin
+        # so that values will be in [lower,upper)  
+        if coordinate == 'radius':
+            nbins = int(np.round(self.r.max() / binsize)+1)
+            coord = self.r
+        elif coordinate == 'azimuth':
+            maxangle = {2:90, 1:180}.get(symmetric, 360)
+            nbins = int(np.round(maxangle / binsize))
+            coord = theta_deg
+        else:
+            raise ValueError("coordinate must be 'radius' or 'azimuth'")
+        maxbin = nbins * binsize
+        self.nbins = nbins
+        self.bins = np.linspace(0,maxbin,nbins+1)
+        # but we're probably more interested in the bin centers than their left or right sides...
+        self.bin_centers = (self.bins[1:]+self.bins[:-1])/2.0
+
+        # Find out which bin each point in the map belongs to; there are never
+        # any in bin 0, because the lowest index returned by digitize is 1
+        self.whichbin = np.digitize(coord.flat,self.bins)
+
+        # how many per bin (i.e., histogram)?
+        if coordinate == 'radius':
+            self.nr = np.bincount(self.whichbin, minlength=nbins+1)[1:nbins+1]
+        else:
+            self.nr = np.bincount(self.whichbin)[1:]
+
+        if azbins is None:
+            self.sectors = None
+        else:
+            self.sectors = np.array([((theta_deg > (blow % 360)) *
+                (theta_deg < (bhigh % 360))).ravel()
+                for blow,bhigh in zip(azbins[:-1],azbins[1:])])
+
+        for arr in (self.r, self.bins, self.bin_centers, self.whichbin,
+                self.nr, self.sectors):
+            if arr is not None:
+                arr.flags.writeable = False
+
+    def profiles(self, stack, statistic='mean', weights=None, mask=None):
+        """
+        Profiles of each image of a 3D stack (or of one 2D image) in one
+        vectorized pass.
+
+        statistic - 'mean', 'stddev', 'median' or 'mad' (see
+            `binned_statistic`)
+        weights - weights for the mean, broadcastable to the stack
+        mask - True for pixels to use, broadcastable to the stack
+
+        Returns an (nimages, nbins) array, or (nimages, nsectors, nbins) if
+        the binner has azimuthal sectors; no leading axis for a 2D image.
+        """
+        stack = np.asarray(stack)
+        oneimage = stack.ndim == 2
+        values = stack.reshape((-1, stack.shape[-2]*stack.shape[-1]))
+        nimages = len(values)
+        if weights is not None:
+            weights = np.broadcast_to(weights, stack.shape).reshape(values.shape)
+        use = None
+        if mask is not None:
+            use = np.broadcast_to(mask, stack.shape).reshape(values.shape)
+            use = use.astype('bool')
+
+        if self.sectors is None:
+            prof = self._stack_statistic(values, use, weights, statistic)
+        else:
+            prof = np.empty((nimages, len(self.sectors), self.nbins))
+            for ii,sector in enumerate(self.sectors):
+                sectoruse = sector if use is None else (sector & use)
+                prof[:,ii] = self._stack_statistic(values,
+                        np.broadcast_to(sectoruse, values.shape), weights,
+                        statistic)
+        return prof[0] if oneimage else prof
+
+    profile = profiles
+
+    def _stack_statistic(self, values, use, weights, statistic):
+        # np.bincount on one image at a time is faster than any gather of
+        # the whole stack into bin order, so just loop
+        prof = np.empty((len(values), self.nbins))
+        for ii in xrange(len(values)):
+            whichbin, imvalues = self.whichbin, values[ii]
+            imweights = None if weights is None else weights[ii]
+            if use is not None:
+                whichbin, imvalues = whichbin[use[ii]], imvalues[use[ii]]
+                if imweights is not None:
+                    imweights = imweights[use[ii]]
+            prof[ii] = binned_statistic(whichbin, imvalues, self.nbins,
+                    statistic=statistic, weights=imweights)
+        return prof
+
+_binner_cache = collections.OrderedDict()
+_binner_cache_size = 16
+
+def get_binner(shape, center=None, binsize=0.5, azbins=None, symmetric=None,
+        coordinate='radius'):
+    """
+    Return a `ProfileBinner` for these arguments, reusing one from a
+    least-recently-used cache of the last 16 when possible
+    """
+    key = (tuple(shape),
+            None if center is None else tuple(np.asarray(center,dtype='float')),
+            float(binsize),
+            None if azbins is None else tuple(np.asarray(azbins,dtype='float')),
+            symmetric, coordinate)
+    try:
+        binner = _binner_cache.pop(key)
+    except KeyError:
+        binner = ProfileBinner(shape, center=center, binsize=binsize,
+                azbins=azbins, symmetric=symmetric, coordinate=coordinate)
+        if len(_binner_cache) >= _binner_cache_size:
+            _binner_cache.popitem(last=False)
+    _binner_cache[key] = binner
+    return binner
+
+def _format_profile(binner, prof, interpnan, left, right, steps, returncoords,
+        return_n):
+    bins, bin_centers = binner.bins, binner.bin_centers
+
+    if interpnan:
+        prof = np.interp(bin_centers,bin_centers[prof==prof],prof[prof==prof],left=left,right=right)
+
+    if steps:
+        xarr = np.array(zip(bins[:-1],bins[1:])).ravel() 
+        yarr = np.array(zip(prof,prof)).ravel() 
+        return xarr,yarr
+    elif returncoords: 
+        return bin_centers,prof
+    elif return_n:
+        return binner.nr,bin_centers,prof
+    else:
+        return prof
+
 def azimuthalAverage(image, center=None, stddev=False, returnradii=False, return_nr=False, 
         binsize=0.5, weights=None, steps=False, interpnan=False, left=None, right=None,
-        mask=None ):
+        mask=None, median=False, mad=False ):
     """
     Calculate the azimuthally averaged radial profile.
 
@@ -26,108 +276,75 @@ def azimuthalAverage(image, center=None, stddev=False, returnradii=False, return
         left,right - passed to interpnan; they set the extrapolated values
     mask - can supply a mask (boolean array same size as image with True for OK and False for not)
         to average over only select data.
+    median - if specified, return the azimuthal median instead of the average
+    mad - if specified, return the azimuthal median absolute deviation (scaled
+        to a standard deviation, see `binned_statistic`)
 
     If a bin contains NO DATA, it will have a NAN value because of the
     divide-by-sum-of-weights component.  I think this is a useful way to denote
     lack of data, but users let me know if an alternative is prefered...
-    
-    """
-    # Calculate the indices from the image
-    y, x = np.indices(image.shape)
 
-    if center is None:
-        center = np.array([(x.max()-x.min())/2.0, (y.max()-y.min())/2.0])
-
-    r = np.hypot(x - center[0], y - center[1])
-
-    if weights is None:
-        weights = np.ones(image.shape)
-    elif stddev:
+    The bins are cached (see `get_binner`), so repeated calls for images of
+    the same shape and center are fast; use `ProfileBinner.profiles` to do a
+    whole stack of images at once.
+    """
+    statistic = _statistic_name(stddev, median, mad)
+    if weights is not None and statistic != 'mean':
         raise ValueError("Weighted standard deviation is not defined.")
 
-    if mask is None:
-        mask = np.ones(image.shape,dtype='bool')
-    # obsolete elif len(mask.shape) > 1:
-    # obsolete     mask = mask.ravel()
-
-    # the 'bins' as initially defined are lower/upper bounds for each bin
-    # so that values will be in [lower,upper)  
-    nbins = int(np.round(r.max() / binsize)+1)
-    maxbin = nbins * binsize
-    bins = np.linspace(0,maxbin,nbins+1)
-    # but we're probably more interested in the bin centers than their left or right sides...
-    bin_centers = (bins[1:]+bins[:-1])/2.0
-
-    # how many per bin (i.e., histogram)?
-    # there are never any in bin 0, because the lowest index returned by digitize is 1
-    #nr = np.bincount(whichbin)[1:]
-    nr = np.histogram(r,bins)[0]
-
-    # recall that bins are from 1 to nbins (which is expressed in array terms by arange(nbins)+1 or xrange(1,nbins+1) )
-    # radial_prof.shape = bin_centers.shape
-    if stddev:
-        # Find out which radial bin each point in the map belongs to
-        whichbin = np.digitize(r.flat,bins)
-        # This method is still very slow; is there a trick to do this with histograms? 
-        radial_prof = np.array([image.flat[mask.flat*(whichbin==b)].std() for b in xrange(1,nbins+1)])
-    else: 
-        radial_prof = np.histogram(r, bins, weights=(image*weights*mask))[0] / np.histogram(r, bins, weights=(mask*weights))[0]
+    binner = get_binner(image.shape, center, binsize)
+    radial_prof = binner.profile(image, statistic, weights=weights, mask=mask)
 
-    if interpnan:
-        radial_prof = np.interp(bin_centers,bin_centers[radial_prof==radial_prof],radial_prof[radial_prof==radial_prof],left=left,right=right)
+    return _format_profile(binner, radial_prof, interpnan, left, right, steps,
+            returnradii, return_nr)
 
-    if steps:
-        xarr = np.array(zip(bins[:-1],bins[1:])).ravel() 
-        yarr = np.array(zip(radial_prof,radial_prof)).ravel() 
-        return xarr,yarr
-    elif returnradii: 
-        return bin_centers,radial_prof
-    elif return_nr:
-        return nr,bin_centers,radial_prof
-    else:
-        return radial_prof
-
-def azimuthalAverageBins(image,azbins,symmetric=None, center=None, **kwargs):
+def azimuthalAverageBins(image,azbins,symmetric=None, center=None, stddev=False,
+        binsize=0.5, weights=None, steps=False, interpnan=False, left=None,
+        right=None, mask=None, median=False, mad=False):
     """ Compute the azimuthal average over a limited range of angles 
-    kwargs are passed to azimuthalAverage """
-    y, x = np.indices(image.shape)
-    if center is None:
-        center = np.array([(x.max()-x.min())/2.0, (y.max()-y.min())/2.0])
-    r = np.hypot(x - center[0], y - center[1])
-    theta = np.arctan2(x - center[0], y - center[1])
-    theta[theta < 0] += 2*np.pi
-    theta_deg = theta*180.0/np.pi
-
+    The other keywords are as for azimuthalAverage (mask is combined with
+    each angular range).  The radial bins are computed once and shared by all
+    of the angular ranges. """
     if isinstance(azbins,np.ndarray):
-        pass
+        # symmetries only apply to integer azbins
+        symmetric = None
     elif isinstance(azbins,int):
         if symmetric == 2:
             azbins = np.linspace(0,90,azbins)
-            theta_deg = theta_deg % 90
         elif symmetric == 1:
             azbins = np.linspace(0,180,azbins)
-            theta_deg = theta_deg % 180
         elif azbins == 1:
-            return azbins,azimuthalAverage(image,center=center,returnradii=True,**kwargs)
+            return azbins,azimuthalAverage(image,center=center,returnradii=True,
+                    stddev=stddev,binsize=binsize,weights=weights,median=median,
+                    mad=mad,steps=steps,interpnan=interpnan,left=left,
+                    right=right,mask=mask)
         else:
+            symmetric = None
             azbins = np.linspace(0,359.9999999999999,azbins)
     else:
         raise ValueError("azbins must be an ndarray or an integer")
 
+    statistic = _statistic_name(stddev, median, mad)
+    if weights is not None and statistic != 'mean':
+        raise ValueError("Weighted standard deviation is not defined.")
+
+    binner = get_binner(image.shape, center, binsize, azbins=azbins,
+            symmetric=symmetric)
+    profiles = binner.profile(image, statistic, weights=weights, mask=mask)
+
     azavlist = []
-    for blow,bhigh in zip(azbins[:-1],azbins[1:]):
-        mask = (theta_deg > (blow % 360)) * (theta_deg < (bhigh % 360))
-        rr,zz = azimuthalAverage(image,center=center,mask=mask,returnradii=True,**kwargs)
+    for zz in profiles:
+        rr,zz = _format_profile(binner, zz, interpnan, left, right,
+                steps=steps, returncoords=True, return_n=False)
         azavlist.append(zz)
 
     return azbins,rr,azavlist
 
 def radialAverage(image, center=None, stddev=False, returnAz=False, return_naz=False, 
         binsize=1.0, weights=None, steps=False, interpnan=False, left=None, right=None,
-        mask=None, symmetric=None ):
+        mask=None, symmetric=None, median=False, mad=False ):
     """
     Calculate the radially averaged azimuthal profile.
-    (this code has not been optimized; it could be speed boosted by ~20x)
 
     image - The 2D image
     center - The [x,y] pixel coordinates used as the center. The default is 
@@ -149,83 +366,29 @@ def radialAverage(image, center=None, stddev=False, returnAz=False, return_naz=F
         left,right - passed to interpnan; they set the extrapolated values
     mask - can supply a mask (boolean array same size as image with True for OK and False for not)
         to average over only select data.
+    median - if specified, return the radial median instead of the average
+    mad - if specified, return the radial median absolute deviation (scaled
+        to a standard deviation, see `binned_statistic`)
 
     If a bin contains NO DATA, it will have a NAN value because of the
     divide-by-sum-of-weights component.  I think this is a useful way to denote
     lack of data, but users let me know if an alternative is prefered...
     
     """
-    # Calculate the indices from the image
-    y, x = np.indices(image.shape)
-
-    if center is None:
-        center = np.array([(x.max()-x.min())/2.0, (y.max()-y.min())/2.0])
-
-    r = np.hypot(x - center[0], y - center[1])
-    theta = np.arctan2(x - center[0], y - center[1])
-    theta[theta < 0] += 2*np.pi
-    theta_deg = theta*180.0/np.pi
-    maxangle = 360
-
-    if weights is None:
-        weights = np.ones(image.shape)
-    elif stddev:
+    statistic = _statistic_name(stddev, median, mad)
+    if weights is not None and statistic != 'mean':
         raise ValueError("Weighted standard deviation is not defined.")
 
-    if mask is None:
-        # mask is only used in a flat context
-        mask = np.ones(image.shape,dtype='bool').ravel()
-    elif len(mask.shape) > 1:
-        mask = mask.ravel()
-
-    # allow for symmetries
-    if symmetric == 2:
-        theta_deg = theta_deg % 90
-        maxangle = 90
-    elif symmetric == 1:
-        theta_deg = theta_deg % 180
-        maxangle = 180
-
-    # the 'bins' as initially defined are lower/upper bounds for each bin
-    # so that values will be in [lower,upper)  
-    nbins = int(np.round(maxangle / binsize))
-    maxbin = nbins * binsize
-    bins = np.linspace(0,maxbin,nbins+1)
-    # but we're probably more interested in the bin centers than their left or right sides...
-    bin_centers = (bins[1:]+bins[:-1])/2.0
-
-    # Find out which azimuthal bin each point in the map belongs to
-    whichbin = np.digitize(theta_deg.flat,bins)
-
-    # how many per bin (i.e., histogram)?
-    # there are never any in bin 0, because the lowest index returned by digitize is 1
-    nr = np.bincount(whichbin)[1:]
-
-    # recall that bins are from 1 to nbins (which is expressed in array terms by arange(nbins)+1 or xrange(1,nbins+1) )
-    # azimuthal_prof.shape = bin_centers.shape
-    if stddev:
-        azimuthal_prof = np.array([image.flat[mask*(whichbin==b)].std() for b in xrange(1,nbins+1)])
-    else:
-        azimuthal_prof = np.array([(image*weights).flat[mask*(whichbin==b)].sum() / weights.flat[mask*(whichbin==b)].sum() for b in xrange(1,nbins+1)])
-
-    #import pdb; pdb.set_trace()
+    if mask is not None:
+        mask = np.reshape(mask, image.shape)
 
-    if interpnan:
-        azimuthal_prof = np.interp(bin_centers,
-            bin_centers[azimuthal_prof==azimuthal_prof],
-            azimuthal_prof[azimuthal_prof==azimuthal_prof],
-            left=left,right=right)
+    binner = get_binner(image.shape, center, binsize, symmetric=symmetric,
+            coordinate='azimuth')
+    azimuthal_prof = binner.profile(image, statistic, weights=weights,
+            mask=mask)
 
-    if steps:
-        xarr = np.array(zip(bins[:-1],bins[1:])).ravel() 
-        yarr = np.array(zip(azimuthal_prof,azimuthal_prof)).ravel() 
-        return xarr,yarr
-    elif returnAz: 
-        return bin_centers,azimuthal_prof
-    elif return_naz:
-        return nr,bin_centers,azimuthal_prof
-    else:
-        return azimuthal_prof
+    return _format_profile(binner, azimuthal_prof, interpnan, left, right,
+            steps, returnAz, return_naz)
 
 def radialAverageBins(image,radbins, corners=True, center=None, **kwargs):
     """ Compute the radial average over a limited range of radii """
@@ -6,27 +6,208 @@ PCA Tools
 A set of tools for PCA analysis, singular value decomposition,
 total least squares, and other linear fitting methods.
 
+The PCA cleaning functions (`efuncs`, `pca_subtract`, `unpca_subtract`, and
+the `PCA` class they use) work on [time, bolometer] timestreams.  The
+[nbolos, nbolos] covariance is accumulated over chunks of time
+(`CovarianceAccumulator`), so the cost grows linearly with the length of the
+observation and the timestream is never copied as a whole, and the cleaned
+timestream is projected onto the top *ncomps* eigenvectors only, not the full
+basis.  float32 timestreams stay float32.
+
 Running this code independently tests the fitting functions with different
 types of random data.
 
 """
+import hashlib
+from collections import OrderedDict
 import numpy
 
-  
-def efuncs(arr, return_others=False):
+class CovarianceAccumulator(object):
     """
-    Determine eigenfunctions of an array for use with
-    PCA cleaning
+    Accumulate the covariance (arr.T arr) of a [time, nbolos] array a chunk of
+    time at a time.  The products are computed in the data's precision and
+    summed in double precision.
+
+    Example::
+
+        >>> acc = CovarianceAccumulator(144)
+        >>> for scan in scans:
+        ...     acc.add(scan)
+        >>> evals,evects = acc.eigen()
+    """
+    def __init__(self, nbolos):
+        self.covmat = numpy.zeros([nbolos,nbolos], dtype='float64')
+        self.nsamples = 0
+
+    def add(self, chunk):
+        """ Add a [time, nbolos] chunk; masked values count as zero """
+        if hasattr(chunk,'filled'):
+            chunk = chunk.filled(0)
+        chunk = numpy.asarray(chunk)
+        if chunk.dtype.kind != 'f':
+            chunk = chunk.astype('float64')
+        self.covmat += numpy.dot(chunk.T,chunk)
+        self.nsamples += chunk.shape[0]
+
+    def eigen(self):
+        """ The eigenvalues and eigenvectors, largest eigenvalue first """
+        evals,evects = numpy.linalg.eigh(self.covmat)
+        return evals[::-1],evects[:,::-1]
+
+def randomized_eigen(arr, ncomps, oversample=10, niter=2, seed=0):
+    """
+    The top *ncomps* eigenvalues and eigenvectors of arr.T arr from a
+    randomized truncated SVD of arr (Halko, Martinsson & Tropp 2011), for
+    when there are many more bolometers than components wanted.
+
+    *oversample* extra random vectors and *niter* power iterations sharpen
+    the estimate.
     """
     if hasattr(arr,'filled'):
         arr = arr.filled(0)
-    covmat = numpy.dot(arr.T,arr)
-    evals,evects = numpy.linalg.eigh(covmat)
-    inds = np.argsort(evals)[::-1]
-    evals = evals[inds]
-    evects = evects[:,inds]
+    nbolos = arr.shape[1]
+    nvecs = min(ncomps+oversample, nbolos)
+    random = numpy.random.RandomState(seed)
+    basis = numpy.dot(arr, random.randn(nbolos,nvecs).astype(arr.dtype))
+    basis,r = numpy.linalg.qr(basis)
+    for ii in xrange(niter):
+        basis,r = numpy.linalg.qr(numpy.dot(arr.T,basis))
+        basis,r = numpy.linalg.qr(numpy.dot(arr,basis))
+    u,s,vt = numpy.linalg.svd(numpy.dot(basis.T,arr), full_matrices=False)
+    return (s[:ncomps]**2).astype('float64'), vt[:ncomps].T
+
+class PCA(object):
+    """
+    Principal components of [time, nbolos] timestreams, and PCA cleaning with
+    them.
+
+    Parameters
+    ----------
+    method: 'auto', 'eigh' or 'randomized'
+        'eigh' accumulates the full covariance over chunks of time and
+        diagonalizes it; 'randomized' computes only the top ncomps components
+        with `randomized_eigen`.  'auto' uses 'randomized' when ncomps is
+        less than a tenth of the (more than 500) bolometers.
+    chunksize: int
+        Number of time samples per chunk
+    dtype: None or numpy dtype
+        Precision to work in (default: that of the timestream, at least
+        float32)
+    cache: bool
+        Keep the eigenvectors of each timestream (keyed by its contents, so a
+        changed timestream is recomputed).  Cleaning the same scan twice, or
+        cleaning it and then plotting its eigenfunctions, diagonalizes it
+        once.  At most *maxcache* timestreams are kept (the least recently
+        used are dropped first).
+
+    Arrays with 3 dimensions are [nscans, scanlen, nbolos] cubes; each scan
+    gets its own components.
+    """
+    def __init__(self, method='auto', chunksize=65536, dtype=None, cache=True,
+            maxcache=256):
+        if method not in ('auto','eigh','randomized'):
+            raise ValueError("method must be 'auto', 'eigh' or 'randomized'")
+        self.method = method
+        self.chunksize = chunksize
+        self.dtype = dtype
+        self.cache = OrderedDict() if cache else None
+        self.maxcache = maxcache
+
+    def _prepare(self, arr):
+        if hasattr(arr,'filled'):
+            arr = arr.filled(0)
+        arr = numpy.asarray(arr)
+        dtype = self.dtype
+        if dtype is None:
+            dtype = numpy.result_type(arr.dtype, numpy.float32)
+        return numpy.asarray(arr, dtype=dtype)
+
+    def _key(self, arr, ncomps):
+        arr = numpy.ascontiguousarray(arr)
+        return (arr.shape, arr.dtype.str, ncomps,
+                hashlib.sha1(arr.view(numpy.uint8)).hexdigest())
+
+    def _method(self, nbolos, ncomps):
+        if self.method == 'auto':
+            if ncomps is not None and nbolos > 500 and ncomps*10 < nbolos:
+                return 'randomized'
+            return 'eigh'
+        if self.method == 'randomized' and ncomps is None:
+            return 'eigh'
+        return self.method
+
+    def covariance(self, arr):
+        """ arr.T arr, accumulated over chunks of time """
+        arr = self._prepare(arr)
+        acc = CovarianceAccumulator(arr.shape[1])
+        for start in xrange(0, arr.shape[0], self.chunksize):
+            acc.add(arr[start:start+self.chunksize])
+        return acc
+
+    def components(self, arr, ncomps=None):
+        """
+        The eigenvalues and eigenvectors ([nbolos, ncomps]) of a [time,
+        nbolos] timestream, largest first; all of them if ncomps is None.
+        """
+        arr = self._prepare(arr)
+        if self.cache is not None:
+            key = self._key(arr, ncomps)
+            if key in self.cache:
+                # move it to the most recently used end
+                result = self.cache.pop(key)
+                self.cache[key] = result
+                return result
+        if self._method(arr.shape[1], ncomps) == 'randomized':
+            evals,evects = randomized_eigen(arr, ncomps)
+        else:
+            evals,evects = self.covariance(arr).eigen()
+            evals,evects = evals[:ncomps],evects[:,:ncomps]
+        evects = evects.astype(arr.dtype)
+        if self.cache is not None:
+            if len(self.cache) >= self.maxcache:
+                self.cache.popitem(last=False)
+            self.cache[key] = evals,evects
+        return evals,evects
+
+    def _project(self, arr, ncomps, keep):
+        arr = self._prepare(arr)
+        if arr.ndim == 3:
+            return numpy.array([self._project(scan, ncomps, keep) for scan in arr])
+        evals,evects = self.components(arr, ncomps)
+        out = numpy.empty_like(arr)
+        for start in xrange(0, arr.shape[0], self.chunksize):
+            chunk = arr[start:start+self.chunksize]
+            model = numpy.dot(numpy.dot(chunk,evects),evects.T)
+            out[start:start+self.chunksize] = model if keep else chunk-model
+        return out
+
+    def subtract(self, arr, ncomps):
+        """ Remove the *ncomps* most correlated components """
+        return self._project(arr, ncomps, keep=False)
+
+    def keep(self, arr, ncomps):
+        """ Keep only the *ncomps* most correlated components """
+        return self._project(arr, ncomps, keep=True)
+
+    def clear_cache(self):
+        if self.cache is not None:
+            self.cache.clear()
+
+# shared by efuncs, pca_subtract and unpca_subtract
+default_pca = PCA()
+
+def efuncs(arr, return_others=False, ncomps=None, pca=None):
+    """
+    Determine eigenfunctions of an array for use with
+    PCA cleaning (only the first *ncomps* if given)
+    """
+    if pca is None:
+        pca = default_pca
+    arr = pca._prepare(arr)
+    evals,evects = pca.components(arr, ncomps)
     efuncarr = numpy.dot(arr,evects)
     if return_others:
+        covmat = pca.covariance(arr).covmat
         return efuncarr,covmat,evals,evects
     else:
         return efuncarr
@@ -219,32 +400,25 @@ def smooth_waterfall(arr,fwhm=4.0,unsharp=False):
     else:
         return arrconv
 
-def pca_subtract(arr,ncomps):
+def pca_subtract(arr,ncomps,pca=None):
     """
     Compute the eigenfunctions and values of correlated data, then subtract off
     the *ncomps* most correlated components, transform back to the original
-    space, and return that.
+    space, and return that.  A [nscans, scanlen, nbolos] cube is cleaned
+    scan by scan.
     """
-    if hasattr(arr,'filled'):
-        arr = arr.filled(0)
-    covmat = numpy.dot(arr.T,arr)
-    evals,evects = numpy.linalg.eig(covmat)
-    efuncarr = numpy.dot(arr,evects)
-    efuncarr[:,0:ncomps] = 0
-    return numpy.inner(efuncarr,evects)
+    if pca is None:
+        pca = default_pca
+    return pca.subtract(arr,ncomps)
 
-def unpca_subtract(arr,ncomps):
+def unpca_subtract(arr,ncomps,pca=None):
     """
     Like pca_subtract, except `keep` the *ncomps* most correlated components
     and reject the others
     """
-    if hasattr(arr,'filled'):
-        arr = arr.filled(0)
-    covmat = numpy.dot(arr.T,arr)
-    evals,evects = numpy.linalg.eig(covmat)
-    efuncarr = numpy.dot(arr,evects)
-    efuncarr[:,ncomps:] = 0
-    return numpy.inner(efuncarr,evects)
+    if pca is None:
+        pca = default_pca
+    return pca.keep(arr,ncomps)
 
 def pymc_linear_fit(data1, data2, data1err=None, data2err=None,
         print_results=False, intercept=True, nsample=5000, burn=1000,
@@ -515,13 +515,31 @@ def coords_in_image(fitsfile,lon,lat,system='galactic'):
     else:
         return False
 
+def _smooth_spectrum(spectrum, smooth_factor, downsample, kwargs):
+    """
+    pyspeckit smooth of one spectrum (a module-level function, so that it can
+    be sent to parallel_map_array's worker processes)
+    """
+    import pyspeckit
+    return pyspeckit.smooth.smooth(spectrum, smooth_factor,
+            downsample=downsample, **kwargs)
+
+def _smooth_plane(plane, kwargs):
+    """ AG_fft_tools.smooth of one plane; see _smooth_spectrum """
+    from AG_fft_tools import smooth
+    return smooth(plane, **kwargs)
+
 def spectral_smooth(cube, smooth_factor, downsample=True, parallel=True,
                     numcores=None, **kwargs):
     """
     Smooth the cube along the spectral direction
-    """
 
-    yy,xx = numpy.indices(cube.shape[1:])
+    The spectra are smoothed in parallel with
+    `contributed.parallel_map_array`, which shares the cube with the worker
+    processes instead of pickling each spectrum.
+    """
+    from contributed import parallel_map_array
+    import functools
 
     if downsample:
         newshape = cube[::smooth_factor,:,:].shape
@@ -531,9 +549,10 @@ def spectral_smooth(cube, smooth_factor, downsample=True, parallel=True,
     # need to make the cube "flat" along dims 1&2 for iteration in the "map"
     flatshape = (cube.shape[0],cube.shape[1]*cube.shape[2])
 
-    Ssmooth = lambda x: pyspeckit.smooth.smooth(x, smooth_factor, downsample=downsample, **kwargs)
+    Ssmooth = functools.partial(_smooth_spectrum, smooth_factor=smooth_factor,
+            downsample=downsample, kwargs=kwargs)
     if parallel:
-        newcube = numpy.array(parallel_map(Ssmooth, cube.reshape(flatshape).T, numcores=numcores)).T.reshape(newshape)
+        newcube = parallel_map_array(Ssmooth, cube.reshape(flatshape).T, numcores=numcores).T.reshape(newshape)
     else:
         newcube = numpy.array(map(Ssmooth, cube.reshape(flatshape).T)).T.reshape(newshape)
 
@@ -544,31 +563,44 @@ def spectral_smooth(cube, smooth_factor, downsample=True, parallel=True,
 
     return newcube
 
-def plane_smooth(cube,cubedim=0,parallel=True,numcores=None,**kwargs):
+def plane_smooth(cube,cubedim=0,parallel=True,numcores=None,batched=True,**kwargs):
     """
-    parallel-map the smooth function
+    Smooth each plane of a cube with the smooth function
 
     Parameters
     ----------
+    batched: bool
+        defaults True.  Smooth all planes in one vectorized call with
+        `AG_fft_tools.smooth_planes` (one kernel FFT for the whole cube).
+        Falls back to smoothing plane-by-plane for options smooth_planes
+        does not support (downsample, use_fft=False, other boundaries,
+        psf_pad=False...; see `AG_fft_tools.smooth_tools.smooth_planes_kwargs`).
     parallel: bool
-        defaults True.  Set to false if you want serial (for debug purposes?)
+        defaults True.  Set to false if you want serial (for debug
+        purposes?).  Only used if not batched.
     numcores: int
-        pass to parallel_map (None = use all available)
+        pass to parallel_map_array (None = use all available)
     """
-    from AG_fft_tools import smooth
-    from contributed import parallel_map
+    from AG_fft_tools import smooth,smooth_planes
+    from AG_fft_tools.smooth_tools import smooth_planes_kwargs
+    from contributed import parallel_map_array
+    import functools
+
+    planes_kwargs = smooth_planes_kwargs(kwargs) if batched else None
+    if planes_kwargs is not None:
+        spatial_axes = tuple(ax for ax in range(3) if ax != cubedim % 3)
+        return smooth_planes(cube, axes=spatial_axes, **planes_kwargs)
 
     if cubedim != 0:
         cube = cube.swapaxes(0,cubedim)
 
-    cubelist = [cube[ii,:,:] for ii in xrange(cube.shape[0])]
-
-    Psmooth = lambda C: smooth(C,**kwargs)
+    Psmooth = functools.partial(_smooth_plane, kwargs=kwargs)
 
     if parallel:
-        smoothcube = array(parallel_map(Psmooth,cubelist,numcores=numcores))
+        # the planes are shared with the workers, not pickled
+        smoothcube = parallel_map_array(Psmooth,cube,numcores=numcores)
     else:
-        smoothcube = array(map(Psmooth,cubelist))
+        smoothcube = array(map(Psmooth,cube))
     
     if cubedim != 0:
         smoothcube = smoothcube.swapaxes(0,cubedim)
@@ -14,7 +14,7 @@ import numpy as np
 from numpy.ma import median
 from numpy import pi
 #from scipy import optimize,stats,pi
-from .mpfit import mpfit
+from .mpfit import mpfit,mpfit_batch
 """ 
 Note about mpfit/leastsq: 
 I switched everything over to the Markwardt mpfit routine for a few reasons,
@@ -65,6 +65,75 @@ def moments(data,circle,rotate,vheight,estimator=median,**kwargs):
         mylist = mylist + [width]
     return mylist
 
+def moments_stack(stack,circle,rotate,vheight,axis=0):
+    """
+    Vectorized `moments` for a stack of images, e.g. a cube of stamps.
+
+    stack - 3D array of images stacked along `axis` (a single 2D image is
+        treated as a stack of one)
+
+    Returns an (nimages, npars) array of the gaussian parameters of each image
+    (which parameters depends on circle, rotate and vheight as for
+    `moments`), computed as `moments` does with the default median
+    estimator.  NaN pixels are ignored.  Images for which `moments` would
+    raise "something is nan" get NaN parameters instead.
+    """
+    data = np.asarray(stack, dtype='float')
+    if data.ndim == 2:
+        data = data[None]
+    else:
+        data = np.rollaxis(data, axis, 0)
+    nimages,ny,nx = data.shape
+    nans = np.isnan(data)
+    zeroed = np.where(nans, 0, data)
+    absdata = np.abs(zeroed)
+    total = absdata.sum(axis=(1,2))
+
+    Y, X = np.indices((ny,nx)) # python convention: reverse x,y np.indices
+    y = np.argmax((X*absdata).sum(axis=2),axis=1)
+    x = np.argmax((Y*absdata).sum(axis=1),axis=1)
+    images = np.arange(nimages)
+    col = zeroed[images,y,:]
+    row = zeroed[images,:,x]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        # FIRST moment, not second!
+        width_x = np.sqrt(np.abs((np.arange(nx)-y[:,None])*col).sum(axis=1)/np.abs(col).sum(axis=1))
+        width_y = np.sqrt(np.abs((np.arange(ny)-x[:,None])*row).sum(axis=1)/np.abs(row).sum(axis=1))
+    width = ( width_x + width_y ) / 2.
+    height = _nanmedian_rows(data.reshape([nimages,-1]))
+    amplitude = np.where(nans, -np.inf, data).max(axis=(1,2))-height
+
+    mylist = [amplitude,x,y]
+    if vheight==1:
+        mylist = [height] + mylist
+    if circle==0:
+        mylist = mylist + [width_x,width_y]
+        if rotate==1:
+            mylist = mylist + [np.zeros(nimages)]
+    else:
+        mylist = mylist + [width]
+    moments = np.array(mylist,dtype='float').T
+    bad = (np.isnan(width_y) | np.isnan(width_x) | ~np.isfinite(height) |
+            ~np.isfinite(amplitude) | (total == 0))
+    moments[bad] = np.nan
+    return moments
+
+_indices_cache = {}
+
+def cached_indices(shape):
+    """
+    np.indices(shape) as floats, computed once per shape and shared
+    (read-only) by every later call
+    """
+    shape = tuple(int(n) for n in shape)
+    if shape not in _indices_cache:
+        if len(_indices_cache) > 32:
+            _indices_cache.clear()
+        grid = np.indices(shape, dtype='float')
+        grid.flags.writeable = False
+        _indices_cache[shape] = grid
+    return _indices_cache[shape]
+
 def twodgaussian(inpars, circle=False, rotate=True, vheight=True, shape=None):
     """Returns a 2d gaussian function of the form:
         x' = np.cos(rota) * x - np.sin(rota) * y
@@ -140,17 +209,204 @@ def twodgaussian(inpars, circle=False, rotate=True, vheight=True, shape=None):
             ((rcen_y-yp)/width_y)**2)/2.)
         return g
     if shape is not None:
-        return rotgauss(*np.indices(shape))
+        return rotgauss(*cached_indices(shape))
     else:
         return rotgauss
 
+def twodgaussian_deriv(inpars, circle=False, rotate=True, vheight=True, shape=None):
+    """
+    Partial derivatives of `twodgaussian` with respect to each of its
+    parameters.  Takes the same arguments, and returns a function of (x,y)
+    (or, if shape is set, an image) whose last axis has one entry per
+    parameter, in the order of inpars.  Rotation derivatives are per degree.
+    """
+    inpars = [float(p) for p in inpars]
+    npars = len(inpars)
+    if vheight == 1:
+        inpars.pop(0)
+    amplitude, center_y, center_x = inpars.pop(0),inpars.pop(0),inpars.pop(0)
+    if circle == 1:
+        width_x = width_y = inpars.pop(0)
+        rotate = 0
+    else:
+        width_x, width_y = inpars.pop(0),inpars.pop(0)
+    if rotate == 1:
+        rota = pi/180. * inpars.pop(0)
+    else:
+        rota = 0.
+    if len(inpars) > 0:
+        raise ValueError("There are still input parameters:" + str(inpars) + \
+                " circle=%d, rotate=%d, vheight=%d" % (circle,rotate,vheight) )
+    cosr,sinr = np.cos(rota),np.sin(rota)
+
+    def rotgauss_deriv(x,y):
+        # offsets from the center in the rotated frame, as in twodgaussian
+        dX = (center_x-x)*cosr - (center_y-y)*sinr
+        dY = (center_x-x)*sinr + (center_y-y)*cosr
+        u,v = dX/width_x,dY/width_y
+        expo = np.exp(-(u**2+v**2)/2.)
+        aexp = amplitude*expo
+        derivs = [expo,
+                  -aexp*(-u*sinr/width_x + v*cosr/width_y),
+                  -aexp*(u*cosr/width_x + v*sinr/width_y)]
+        if circle == 1:
+            derivs.append(aexp*(u**2+v**2)/width_x)
+        else:
+            derivs += [aexp*u**2/width_x, aexp*v**2/width_y]
+            if rotate == 1:
+                derivs.append(-aexp*(-u*dY/width_x + v*dX/width_y)*pi/180.)
+        if vheight == 1:
+            derivs.insert(0,np.ones_like(expo))
+        derivs = np.array(derivs)
+        if len(derivs) != npars:
+            raise ValueError("Wrong number of parameters")
+        return np.rollaxis(derivs,0,derivs.ndim)
+    if shape is not None:
+        return rotgauss_deriv(*cached_indices(shape))
+    else:
+        return rotgauss_deriv
+
+def _psf_geometry(params, circle, rotate, vheight):
+    """
+    (row center, column center, largest width) of a `twodgaussian`-style
+    parameter list
+    """
+    ind = 1 if vheight else 0
+    col, row = params[ind+1], params[ind+2]
+    widths = params[ind+3:ind+4] if circle else params[ind+3:ind+5]
+    return row, col, max(abs(w) for w in widths)
+
+def gaussian_window_radius(width, window):
+    """ Radius enclosing `window` sigma of a gaussian of the given width """
+    return window * width
+
+class ModelEvaluator(object):
+    """
+    Evaluate and fit a 2D PSF model (`twodgaussian`, or e.g.
+    `psf_fitter.airy`) on images of one shape, for fitting many same-shaped
+    stamps.
+
+    The coordinate grids are computed once (see `cached_indices`).  If
+    `window` is set, `fit` only fits the pixels within a box around the
+    model's center, of half-size ``window_radius(width, window)`` (by default
+    `window` sigma for a gaussian): the data, errors, model and derivatives
+    are all cut down to the box, so for a small PSF on a large cutout mpfit
+    works on a small fraction of the pixels.  The box is placed using the
+    starting parameters, and if the fit moves it (by shifting the center or
+    changing the width) the data are cut again and the fit continued from
+    there.  The background height is then only constrained by the pixels in
+    the box.
+
+    Inputs:
+        shape - shape of the images
+        psffunction - model called as psffunction(params,circle,rotate,
+            vheight,**kwargs)(x,y), like `twodgaussian`
+        circle, rotate, vheight - as for `twodgaussian`
+        window - window half-size in units of width (None: whole image)
+        window_radius - function(width, window) giving the window half-size
+            in pixels
+        psfderiv - optional analytic derivatives of psffunction, called the
+            same way (e.g. `twodgaussian_deriv`)
+        kwargs - extra arguments for psffunction
+
+    >>> evaluator = ModelEvaluator(stamps[0].shape, window=5,
+    ...         psfderiv=twodgaussian_deriv)
+    >>> fits = [gaussfit(stamp, evaluator=evaluator) for stamp in stamps]
+    """
+    def __init__(self, shape, psffunction=twodgaussian, circle=False,
+            rotate=True, vheight=True, window=None,
+            window_radius=gaussian_window_radius, psfderiv=None, **kwargs):
+        self.shape = tuple(shape)
+        self.rows, self.cols = cached_indices(self.shape)
+        self.psffunction = psffunction
+        self.psfderiv = psfderiv
+        self.circle, self.rotate, self.vheight = circle, rotate, vheight
+        self.window = window
+        self.window_radius = window_radius
+        self.kwargs = kwargs
+
+    def window_slices(self, params):
+        """ The part of the image within the window for these params """
+        if self.window is None:
+            return None
+        row,col,width = _psf_geometry(params,self.circle,self.rotate,self.vheight)
+        radius = self.window_radius(width, self.window)
+        if not np.isfinite([row,col,radius]).all():
+            return None
+        return tuple(slice(min(max(int(np.floor(c-radius)),0),n),
+                           min(max(int(np.ceil(c+radius))+1,0),n))
+                for c,n in zip((row,col),self.shape))
+
+    def __call__(self, params, window=None):
+        """ The model image for params (only the part in window if given) """
+        func = self.psffunction(params,self.circle,self.rotate,self.vheight,
+                **self.kwargs)
+        if window is None:
+            return func(self.rows,self.cols)
+        return func(self.rows[window],self.cols[window])
+
+    def deriv(self, params, window=None):
+        """
+        The derivatives of the model image (or of its part in window),
+        shape + (len(params),)
+        """
+        func = self.psfderiv(params,self.circle,self.rotate,self.vheight,
+                **self.kwargs)
+        if window is None:
+            return func(self.rows,self.cols)
+        return func(self.rows[window],self.cols[window])
+
+    def mpfitfun(self, data, err=None, deriv=False, window=None):
+        """
+        An mpfit user function for fitting data (with errors err), or only
+        its part in window; if deriv it returns analytic derivatives too (use
+        mpfit's autoderivative=0)
+        """
+        if window is not None:
+            data = data[window]
+            if err is not None and np.ndim(err) == 2:
+                err = err[window]
+        weight = 1. if err is None else 1./np.ravel(err)
+        def f(p,fjac=None):
+            resid = np.ravel(data-self(p,window))*weight
+            if fjac is None:
+                return [0,resid]
+            derivs = self.deriv(p,window).reshape([resid.size,len(p)])
+            return [0,resid,derivs*np.reshape(weight,[-1,1])]
+        return f
+
+    def fit(self, data, err=None, parinfo=None, deriv=False, quiet=True,
+            maxcuts=10):
+        """
+        Fit data (with errors err) with mpfit, starting from and constrained
+        by parinfo, within the window (see above).  deriv uses the analytic
+        derivatives.  Returns the mpfit object of the last fit, after at
+        most maxcuts cuts of the data.
+        """
+        parinfo = [dict(par) for par in parinfo]
+        params = [par['value'] for par in parinfo]
+        window = self.window_slices(params)
+        for ii in xrange(maxcuts):
+            mp = mpfit(self.mpfitfun(data,err,deriv=deriv,window=window),
+                    parinfo=parinfo,quiet=quiet,
+                    autoderivative=0 if deriv else 1)
+            if window is None or mp.status <= 0:
+                break
+            newwindow = self.window_slices(mp.params)
+            if newwindow == window:
+                break
+            window = newwindow
+            for par,value in zip(parinfo,mp.params):
+                par['value'] = value
+        return mp
+
 def gaussfit(data,err=None,params=(),autoderiv=True,return_all=False,circle=False,
         fixed=np.repeat(False,7),limitedmin=[False,False,False,False,True,True,True],
         limitedmax=[False,False,False,False,False,False,True],
         usemoment=np.array([],dtype='bool'),
         minpars=np.repeat(0,7),maxpars=[0,0,0,0,0,0,360],
         rotate=1,vheight=1,quiet=True,returnmp=False,
-        returnfitimage=False,**kwargs):
+        returnfitimage=False,window=None,evaluator=None,**kwargs):
     """
     Gaussian fitter with the ability to fit a variety of different forms of
     2-dimensional gaussian.
@@ -163,8 +419,9 @@ def gaussfit(data,err=None,params=(),autoderiv=True,return_all=False,circle=Fals
             if not input, these will be determined from the moments of the system, 
             assuming no rotation
         autoderiv=1 - use the autoderiv provided in the lmder.f function (the
-            alternative is to us an analytic derivative with lmdif.f: this method
-            is less robust)
+            alternative is to use the analytic derivatives of
+            `twodgaussian_deriv`, which saves one model evaluation per free
+            parameter on every iteration)
         return_all=0 - Default is to return only the Gaussian parameters.  
                    1 - fit params, fit error
         returnfitimage - returns (best fit params,best fit image)
@@ -179,6 +436,12 @@ def gaussfit(data,err=None,params=(),autoderiv=True,return_all=False,circle=Fals
         usemoment - can choose which parameters to use a moment estimation for.
             Other parameters will be taken from params.  Needs to be a boolean
             array.
+        window=None - only fit the pixels within this many sigma of the
+            gaussian's center (see `ModelEvaluator`); useful for small
+            sources on large images
+        evaluator=None - a `ModelEvaluator` to reuse for fits to many images
+            of the same shape (it must have been made with matching circle,
+            rotate and vheight=1; window is then ignored)
 
     Output:
         Default output is a set of Gaussian parameters with the same shape as
@@ -214,22 +477,10 @@ def gaussfit(data,err=None,params=(),autoderiv=True,return_all=False,circle=Fals
         if params[i] > maxpars[i] and limitedmax[i]: params[i] = maxpars[i]
         if params[i] < minpars[i] and limitedmin[i]: params[i] = minpars[i]
 
-    if err is None:
-        errorfunction = lambda p: np.ravel((twodgaussian(p,circle,rotate,vheight)\
-                (*np.indices(data.shape)) - data))
-    else:
-        errorfunction = lambda p: np.ravel((twodgaussian(p,circle,rotate,vheight)\
-                (*np.indices(data.shape)) - data)/err)
-    def mpfitfun(data,err):
-        if err is None:
-            def f(p,fjac=None): return [0,np.ravel(data-twodgaussian(p,circle,rotate,vheight)\
-                    (*np.indices(data.shape)))]
-        else:
-            def f(p,fjac=None): return [0,np.ravel((data-twodgaussian(p,circle,rotate,vheight)\
-                    (*np.indices(data.shape)))/err)]
-        return f
+    if evaluator is None:
+        evaluator = ModelEvaluator(data.shape,twodgaussian,circle,rotate,vheight,
+                window=window,psfderiv=twodgaussian_deriv)
 
-                    
     parinfo = [ 
                 {'n':1,'value':params[1],'limits':[minpars[1],maxpars[1]],'limited':[limitedmin[1],limitedmax[1]],'fixed':fixed[1],'parname':"AMPLITUDE",'error':0},
                 {'n':2,'value':params[2],'limits':[minpars[2],maxpars[2]],'limited':[limitedmin[2],limitedmax[2]],'fixed':fixed[2],'parname':"XSHIFT",'error':0},
@@ -242,16 +493,7 @@ def gaussfit(data,err=None,params=(),autoderiv=True,return_all=False,circle=Fals
         if rotate == 1:
             parinfo.append({'n':6,'value':params[6],'limits':[minpars[6],maxpars[6]],'limited':[limitedmin[6],limitedmax[6]],'fixed':fixed[6],'parname':"ROTATION",'error':0})
 
-    if autoderiv == 0:
-        # the analytic derivative, while not terribly difficult, is less
-        # efficient and useful.  I only bothered putting it here because I was
-        # instructed to do so for a class project - please ask if you would
-        # like this feature implemented
-        raise ValueError("I'm sorry, I haven't implemented this feature yet.")
-    else:
-#        p, cov, infodict, errmsg, success = optimize.leastsq(errorfunction,\
-#                params, full_output=1)
-        mp = mpfit(mpfitfun(data,err),parinfo=parinfo,quiet=quiet)
+    mp = evaluator.fit(data,err,parinfo,deriv=(autoderiv == 0),quiet=quiet)
 
 
     if returnmp:
@@ -261,7 +503,7 @@ def gaussfit(data,err=None,params=(),autoderiv=True,return_all=False,circle=Fals
     elif return_all == 1:
         returns = mp.params,mp.perror
     if returnfitimage:
-        fitimage = twodgaussian(mp.params,circle,rotate,vheight)(*np.indices(data.shape))
+        fitimage = twodgaussian(mp.params,circle,rotate,vheight)(*cached_indices(data.shape))
         returns = (returns,fitimage)
     return returns
 
@@ -315,6 +557,94 @@ def onedmoments(Xax,data,vheight=True,estimator=median,negamp=None,
         mylist = [height] + mylist
     return mylist
 
+def _nanmedian_rows(data):
+    """ Median of each row of a 2D array, ignoring NaNs (NaN for empty rows) """
+    nans = np.isnan(data)
+    if not nans.any():
+        return np.median(data, axis=1)
+    ordered = np.sort(data, axis=1) # NaNs sort to the end
+    count = (~nans).sum(axis=1)
+    rows = np.arange(len(data))
+    lo,hi = np.maximum((count-1)//2,0),np.maximum(count//2,0)
+    median = 0.5*(ordered[rows,lo]+ordered[rows,hi])
+    median[count==0] = np.nan
+    return median
+
+def onedmoments_stack(Xax,spectra,vheight=True,negamp=None,axis=-1):
+    """
+    Vectorized `onedmoments` for many spectra at once.
+
+    spectra - array of spectra along `axis` (e.g. (nspectra, len(Xax)), or a
+        cube with axis=0)
+
+    Returns an array of (height, amplitude, x, width_x) guesses (without
+    height if vheight is False) along a new last axis, one set per spectrum,
+    computed as `onedmoments` does with the default median estimator.  NaN
+    channels are ignored.  Spectra for which `onedmoments` would raise
+    "something is nan" get NaN guesses instead.
+    """
+    Xax = np.asarray(Xax, dtype='float')
+    data = np.asarray(spectra, dtype='float')
+    data = np.rollaxis(data, axis % data.ndim, data.ndim)
+    outshape = data.shape[:-1]
+    data = data.reshape([-1,data.shape[-1]])
+    nans = np.isnan(data)
+    anynan = nans.any()
+    zeroed = np.where(nans, 0, data) if anynan else data
+    lowest = np.where(nans, np.inf, data) if anynan else data
+    highest = np.where(nans, -np.inf, data) if anynan else data
+    nchan = (~nans).sum(axis=1)
+
+    dx = np.mean(Xax[1:] - Xax[:-1]) # assume a regular grid
+    integral = zeroed.sum(axis=1)*dx
+    height = _nanmedian_rows(data)
+    with np.errstate(invalid='ignore'):
+        above = data > height[:,None]
+        below = data < height[:,None]
+
+    Lpeakintegral = integral - height*nchan*dx - (zeroed*above).sum(axis=1)*dx
+    Lamplitude = lowest.min(axis=1)-height
+    Hpeakintegral = integral - height*nchan*dx - (zeroed*below).sum(axis=1)*dx
+    Hamplitude = highest.max(axis=1)-height
+    with np.errstate(divide='ignore',invalid='ignore'):
+        Lwidth_x = 0.5*(np.abs(Lpeakintegral / Lamplitude))
+        Hwidth_x = 0.5*(np.abs(Hpeakintegral / Hamplitude))
+
+    def masked_std(mask):
+        # std of Xax where mask is set, for each row (NaN for no points),
+        # from sums computed as matrix products
+        mask = mask.astype('float')
+        Xcen = Xax - Xax.mean()
+        count = mask.sum(axis=1)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            mean = mask.dot(Xcen) / count
+            variance = mask.dot(Xcen**2) / count - mean**2
+        return np.sqrt(np.maximum(variance,0))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        datamean = (zeroed.sum(axis=1) / nchan)[:,None]
+        Lstddev = masked_std(data < datamean)
+        Hstddev = masked_std(data > datamean)
+
+    if negamp: # can force the guess to be negative
+        usehigh = np.zeros(len(data), dtype='bool')
+    elif negamp is None:
+        usehigh = Hstddev < Lstddev
+    else:  # if negamp==False, make positive
+        usehigh = np.ones(len(data), dtype='bool')
+
+    xcen = np.where(usehigh, Xax[np.argmax(highest,axis=1)],
+            Xax[np.argmin(lowest,axis=1)])
+    amplitude = np.where(usehigh, Hamplitude, Lamplitude)
+    width_x = np.where(usehigh, Hwidth_x, Lwidth_x)
+
+    moments = [amplitude,xcen,width_x]
+    if vheight:
+        moments = [height] + moments
+    moments = np.array(moments).T
+    bad = ~(np.isfinite(width_x) & np.isfinite(height) & np.isfinite(amplitude))
+    moments[bad] = np.nan
+    return moments.reshape(outshape + (moments.shape[-1],))
+
 def onedgaussian(x,H,A,dx,w):
     """
     Returns a 1-dimensional gaussian of form
@@ -322,6 +652,15 @@ def onedgaussian(x,H,A,dx,w):
     """
     return H+A*np.exp(-(x-dx)**2/(2*w**2))
 
+def onedgaussian_deriv(x,H,A,dx,w):
+    """
+    Partial derivatives of `onedgaussian` with respect to H, A, dx and w,
+    stacked along a new last axis
+    """
+    expo = np.exp(-(x-dx)**2/(2*w**2))
+    return np.stack([np.ones_like(expo), expo, A*expo*(x-dx)/w**2,
+        A*expo*(x-dx)**2/w**3], axis=-1)
+
 def onedgaussfit(xax, data, err=None,
         params=[0,1,0,1],fixed=[False,False,False,False],
         limitedmin=[False,False,False,True],
@@ -329,7 +668,7 @@ def onedgaussfit(xax, data, err=None,
         maxpars=[0,0,0,0], quiet=True, shh=True,
         veryverbose=False,
         vheight=True, negamp=False,
-        usemoments=False):
+        usemoments=False, method='mpfit', autoderiv=True):
     """
     Inputs:
        xax - x axis
@@ -343,6 +682,10 @@ def onedgaussfit(xax, data, err=None,
        quiet - should MPFIT output each iteration?
        shh - output final parameters?
        usemoments - replace default parameters with moments
+       method - 'mpfit', or 'batch' to use the vectorized `mpfit_batch`
+           solver (see `onedgaussfit_stack` for fitting many spectra)
+       autoderiv - use finite-difference derivatives; if False, use the
+           analytic derivatives from `onedgaussian_deriv`
 
     Returns:
        Fit parameters
@@ -358,7 +701,16 @@ def onedgaussfit(xax, data, err=None,
             def f(p,fjac=None): return [0,(y-onedgaussian(x,*p))/err]
         return f
 
-    if xax == None:
+    def mpfitfun_deriv(x,y,err):
+        weight = 1. if err is None else 1./np.asarray(err)
+        def f(p,fjac=None):
+            resid = (y-onedgaussian(x,*p))*weight
+            if fjac is None:
+                return [0,resid]
+            return [0,resid,onedgaussian_deriv(x,*p)*np.reshape(weight,[-1,1])]
+        return f
+
+    if xax is None:
         xax = np.arange(len(data))
 
     if vheight is False: 
@@ -374,10 +726,22 @@ def onedgaussfit(xax, data, err=None,
                 {'n':2,'value':params[2],'limits':[minpars[2],maxpars[2]],'limited':[limitedmin[2],limitedmax[2]],'fixed':fixed[2],'parname':"SHIFT",'error':0},
                 {'n':3,'value':params[3],'limits':[minpars[3],maxpars[3]],'limited':[limitedmin[3],limitedmax[3]],'fixed':fixed[3],'parname':"WIDTH",'error':0}]
 
-    mp = mpfit(mpfitfun(xax,data,err),parinfo=parinfo,quiet=quiet)
-    mpp = mp.params
-    mpperr = mp.perror
-    chi2 = mp.fnorm
+    if method == 'batch':
+        mp = mpfit_batch(_onedgaussian_stack,xax,data,params,err=err,parinfo=parinfo,
+                jacobian=None if autoderiv else _onedgaussian_stack_deriv)
+        mpp,mpperr,chi2 = mp.params[0],mp.perror[0],mp.fnorm[0]
+        mp.status = mp.status[0]
+    elif not autoderiv:
+        mp = mpfit(mpfitfun_deriv(xax,data,err),parinfo=parinfo,quiet=quiet,
+                autoderivative=0)
+        mpp = mp.params
+        mpperr = mp.perror
+        chi2 = mp.fnorm
+    else:
+        mp = mpfit(mpfitfun(xax,data,err),parinfo=parinfo,quiet=quiet)
+        mpp = mp.params
+        mpperr = mp.perror
+        chi2 = mp.fnorm
 
     if mp.status == 0:
         raise Exception(mp.errmsg)
@@ -392,6 +756,75 @@ def onedgaussfit(xax, data, err=None,
     return mpp,onedgaussian(xax,*mpp),mpperr,chi2
 
 
+def _onedgaussian_stack(x,p):
+    """ `onedgaussian` for an (n,4) array of parameters (for `mpfit_batch`) """
+    return onedgaussian(x,p[:,0:1],p[:,1:2],p[:,2:3],p[:,3:4])
+
+def _onedgaussian_stack_deriv(x,p):
+    """ `onedgaussian_deriv` for an (n,4) array of parameters: (n,len(x),4) """
+    return onedgaussian_deriv(x,p[:,0:1],p[:,1:2],p[:,2:3],p[:,3:4])
+
+def onedgaussfit_stack(xax, spectra, err=None,
+        params=[0,1,0,1],fixed=[False,False,False,False],
+        limitedmin=[False,False,False,True],
+        limitedmax=[False,False,False,False], minpars=[0,0,0,0],
+        maxpars=[0,0,0,0], vheight=True, negamp=False,
+        usemoments=False, autoderiv=True, **kwargs):
+    """
+    Fit a gaussian to each of many spectra at once with the batched
+    Levenberg-Marquardt solver `mpfit_batch`.
+
+    Inputs:
+       xax - x axis, shared by all spectra
+       spectra - 2D array, one spectrum per row
+       err - error corresponding to spectra (broadcastable to its shape)
+
+       params - Fit parameters: Height of background, Amplitude, Shift,
+           Width.  Either one set for all spectra or one row per spectrum.
+       fixed, limitedmin, limitedmax, minpars, maxpars, vheight, negamp,
+       usemoments, autoderiv - as in `onedgaussfit`.  Moments are computed
+           for all spectra at once with `onedmoments_stack`.
+
+    Returns:
+       Fit parameters, (nspectra,4)
+       Fit errors, (nspectra,4); NaN for degenerate fits (see `mpfit_batch`)
+       chi2, (nspectra,)
+       mpfit-style status, (nspectra,); 0 (and NaN parameters) where the
+           spectrum or its moments are not finite
+    """
+    if xax is None:
+        xax = np.arange(np.shape(spectra)[-1])
+    xax = np.asarray(xax)
+    spectra = np.asarray(spectra,dtype='float')
+    fixed = list(fixed)
+
+    params = np.array(np.broadcast_to(np.asarray(params,dtype='float'),
+        (len(spectra),4)))
+    if vheight is False:
+        fixed[0] = True
+    if usemoments:
+        moments = onedmoments_stack(xax,spectra,negamp=negamp)
+        if vheight is False:
+            moments[:,0] = params[:,0]
+        params = moments
+
+    parnames = ["HEIGHT","AMPLITUDE","SHIFT","WIDTH"]
+    parinfo = [ {'n':ii,'limits':[minpars[ii],maxpars[ii]],
+        'limited':[limitedmin[ii],limitedmax[ii]],'fixed':fixed[ii],
+        'parname':parnames[ii]} for ii in xrange(4) ]
+
+    fit = mpfit_batch(_onedgaussian_stack,xax,spectra,params,err=err,
+            parinfo=parinfo,
+            jacobian=None if autoderiv else _onedgaussian_stack_deriv)
+    mpp = fit.params
+    mpperr = fit.perror
+    chi2 = fit.fnorm
+    failed = fit.status == 0
+    mpp[failed] = np.nan
+    mpperr[failed] = np.nan
+    chi2[failed] = np.nan
+    return mpp,mpperr,chi2,fit.status
+
 def n_gaussian(pars=None,a=None,dx=None,sigma=None):
     """
     Returns a function that sums over N gaussians, where N is the length of
@@ -419,10 +852,36 @@ def n_gaussian(pars=None,a=None,dx=None,sigma=None):
         return v
     return g
 
+def n_gaussian_deriv(pars,x):
+    """
+    Partial derivatives of `n_gaussian` (given pars) at x, shape
+    (len(x),len(pars)), in the order of pars
+    """
+    x = np.asarray(x,dtype='float')[:,None]
+    a,dx,sigma = (np.asarray(pars[ii::3],dtype='float') for ii in xrange(3))
+    expo = np.exp( - ( x - dx )**2 / (2.0*sigma**2) )
+    derivs = np.stack([expo, a*expo*(x-dx)/sigma**2,
+        a*expo*(x-dx)**2/sigma**3], axis=-1)
+    return derivs.reshape([len(x),len(pars)])
+
+def _n_gaussian_stack(x,p):
+    """ `n_gaussian` for an (n,3*ngauss) array of parameters (for `mpfit_batch`) """
+    a,dx,sigma = p[:,0::3,None],p[:,1::3,None],p[:,2::3,None]
+    return (a * np.exp( - ( x - dx )**2 / (2.0*sigma**2) )).sum(axis=1)
+
+def _n_gaussian_stack_deriv(x,p):
+    """ `n_gaussian_deriv` for an (n,3*ngauss) array of parameters """
+    a,dx,sigma = p[:,0::3,None],p[:,1::3,None],p[:,2::3,None]
+    expo = np.exp( - ( x - dx )**2 / (2.0*sigma**2) )
+    derivs = np.stack([expo, a*expo*(x-dx)/sigma**2,
+        a*expo*(x-dx)**2/sigma**3], axis=-1)
+    return derivs.transpose(0,2,1,3).reshape(p.shape[0],-1,p.shape[1])
+
 def multigaussfit(xax, data, ngauss=1, err=None, params=[1,0,1],
         fixed=[False,False,False], limitedmin=[False,False,True],
         limitedmax=[False,False,False], minpars=[0,0,0], maxpars=[0,0,0],
-        quiet=True, shh=True, veryverbose=False):
+        quiet=True, shh=True, veryverbose=False, method='mpfit',
+        autoderiv=True):
     """
     An improvement on onedgaussfit.  Lets you fit multiple gaussians.
 
@@ -442,6 +901,10 @@ def multigaussfit(xax, data, ngauss=1, err=None, params=[1,0,1],
 
        quiet - should MPFIT output each iteration?
        shh - output final parameters?
+       method - 'mpfit', or 'batch' to use the vectorized `mpfit_batch`
+           solver
+       autoderiv - use finite-difference derivatives; if False, use the
+           analytic derivatives from `n_gaussian_deriv`
 
     Returns:
        Fit parameters
@@ -478,7 +941,16 @@ def multigaussfit(xax, data, ngauss=1, err=None, params=[1,0,1],
             def f(p,fjac=None): return [0,(y-n_gaussian(pars=p)(x))/err]
         return f
 
-    if xax == None:
+    def mpfitfun_deriv(x,y,err):
+        weight = 1. if err is None else 1./np.asarray(err)
+        def f(p,fjac=None):
+            resid = (y-n_gaussian(pars=p)(x))*weight
+            if fjac is None:
+                return [0,resid]
+            return [0,resid,n_gaussian_deriv(p,x)*np.reshape(weight,[-1,1])]
+        return f
+
+    if xax is None:
         xax = np.arange(len(data))
 
     parnames = {0:"AMPLITUDE",1:"SHIFT",2:"WIDTH"}
@@ -493,10 +965,22 @@ def multigaussfit(xax, data, ngauss=1, err=None, params=[1,0,1],
         print "GUESSES: "
         print "\n".join(["%s: %s" % (p['parname'],p['value']) for p in parinfo])
 
-    mp = mpfit(mpfitfun(xax,data,err),parinfo=parinfo,quiet=quiet)
-    mpp = mp.params
-    mpperr = mp.perror
-    chi2 = mp.fnorm
+    if method == 'batch':
+        mp = mpfit_batch(_n_gaussian_stack,xax,data,params,err=err,parinfo=parinfo,
+                jacobian=None if autoderiv else _n_gaussian_stack_deriv)
+        mpp,mpperr,chi2 = mp.params[0],mp.perror[0],mp.fnorm[0]
+        mp.status = mp.status[0]
+    elif not autoderiv:
+        mp = mpfit(mpfitfun_deriv(xax,data,err),parinfo=parinfo,quiet=quiet,
+                autoderivative=0)
+        mpp = mp.params
+        mpperr = mp.perror
+        chi2 = mp.fnorm
+    else:
+        mp = mpfit(mpfitfun(xax,data,err),parinfo=parinfo,quiet=quiet)
+        mpp = mp.params
+        mpperr = mp.perror
+        chi2 = mp.fnorm
 
     if mp.status == 0:
         raise Exception(mp.errmsg)
@@ -510,52 +994,198 @@ def multigaussfit(xax, data, ngauss=1, err=None, params=[1,0,1],
 
     return mpp,n_gaussian(pars=mpp)(xax),mpperr,chi2
 
+def _fit_spectrum(row,xax=None,err=None,usemoments=True,negamp=False,
+        kwargs={}):
+    """
+    Fit one spectrum for `collapse_gaussfit`.  `row` is the spectrum followed
+    by its 4 moment guesses; returns parameters, errors and chi^2 in one
+    array of 9, or NaNs if the guess or the fit failed.
+    """
+    nchan = len(xax)
+    spectrum,guess = row[:nchan],row[nchan:]
+    kwargs = dict(kwargs)
+    if usemoments:
+        if np.isnan(guess).any():
+            return np.repeat(np.nan,9)
+        guess = list(guess)
+        if kwargs.get('vheight',True) is False:
+            guess[0] = kwargs.get('params',[0])[0]
+        kwargs['params'] = guess
+    try:
+        mpp,gfit,mpperr,chi2 = onedgaussfit(xax,spectrum,err=err,
+                negamp=negamp,usemoments=False,**kwargs)
+    except Exception:
+        return np.repeat(np.nan,9)
+    return np.concatenate([mpp,mpperr,[chi2]])
+
+def _fit_spectra_batch(rows,xax=None,err=None,usemoments=True,negamp=False,
+        kwargs={}):
+    """
+    Fit a chunk of spectra for `collapse_gaussfit` with `onedgaussfit_stack`.
+    `rows` holds one spectrum followed by its 4 moment guesses per row;
+    returns parameters, errors and chi^2 as an (n,9) array.
+    """
+    nchan = len(xax)
+    kwargs = dict(kwargs)
+    for key in ('quiet','shh','veryverbose','method'):
+        kwargs.pop(key,None)
+    if usemoments:
+        guesses = rows[:,nchan:].copy()
+        if kwargs.get('vheight',True) is False:
+            guesses[:,0] = kwargs.get('params',[0])[0]
+        kwargs['params'] = guesses
+    mpp,mpperr,chi2,status = onedgaussfit_stack(xax,rows[:,:nchan],err=err,
+            negamp=negamp,usemoments=False,**kwargs)
+    return np.concatenate([mpp,mpperr,chi2[:,None]],axis=1)
+
 def collapse_gaussfit(cube,xax=None,axis=2,negamp=False,usemoments=True,nsigcut=1.0,mppsigcut=1.0,
-        return_errors=False, **kwargs):
+        return_errors=False, numcores=1, blocksize=65536, chunksize=None,
+        output=None, return_maps=False, verbose=False, progress=None,
+        method='mpfit', **kwargs):
+    """
+    Fit a single gaussian (with `onedgaussfit`) to every spectrum in a cube
+    whose peak (or trough, if negamp) is more than `nsigcut` times the median
+    spectrum standard deviation, and collect the results in maps.
+
+    Initial guesses are computed for all of the selected spectra at once with
+    `onedmoments_stack`.  The spectra are then fit in blocks of `blocksize`,
+    each spread over `numcores` processes with
+    `contributed.parallel_map_array`.  The cube is read a block at a time
+    (also when computing the spectrum standard deviations and peaks that
+    select the spectra to fit), so only one block of spectra is ever held
+    in memory.  By default the spectra are fit one at a time with
+    `onedgaussfit`; method='batch' instead fits each work unit of
+    `chunksize` spectra in one go with the batched solver
+    (`onedgaussfit_stack`), which is much faster.  It reaches the same fits
+    where they are well determined, but gives NaN errors (so the fit is
+    rejected) for degenerate fits that mpfit reports with zero errors, such
+    as a width that ends at 0.  Spectra whose fit fails are left as NaN.
+
+    Inputs:
+       cube - 3D data cube (may be a `numpy.memmap`)
+       xax - spectral axis; defaults to the channel number
+       axis - the spectral axis of the cube
+       negamp - fit absorption (negative) lines
+       usemoments - start each fit from the moments of its spectrum
+       nsigcut - only fit spectra with a peak above nsigcut times the
+           median standard deviation
+       mppsigcut - only keep fits with an amplitude above mppsigcut times its
+           error
+       numcores - number of processes to fit with
+       blocksize - maximum number of spectra to extract and fit at a time
+       chunksize - number of spectra per work unit sent to a process
+           (defaults to 1024 for method='batch', otherwise a few units per
+           process per block)
+       output - None to return in-memory maps, or the name of a .npy file to
+           create and memory-map for them (for cubes whose maps don't fit in
+           memory).  The file holds a (9,ny,nx) array: the 4 fit parameters
+           (height, amplitude, offset, width), their 4 errors, and chi^2.
+       return_maps - return that (9,ny,nx) array instead of the tuples below
+       verbose - print the number of spectra to fit and the total time
+       progress - optional callable, called as progress(nfit, nspectra)
+       method - 'mpfit' (`onedgaussfit`) or 'batch' (`onedgaussfit_stack`)
+       kwargs - passed to `onedgaussfit` (or `onedgaussfit_stack`)
+
+    Returns:
+       width,offset,amplitude,chi2 maps, or
+       width,offset,amplitude,width error,offset error,amplitude error,chi2
+       maps if return_errors
+    """
     import time
-    std_coll = cube.std(axis=axis)
-    std_coll[std_coll==0] = np.nan # must eliminate all-zero spectra
-    mean_std = median(std_coll[std_coll==std_coll])
+    import functools
+    from contributed import parallel_map_array
+
+    starttime = time.time()
     if axis > 0:
         cube = cube.swapaxes(0,axis)
-    width_arr = np.zeros(cube.shape[1:]) + np.nan
-    amp_arr = np.zeros(cube.shape[1:]) + np.nan
-    chi2_arr = np.zeros(cube.shape[1:]) + np.nan
-    offset_arr = np.zeros(cube.shape[1:]) + np.nan
-    width_err = np.zeros(cube.shape[1:]) + np.nan
-    amp_err = np.zeros(cube.shape[1:]) + np.nan
-    offset_err = np.zeros(cube.shape[1:]) + np.nan
-    if xax is None:
-        xax = np.arange(cube.shape[0])
-    starttime = time.time()
-    print "Cube shape: ",cube.shape
+    nchan = cube.shape[0]
     if negamp: extremum=np.min
     else: extremum=np.max
-    print "Fitting a total of %i spectra with peak signal above %f" % ((np.abs(extremum(cube,axis=0)) > (mean_std*nsigcut)).sum(),mean_std*nsigcut)
-    for i in xrange(cube.shape[1]):
-        t0 = time.time()
-        nspec = (np.abs(extremum(cube[:,i,:],axis=0)) > (mean_std*nsigcut)).sum()
-        print "Working on row %d with %d spectra to fit" % (i,nspec) ,
-        for j in xrange(cube.shape[2]):
-            if np.abs(extremum(cube[:,i,j])) > (mean_std*nsigcut):
-                mpp,gfit,mpperr,chi2 = onedgaussfit(xax,cube[:,i,j],err=np.ones(cube.shape[0])*mean_std,negamp=negamp,usemoments=usemoments,**kwargs)
-                if np.abs(mpp[1]) > (mpperr[1]*mppsigcut):
-                    width_arr[i,j] = mpp[3]
-                    offset_arr[i,j] = mpp[2]
-                    chi2_arr[i,j] = chi2
-                    amp_arr[i,j] = mpp[1]
-                    width_err[i,j] = mpperr[3]
-                    offset_err[i,j] = mpperr[2]
-                    amp_err[i,j] = mpperr[1]
-        dt = time.time()-t0
-        if nspec > 0:
-            print "in %f seconds (average: %f)" % (dt,dt/float(nspec))
-        else:
-            print "in %f seconds" % (dt)
-    print "Total time %f seconds" % (time.time()-starttime)
 
-    if return_errors:
-        return width_arr,offset_arr,amp_arr,width_err,offset_err,amp_err,chi2_arr
+    # the standard deviation and peak of each spectrum, computed a block of
+    # rows at a time so that a memory-mapped cube is never read in full
+    std_coll = np.empty(cube.shape[1:])
+    peak = np.empty(cube.shape[1:])
+    nrows = max(1, blocksize // max(1, int(np.prod(cube.shape[2:]))))
+    for row in xrange(0, cube.shape[1], nrows):
+        spectra = cube[:,row:row+nrows].astype('float')
+        std_coll[row:row+nrows] = spectra.std(axis=0)
+        peak[row:row+nrows] = np.abs(extremum(spectra,axis=0))
+    del spectra
+    std_coll[std_coll==0] = np.nan # must eliminate all-zero spectra
+    mean_std = median(std_coll[std_coll==std_coll])
+    mapshape = (9,) + cube.shape[1:]
+    if output is None:
+        maps = np.empty(mapshape)
     else:
-        return width_arr,offset_arr,amp_arr,chi2_arr
+        maps = np.lib.format.open_memmap(output, mode='w+', dtype='float',
+                shape=mapshape)
+    maps[...] = np.nan
+    if xax is None:
+        xax = np.arange(nchan)
+    xax = np.asarray(xax)
+
+    yy,xx = np.nonzero(peak > (mean_std*nsigcut))
+    nfit = len(yy)
+    if verbose:
+        print "Cube shape: ",cube.shape
+        print "Fitting a total of %i spectra with peak signal above %f" % (nfit,mean_std*nsigcut)
+
+    if method == 'batch':
+        fitter = _fit_spectra_batch
+        if chunksize is None:
+            chunksize = 1024
+    else:
+        fitter = _fit_spectrum
+    fitter = functools.partial(fitter, xax=xax,
+            err=np.ones(nchan)*mean_std, usemoments=usemoments,
+            negamp=negamp, kwargs=kwargs)
+
+    for start in xrange(0, nfit, blocksize):
+        by,bx = yy[start:start+blocksize],xx[start:start+blocksize]
+        spectra = np.asarray(cube[:,by,bx],dtype='float').T
+        block = np.empty([len(by),nchan+4])
+        block[:,:nchan] = spectra
+        if usemoments:
+            block[:,nchan:] = onedmoments_stack(xax,spectra,negamp=negamp)
+        else:
+            block[:,nchan:] = 0
+        if progress is not None:
+            blockprogress = (lambda ndone,ntotal,start=start:
+                    progress(start+ndone, nfit))
+        else:
+            blockprogress = None
+        if method == 'batch':
+            # each work unit is a whole chunk of spectra: pad the block to a
+            # whole number of chunks (the padding fits fail harmlessly)
+            nchunks = -(-len(block) // chunksize)
+            chunks = np.empty([nchunks*chunksize,nchan+4])
+            chunks[:len(block)] = block
+            chunks[len(block):] = np.nan
+            chunks = chunks.reshape(nchunks,chunksize,nchan+4)
+            if blockprogress is not None:
+                chunkprogress = (lambda ndone,ntotal,blockprogress=blockprogress:
+                        blockprogress(min(ndone*chunksize,len(block)),len(block)))
+            else:
+                chunkprogress = None
+            results = parallel_map_array(fitter, chunks, numcores=numcores,
+                    chunksize=1, progress=chunkprogress)
+            results = results.reshape(nchunks*chunksize,9)[:len(block)]
+        else:
+            results = parallel_map_array(fitter, block, numcores=numcores,
+                    chunksize=chunksize, progress=blockprogress)
+
+        good = np.abs(results[:,1]) > (results[:,5]*mppsigcut)
+        maps[:,by[good],bx[good]] = results[good].T
 
+    if isinstance(maps, np.memmap):
+        maps.flush()
+    if verbose:
+        print "Total time %f seconds" % (time.time()-starttime)
+
+    if return_maps:
+        return maps
+    elif return_errors:
+        return maps[3],maps[2],maps[1],maps[7],maps[6],maps[5],maps[8]
+    else:
+        return maps[3],maps[2],maps[1],maps[8]
@@ -1 +1,2 @@
 from mpfit import mpfit
+from mpfit_batch import mpfit_batch
@@ -0,0 +1,483 @@
+"""
+Levenberg-Marquardt least-squares minimization of many independent problems
+at once.
+
+`mpfit` solves one problem at a time, and for the small (4-9 parameter)
+models fit to every spectrum of a cube or every star in an image its
+running time is dominated by the pure-Python QR factorization and
+finite-difference loops.  `mpfit_batch` instead advances N problems of the
+same model together: residuals and Jacobians are evaluated for all of them
+with one vectorized model call, and the damped normal equations are solved
+with stacked NumPy linear algebra.  The iteration is mpfit's (MINPACK's
+trust-region Levenberg-Marquardt, with the same step bounds, parameter
+limits and convergence tests), so each problem follows nearly the same
+path as it would in `mpfit` and stops independently when it converges.
+
+Parameter constraints are given with an `mpfit`-style `parinfo` list (the
+'value', 'fixed', 'limited', 'limits' and 'step' keys are used) and are the
+same for every problem.  'tied', 'mpside' and 'mpmaxstep' are not supported
+and raise a ValueError.
+
+Example, fitting a gaussian to each of N spectra sharing an x axis::
+
+    def model(x, p):
+        return p[:,0:1] * np.exp(-(x-p[:,1:2])**2 / (2*p[:,2:3]**2))
+
+    parinfo = [{}, {}, {'limited':[1,0], 'limits':[0,0]}]
+    fit = mpfit_batch(model, x, spectra, guesses, err=noise, parinfo=parinfo)
+    fit.params, fit.perror, fit.fnorm, fit.status
+"""
+import numpy
+
+
+class mpfit_batch:
+
+    def __init__(self, model, x, data, p0=None, err=None, parinfo=None,
+                 jacobian=None, ftol=1.e-10, xtol=1.e-10, gtol=1.e-10,
+                 maxiter=200, epsfcn=None, nocovar=0):
+        """
+  Inputs:
+    model:
+       The model, called as model(x, p) where p is an (n, npar) array of
+       parameters for n problems.  It must return an (n, m) array of model
+       values (one row per problem), e.g. by using p[:,i:i+1] so that the
+       parameters broadcast against x.
+
+    x:
+       The independent variable, passed to model.  Either shared by all
+       problems, or an array whose first axis has one entry per problem (it
+       is then indexed along with p).
+
+    data:
+       An (N, m) array of measurements, one row per problem (a 1D array is
+       a single problem).
+
+    p0:
+       Starting parameters, (N, npar), or (npar,) to use the same start for
+       every problem.  Defaults to the 'value' entries of parinfo.  Values
+       outside the limits are moved onto them.
+
+  Keywords:
+
+     err:
+        1-sigma errors on data, broadcastable to its shape.  Default: 1
+
+     parinfo:
+        A list of npar dictionaries of constraints, as in `mpfit`:
+        'fixed', 'limited' ([lower, upper] flags), 'limits' ([lower, upper]
+        values), 'step' (absolute finite-difference step) and 'value'.
+        Missing keys mean free and unconstrained.  Tied parameters,
+        two-sided derivatives ('mpside') and maximum steps ('mpmaxstep')
+        are not supported.
+
+     jacobian:
+        Optional analytic derivatives of the model, called as
+        jacobian(x, p) and returning an (n, m, npar) array of
+        d model / d p.  Default: forward finite differences, computed for
+        all problems with one model call per free parameter.
+
+     ftol, xtol, gtol, maxiter, epsfcn, nocovar:
+        As in `mpfit`.
+
+   Outputs (attributes, with one entry per problem):
+
+     .params   best fit parameters, (N, npar)
+     .perror   1-sigma parameter errors, (N, npar); 0 for fixed
+               parameters, and NaN for every parameter of a degenerate fit
+               (one that ends with a free parameter at a limit, or whose
+               curvature matrix is singular), where mpfit would report
+               zero errors
+     .covar    covariance matrices, (N, npar, npar), NaN where perror is
+     .fnorm    chi-squared at the best fit
+     .status   as in `mpfit`: 1, 2, 3 (ftol and/or xtol reached), 4 (gtol),
+               5 (maxiter), 6 (no further reduction possible), 7 (xtol too
+               small), or 0 if the data, starting point or jacobian were not
+               finite
+     .niter    number of (successful) iterations
+     .dof      degrees of freedom (number of finite points - free params)
+        """
+        self.model = model
+        self.jacobian = jacobian
+
+        data = numpy.asarray(data, dtype='float')
+        if data.ndim == 1:
+            data = data[None,:]
+        nprob, npts = data.shape
+
+        if parinfo is None and p0 is None:
+            raise ValueError("Either p0 or parinfo must be given")
+        if p0 is None:
+            p0 = [par.get('value', 0) for par in parinfo]
+        p = numpy.array(numpy.broadcast_to(numpy.asarray(p0, dtype='float'),
+                                           (nprob, numpy.shape(p0)[-1])))
+        npar = p.shape[1]
+        if parinfo is None:
+            parinfo = [{}] * npar
+        if len(parinfo) != npar:
+            raise ValueError("parinfo must have one entry per parameter")
+        for key in ('tied', 'mpside', 'mpmaxstep'):
+            if any(par.get(key) for par in parinfo):
+                raise ValueError("parinfo key '%s' is not supported by "
+                                 "mpfit_batch; use mpfit" % key)
+
+        self.fixed = numpy.array([bool(par.get('fixed', 0))
+                                  for par in parinfo])
+        limited = numpy.array([par.get('limited', [0,0]) for par in parinfo],
+                              dtype='bool')
+        limits = numpy.array([par.get('limits', [0,0]) for par in parinfo],
+                             dtype='float')
+        self.lower = numpy.where(limited[:,0], limits[:,0], -numpy.inf)
+        self.upper = numpy.where(limited[:,1], limits[:,1], numpy.inf)
+        if (self.lower > self.upper).any():
+            raise ValueError("Parameter limits are not consistent")
+        self.step = numpy.array([par.get('step', 0) for par in parinfo],
+                                dtype='float')
+        machep = numpy.finfo('float').eps
+        if epsfcn is None:
+            epsfcn = machep
+        self.eps = numpy.sqrt(max(epsfcn, machep))
+
+        p = numpy.clip(p, self.lower, self.upper)
+
+        # weights; missing data get zero weight
+        if err is None:
+            weights = numpy.ones_like(data)
+        else:
+            with numpy.errstate(divide='ignore'):
+                weights = 1. / numpy.broadcast_to(
+                    numpy.asarray(err, dtype='float'), data.shape)
+        bad = ~numpy.isfinite(data) | ~numpy.isfinite(weights)
+        self.data = numpy.where(bad, 0, data)
+        self.weights = numpy.where(bad, 0, weights)
+
+        x = numpy.asarray(x)
+        self.x_per_problem = (x.ndim > 1 and x.shape[0] == nprob and
+                              nprob > 1)
+        self.x = x
+
+        self.status = numpy.zeros(nprob, dtype='int')
+        self.niter = numpy.zeros(nprob, dtype='int')
+        self.dof = (~bad).sum(axis=1) - (~self.fixed).sum()
+        self.errmsg = ''
+
+        self._solve(p, ftol, xtol, gtol, maxiter)
+
+        self.params = p
+        self.fnorm = self._chi2(numpy.arange(nprob), p)
+        self.perror = None
+        self.covar = None
+        if not nocovar:
+            self._calc_covar()
+
+    def _x(self, idx):
+        return self.x[idx] if self.x_per_problem else self.x
+
+    def _resid(self, idx, p):
+        """ Weighted deviates (data - model)/err of problems idx """
+        return (self.data[idx] - self.model(self._x(idx), p)) * \
+            self.weights[idx]
+
+    def _chi2(self, idx, p):
+        return (self._resid(idx, p)**2).sum(axis=1)
+
+    def _jac(self, idx, p, resid):
+        """ d(resid)/dp for problems idx, shape (n, m, npar) """
+        if self.jacobian is not None:
+            return -self.jacobian(self._x(idx), p) * \
+                self.weights[idx][:,:,None]
+        jac = numpy.zeros(resid.shape + (p.shape[1],))
+        for k in numpy.flatnonzero(~self.fixed):
+            h = self.eps * numpy.abs(p[:,k])
+            if self.step[k] > 0:
+                h[:] = self.step[k]
+            h[h == 0] = self.eps
+            # step away from an upper limit, as mpfit does
+            h[p[:,k] + h > self.upper[k]] *= -1
+            pstep = p.copy()
+            pstep[:,k] += h
+            jac[:,:,k] = (self._resid(idx, pstep) - resid) / h[:,None]
+        return jac
+
+    def _solve(self, p, ftol, xtol, gtol, maxiter, factor=100.):
+        """
+        The trust-region Levenberg-Marquardt iteration of MINPACK (and
+        `mpfit`), run for all of the problems together.  Each pass makes one
+        trial step for every unfinished problem: those whose step succeeded
+        get a new jacobian, the others retry with a smaller step bound.
+        """
+        nprob, npar = p.shape
+        free = ~self.fixed
+        machep = numpy.finfo('float').eps
+
+        active = numpy.arange(nprob)
+        resid = self._resid(active, p)
+        chi2 = (resid**2).sum(axis=1)
+        ok = numpy.isfinite(chi2)
+        if not ok.all():
+            self.errmsg = ('non-finite chi-squared at the starting point of '
+                           '%i problems' % (~ok).sum())
+        active = active[ok]
+        resid, chi2 = resid[ok], chi2[ok]
+        n = len(active)
+        alpha = numpy.zeros((n, npar, npar))
+        grad = numpy.zeros((n, npar))
+        use = numpy.zeros((n, npar), dtype='bool')
+        diag = numpy.ones((n, npar))
+        delta = numpy.zeros(n)
+        xnorm = numpy.zeros(n)
+        par = numpy.zeros(n)
+        # first: no successful step yet; fresh: a new jacobian is needed
+        first = numpy.ones(n, dtype='bool')
+        fresh = numpy.ones(n, dtype='bool')
+
+        while len(active):
+            status = numpy.zeros(len(active), dtype='int')
+            failed = numpy.zeros(len(active), dtype='bool')
+
+            if fresh.any():
+                f = numpy.flatnonzero(fresh)
+                pf = p[active[f]]
+                jac = self._jac(active[f], pf, resid[f])
+                g = numpy.einsum('nmk,nm->nk', jac, resid[f])
+                a = numpy.einsum('nmk,nml->nkl', jac, jac)
+                # parameters at a limit that the step would push beyond it
+                # stay put (and out of the solve) for this iteration
+                pegged = (((pf <= self.lower) & (g > 0)) |
+                          ((pf >= self.upper) & (g < 0)))
+                u = free & ~pegged
+                g[~u] = 0
+                a[~u[:,:,None] | ~u[:,None,:]] = 0
+                failed[f] = ~(numpy.isfinite(a).all(axis=(1,2)) &
+                              numpy.isfinite(g).all(axis=1))
+                a[failed[f]] = 0
+                g[failed[f]] = 0
+                colnorm = numpy.sqrt(numpy.diagonal(a, axis1=1, axis2=2))
+
+                # scale by the jacobian column norms (their running maximum)
+                # and start with a step bound of factor*|diag*x|
+                firstf = first[f]
+                d = numpy.where(firstf[:,None], colnorm, diag[f])
+                d = numpy.maximum(d, colnorm)
+                d[d == 0] = 1
+                xn = numpy.sqrt(((d * pf)**2 * free).sum(axis=1))
+                delta[f] = numpy.where(firstf,
+                                       numpy.where(xn > 0, factor * xn, factor),
+                                       delta[f])
+                alpha[f], grad[f], use[f], diag[f], xnorm[f] = a, g, u, d, xn
+
+                # gtol: cosine between the residuals and each jacobian column
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    cosine = numpy.abs(g) / (colnorm *
+                                             numpy.sqrt(chi2[f])[:,None])
+                cosine[colnorm == 0] = 0
+                gnorm = numpy.where(chi2[f] > 0, cosine.max(axis=1), 0)
+                status[f[gnorm <= gtol]] = 4
+
+            finished = (status > 0) | failed
+            if finished.any():
+                self.status[active[status > 0]] = status[status > 0]
+                keep = ~finished
+                (active, resid, chi2, alpha, grad, use, diag, delta, xnorm,
+                 par, first) = [arr[keep] for arr in
+                                (active, resid, chi2, alpha, grad, use, diag,
+                                 delta, xnorm, par, first)]
+                if not len(active):
+                    break
+
+            dp, par = self._lmpar(alpha, grad, diag, delta, par, use)
+
+            # like mpfit, a step that would leave the limits is shortened
+            # (in the same direction) to end on the nearest one
+            pact = p[active]
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                tolimit = numpy.where(dp < 0, (self.lower - pact) / dp,
+                                      (self.upper - pact) / dp)
+            tolimit[~use | (numpy.abs(dp) <= machep)] = 1
+            frac = numpy.clip(tolimit.min(axis=1), 0, 1)
+            dp *= frac[:,None]
+            ptrial = numpy.clip(pact + dp, self.lower, self.upper)
+            pnorm = numpy.sqrt(((diag * dp)**2).sum(axis=1))
+            delta = numpy.where(first, numpy.minimum(delta, pnorm), delta)
+
+            rtrial = self._resid(active, ptrial)
+            chi2trial = (rtrial**2).sum(axis=1)
+
+            # actual and predicted reductions of chi-squared, and their ratio
+            # (the predicted one scaled by frac twice, exactly as mpfit does)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                actred = numpy.where(chi2trial < 100 * chi2,
+                                     1 - chi2trial / chi2, -1.)
+                temp1 = frac**2 * numpy.einsum('nk,nkl,nl->n', dp, alpha,
+                                               dp) / chi2
+                temp2 = frac * par * pnorm**2 / chi2
+                prered = temp1 + 2 * temp2
+                dirder = -(temp1 + temp2)
+                ratio = numpy.where(prered != 0, actred / prered, 0.)
+
+                # update the step bound
+                small = ratio <= 0.25
+                temp = numpy.where(actred >= 0, 0.5,
+                                   0.5 * dirder / (dirder + 0.5 * actred))
+                temp[~(chi2trial < 100 * chi2) | ~(temp >= 0.1)] = 0.1
+                grow = ~small & ((par == 0) | (ratio >= 0.75))
+                delta = numpy.where(small,
+                                    temp * numpy.minimum(delta, pnorm / 0.1),
+                                    numpy.where(grow, pnorm / 0.5, delta))
+                par = numpy.where(small, par / temp,
+                                  numpy.where(grow, 0.5 * par, par))
+
+            # take the successful steps
+            success = ratio >= 1e-4
+            if success.any():
+                sidx = active[success]
+                p[sidx] = ptrial[success]
+                resid[success] = rtrial[success]
+                chi2[success] = chi2trial[success]
+                self.niter[sidx] += 1
+                xnorm[success] = numpy.sqrt(
+                    ((diag[success] * ptrial[success])**2 * free).sum(axis=1))
+            first &= ~success
+            fresh = success
+
+            # convergence tests as in MINPACK
+            fdone = ((numpy.abs(actred) <= ftol) & (prered <= ftol) &
+                     (0.5 * ratio <= 1))
+            xdone = delta <= xtol * xnorm
+            status = numpy.zeros(len(active), dtype='int')
+            status[fdone] = 1
+            status[xdone] = 2
+            status[fdone & xdone] = 3
+            more = status == 0
+            status[more & (self.niter[active] >= maxiter)] = 5
+            status[more & (numpy.abs(actred) <= machep) & (prered <= machep) &
+                   (0.5 * ratio <= 1)] = 6
+            status[more & (delta <= machep * xnorm)] = 7
+            # a step that is not finite can't be recovered from
+            failed = ~numpy.isfinite(dp).all(axis=1) & (status == 0)
+
+            done = (status > 0) | failed
+            self.status[active[status > 0]] = status[status > 0]
+            keep = ~done
+            (active, resid, chi2, alpha, grad, use, diag, delta, xnorm, par,
+             first, fresh) = [arr[keep] for arr in
+                              (active, resid, chi2, alpha, grad, use, diag,
+                               delta, xnorm, par, first, fresh)]
+
+    def _lmpar(self, alpha, grad, diag, delta, par, use):
+        """
+        Levenberg-Marquardt parameters and steps (as MINPACK's lmpar) for
+        step bounds delta: par is 0 where the Gauss-Newton step fits within
+        delta, otherwise it is iterated until |diag*dp| is within 10% of
+        delta.
+        """
+        n, npar = grad.shape
+        dwarf = numpy.finfo('float').tiny
+        diagonal = numpy.arange(npar)
+
+        def damped(idx, lam):
+            mat = alpha[idx] + (lam[:,None] * diag[idx]**2)[:,:,None] * \
+                numpy.eye(npar)
+            mat[:, diagonal, diagonal] += ~use[idx]
+            return mat
+
+        # the Gauss-Newton step (least-squares if the jacobian is rank
+        # deficient)
+        rhs = -grad
+        gauss = damped(numpy.arange(n), numpy.zeros(n))
+        inverse = numpy.linalg.pinv(gauss)
+        dp = numpy.einsum('nkl,nl->nk', inverse, rhs)
+        dxnorm = numpy.sqrt(((diag * dp)**2).sum(axis=1))
+        fp = dxnorm - delta
+        pending = fp > 0.1 * delta
+        gaussnewton = ~pending
+        if not pending.any():
+            return dp, numpy.zeros(n)
+
+        # if the jacobian has full rank the Newton step gives a lower bound
+        # for par, otherwise it is 0; the gradient gives an upper bound
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            w = diag**2 * dp / dxnorm[:,None]
+            parl = (fp / delta) / numpy.einsum('nk,nkl,nl->n', w, inverse, w)
+        fullrank = numpy.linalg.matrix_rank(gauss) == npar
+        parl[~fullrank | ~pending | ~numpy.isfinite(parl)] = 0
+        gnorm = numpy.sqrt(((grad / diag)**2).sum(axis=1))
+        paru = gnorm / delta
+        paru[paru == 0] = dwarf / numpy.minimum(delta[paru == 0], 0.1)
+        par = numpy.minimum(numpy.maximum(par, parl), paru)
+        par = numpy.where(par == 0, gnorm / dxnorm, par)
+
+        for niter in xrange(1, 11):
+            idx = numpy.flatnonzero(pending)
+            if not len(idx):
+                break
+            lam = par[idx]
+            lam = numpy.where(lam == 0, numpy.maximum(dwarf, 0.001 * paru[idx]),
+                              lam)
+            par[idx] = lam
+            mat = damped(idx, lam)
+            x = numpy.linalg.solve(mat, rhs[idx][:,:,None])[:,:,0]
+            dp[idx] = x
+            dn = numpy.sqrt(((diag[idx] * x)**2).sum(axis=1))
+            fpold = fp[idx]
+            fpnew = dn - delta[idx]
+            fp[idx] = fpnew
+            stop = ((numpy.abs(fpnew) <= 0.1 * delta[idx]) |
+                    ((parl[idx] == 0) & (fpnew <= fpold) & (fpold < 0)) |
+                    (niter == 10))
+            pending[idx[stop]] = False
+
+            # Newton correction for the others
+            go = ~stop
+            if go.any():
+                gidx = idx[go]
+                w = diag[gidx]**2 * x[go] / dn[go][:,None]
+                temp = numpy.einsum('nk,nk->n', w, numpy.linalg.solve(
+                    mat[go], w[:,:,None])[:,:,0])
+                parc = (fpnew[go] / delta[gidx]) / temp
+                parl[gidx] = numpy.where(fpnew[go] > 0,
+                                         numpy.maximum(parl[gidx], lam[go]),
+                                         parl[gidx])
+                paru[gidx] = numpy.where(fpnew[go] < 0,
+                                         numpy.minimum(paru[gidx], lam[go]),
+                                         paru[gidx])
+                par[gidx] = numpy.maximum(parl[gidx], lam[go] + parc)
+
+        par[gaussnewton] = 0
+        return dp, par
+
+    def _calc_covar(self, rtol=1e-14):
+        nprob, npar = self.params.shape
+        idx = numpy.arange(nprob)
+        resid = self._resid(idx, self.params)
+        jac = self._jac(idx, self.params, resid)
+        alpha = numpy.einsum('nmk,nml->nkl', jac, jac)
+        free = ~self.fixed
+        unused = ~free[:,None] | ~free[None,:]
+        alpha[:, unused] = 0
+        alpha[:, ~free, ~free] = 1
+
+        # The errors are undefined (NaN) if the fit is degenerate: a free
+        # parameter ends at one of its limits, or the curvature matrix is
+        # singular (a jacobian column is below rtol times the largest, or,
+        # with the diagonal normalized to 1, its smallest eigenvalue is below
+        # rtol).  mpfit instead returns zero errors for those parameters,
+        # which makes such fits look perfectly determined.
+        pegged = ((self.params <= self.lower) |
+                  (self.params >= self.upper)) & free
+        scale = numpy.sqrt(numpy.diagonal(alpha, axis1=1, axis2=2))
+        with numpy.errstate(invalid='ignore'):
+            negligible = (scale <= rtol * (scale * free).max(axis=1)[:,None])
+        good = (numpy.isfinite(alpha).all(axis=(1,2)) &
+                ~(negligible & free).any(axis=1) & ~pegged.any(axis=1))
+        covar = numpy.empty_like(alpha)
+        covar[:] = numpy.nan
+        if good.any():
+            norm = alpha[good] / (scale[good,:,None] * scale[good,None,:])
+            eigval = numpy.linalg.eigvalsh(norm)
+            ok = eigval[:,0] > rtol * eigval[:,-1]
+            gidx = numpy.flatnonzero(good)[ok]
+            covar[gidx] = (numpy.linalg.inv(norm[ok]) /
+                           (scale[gidx,:,None] * scale[gidx,None,:]))
+        covar[:, unused] = 0
+        self.covar = covar
+        self.perror = numpy.sqrt(numpy.diagonal(covar, axis1=1, axis2=2))
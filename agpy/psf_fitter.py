@@ -1,7 +1,9 @@
 # Fit a PSF of type Airy or Gaussian...
-from gaussfitter import twodgaussian,moments
+from gaussfitter import twodgaussian,moments,cached_indices,ModelEvaluator,\
+        gaussian_window_radius
 import numpy
 import scipy
+import scipy.special
 from numpy import pi
 from agpy.mpfit import mpfit
 
@@ -19,6 +21,13 @@ def _gaussian_func(rr, amplitude=1.0, sigma=1.0):
     """
     return amplitude * numpy.exp(-(rr**2) / (2.0 * sigma**2) )
 
+def airy_window_radius(width, window):
+    """
+    Radius of the `window`th dark ring of an Airy function of the given width
+    (for use as a `ModelEvaluator` window_radius)
+    """
+    return scipy.special.jn_zeros(1, int(numpy.ceil(window)))[-1] * width
+
 def airy(inpars, circle=True, rotate=False, vheight=True, shape=None, fwhm=False):
     """Returns a 2d Airy *function* of the form:
         x' = numpy.cos(rota) * x - numpy.sin(rota) * y
@@ -109,7 +118,7 @@ def airy(inpars, circle=True, rotate=False, vheight=True, shape=None, fwhm=False
 
         return airy
     if shape is not None:
-        return rotairy(*numpy.indices(shape))
+        return rotairy(*cached_indices(shape))
     else:
         return rotairy
 
@@ -123,6 +132,8 @@ def psffit(data,err=None,params=[],autoderiv=True,return_all=False,circle=True,
         psffunction=airy, 
         extra_pars=None,
         return_parinfo=False,
+        window=None,
+        evaluator=None,
         **kwargs):
     """
     PSF fitter with the ability to fit a variety of different forms of
@@ -156,6 +167,11 @@ def psffit(data,err=None,params=[],autoderiv=True,return_all=False,circle=True,
             array.
         extra_pars - If your psffunction requires extra parameters, pass their
             parinfo dictionaries through this variable
+        window=None - only fit the pixels near the psffunction's center: out
+            to this many dark rings for an airy, or this many sigma otherwise
+            (see `gaussfitter.ModelEvaluator`)
+        evaluator=None - a `gaussfitter.ModelEvaluator` to reuse when fitting
+            many images of the same shape (window is then ignored)
 
     Output:
         Default output is a set of Gaussian parameters with the same shape as
@@ -185,20 +201,11 @@ def psffit(data,err=None,params=[],autoderiv=True,return_all=False,circle=True,
         if params[i] > maxpars[i] and limitedmax[i]: params[i] = maxpars[i]
         if params[i] < minpars[i] and limitedmin[i]: params[i] = minpars[i]
 
-    if err is None:
-        errorfunction = lambda p: numpy.ravel((psffunction(p,circle,rotate,vheight)\
-                (*numpy.indices(data.shape)) - data))
-    else:
-        errorfunction = lambda p: numpy.ravel((psffunction(p,circle,rotate,vheight)\
-                (*numpy.indices(data.shape)) - data)/err)
-    def mpfitfun(data,err):
-        if err is None:
-            def f(p,fjac=None): return [0,numpy.ravel(data-psffunction(p,circle,rotate,vheight)\
-                    (*numpy.indices(data.shape)))]
-        else:
-            def f(p,fjac=None): return [0,numpy.ravel((data-psffunction(p,circle,rotate,vheight)\
-                    (*numpy.indices(data.shape)))/err)]
-        return f
+    if evaluator is None:
+        window_radius = airy_window_radius if psffunction is airy else \
+                gaussian_window_radius
+        evaluator = ModelEvaluator(data.shape,psffunction,circle,rotate,vheight,
+                window=window,window_radius=window_radius)
 
                     
     parinfo = [ ]
@@ -231,7 +238,7 @@ def psffit(data,err=None,params=[],autoderiv=True,return_all=False,circle=True,
     else:
 #        p, cov, infodict, errmsg, success = optimize.leastsq(errorfunction,\
 #                params, full_output=1)
-        mp = mpfit(mpfitfun(data,err),parinfo=parinfo,quiet=quiet)
+        mp = evaluator.fit(data,err,parinfo,quiet=quiet)
 
 
     if returnmp:
@@ -243,6 +250,6 @@ def psffit(data,err=None,params=[],autoderiv=True,return_all=False,circle=True,
     elif return_all:
         returns = mp.params,mp.perror
     if returnfitimage:
-        fitimage = psffunction(mp.params,circle,rotate,vheight)(*numpy.indices(data.shape))
+        fitimage = psffunction(mp.params,circle,rotate,vheight)(*cached_indices(data.shape))
         returns = (returns,fitimage)
     return returns
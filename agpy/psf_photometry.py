@@ -0,0 +1,324 @@
+"""
+Batch PSF photometry of many stars on many frames, e.g. for light curves.
+
+`subim_gaussfit` opens every file once per star and fits the stars one at a
+time; `photometry` instead opens each frame once, cuts the stamps of all of
+the stars in one indexing operation, and fits all of them together with the
+batched Levenberg-Marquardt solver (`agpy.mpfit.mpfit_batch`) using a
+gaussian or Airy PSF.  Frames are spread over processes with
+`contributed.parallel_map`, and the results come back as one record array
+(one row per star per frame) that can be written out as a text or FITS
+table.
+
+Example::
+
+    >>> table = photometry('@file_list.txt', [103.2, 55.1], [88.0, 12.7],
+    ...                    psf='gaussian', numcores=4, outfile='phot.txt')
+    >>> star0 = table[table['star'] == 0]
+    >>> plot(star0['JD'], star0['flux'])
+"""
+import functools
+import numpy as np
+import scipy.special
+try:
+    import astropy.io.fits as pyfits
+except ImportError:
+    import pyfits
+from gaussfitter import moments_stack
+from agpy.mpfit import mpfit_batch
+
+# FWHM of the Airy function (2 J1(r)/r)^2 in units of r, for converting
+# gaussian (moment) widths to Airy widths
+_airy_fwhm = 2 * 1.61633
+_sigma_to_fwhm = np.sqrt(8*np.log(2))
+
+# integral of each (unit amplitude, unit width) profile over the plane
+_profile_area = {'gaussian': 2*np.pi, 'airy': 4*np.pi}
+
+parnames = ['height','amplitude','xcen','ycen','xwidth','ywidth','rotation']
+
+def _read_filelist(filelist):
+    """
+    A list of (image, error image or None) file names from a list of names or
+    an "@file_list.txt" file with one "image [errimage]" per line
+    """
+    if isinstance(filelist, basestring):
+        if filelist[0] == "@":
+            filelist = [line for line in open(filelist[1:]).readlines()
+                    if line.strip() and line.strip()[0] != "#"]
+        else:
+            filelist = [filelist]
+    files = []
+    for line in filelist:
+        names = line.split()
+        files.append((names[0], names[1] if len(names) > 1 else None))
+    return files
+
+def cut_stamps(data, xcen, ycen, size=10):
+    """
+    Cut size x size stamps centered on (xcen, ycen) (0-indexed columns and
+    rows) out of data, all in one indexing operation.
+
+    Returns the (nstars, size, size) stamps and the column and row of their
+    lower corners in data.  Pixels beyond the edge of data are NaN.
+    """
+    xcen = np.atleast_1d(np.asarray(xcen, dtype='float'))
+    ycen = np.atleast_1d(np.asarray(ycen, dtype='float'))
+    x0 = np.round(xcen).astype('int') - size//2
+    y0 = np.round(ycen).astype('int') - size//2
+    offsets = np.arange(size)
+    rows = (y0[:,None] + offsets)[:,:,None]
+    cols = (x0[:,None] + offsets)[:,None,:]
+    inside = ((rows >= 0) & (rows < data.shape[0]) &
+              (cols >= 0) & (cols < data.shape[1]))
+    stamps = np.asarray(data[np.clip(rows,0,data.shape[0]-1),
+        np.clip(cols,0,data.shape[1]-1)], dtype='float')
+    stamps[~inside] = np.nan
+    return stamps, x0, y0
+
+def _stamp_model(grid, p, profile='gaussian', circle=False, rotate=True,
+        vheight=True):
+    """
+    `twodgaussian` (or `psf_fitter.airy`) for many parameter sets at once:
+    grid is the (2, npix) rows and columns of the stamp pixels, p is
+    (nstars, npars), and the result is (nstars, npix).
+    """
+    ind = 1 if vheight else 0
+    height = p[:,0:1] if vheight else 0
+    amplitude = p[:,ind:ind+1]
+    drow = p[:,ind+2:ind+3] - grid[0]
+    dcol = p[:,ind+1:ind+2] - grid[1]
+    width_x = p[:,ind+3:ind+4]
+    width_y = width_x if circle else p[:,ind+4:ind+5]
+    if rotate and not circle:
+        rota = np.pi/180. * p[:,ind+5:ind+6]
+        drow, dcol = (drow * np.cos(rota) - dcol * np.sin(rota),
+                      drow * np.sin(rota) + dcol * np.cos(rota))
+    r2 = (drow/width_x)**2 + (dcol/width_y)**2
+    if profile == 'gaussian':
+        psf = np.exp(-r2/2.)
+    else:
+        rr = np.sqrt(r2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            psf = (2.0 * scipy.special.j1(rr) / rr)**2
+        psf[rr == 0] = 1.0
+    return height + amplitude * psf
+
+def fit_stamps(stamps, err=None, psf='gaussian', circle=False, rotate=True,
+        vheight=True, params=None,
+        limitedmin=[False,False,False,False,True,True,True],
+        limitedmax=[False,False,False,False,False,False,True],
+        minpars=[0,0,0,0,0,0,0], maxpars=[0,0,0,0,0,0,360], **kwargs):
+    """
+    Fit a PSF to each of a stack of stamps at once.
+
+    Inputs:
+        stamps - (nstars, ny, nx) array; NaN pixels are ignored
+        err - errors on stamps (broadcastable to their shape).  If None the
+            parameter errors are scaled by the reduced chi^2.
+        psf - 'gaussian' (see `gaussfitter.twodgaussian`) or 'airy' (see
+            `psf_fitter.airy`)
+        circle, rotate, vheight - as for `gaussfitter.gaussfit`
+        params - starting parameters, (npars,) or (nstars, npars); default is
+            `gaussfitter.moments_stack` (with the widths converted to Airy
+            widths for psf='airy')
+        limitedmin, limitedmax, minpars, maxpars - as for `gaussfit`, for
+            the full set of 7 parameters
+        kwargs - passed to `mpfit_batch` (e.g. maxiter)
+
+    Returns:
+        the fit `mpfit_batch` object, with params, perror, covar, fnorm,
+        status and dof per stamp
+    """
+    if psf not in _profile_area:
+        raise ValueError("psf must be one of %s" % _profile_area.keys())
+    stamps = np.asarray(stamps, dtype='float')
+    nstars = stamps.shape[0]
+    if params is None:
+        params = moments_stack(stamps, circle, rotate, vheight)
+        if psf == 'airy':
+            ind = 1 if vheight else 0
+            nwidths = 1 if circle else 2
+            params[:,ind+3:ind+3+nwidths] *= _sigma_to_fwhm / _airy_fwhm
+    params = np.array(np.broadcast_to(np.asarray(params, dtype='float'),
+        (nstars, np.shape(params)[-1])))
+
+    # pick the parameters in use out of the full 7
+    use = [vheight, True, True, True, True, not circle,
+           rotate and not circle]
+    parinfo = [{'limited':[limitedmin[ii],limitedmax[ii]],
+                'limits':[minpars[ii],maxpars[ii]],
+                'parname':parnames[ii].upper()}
+               for ii in xrange(7) if use[ii]]
+    if params.shape[1] != len(parinfo):
+        raise ValueError("params must have %i entries" % len(parinfo))
+
+    # bad starting guesses (e.g. stamps entirely off the image) would make
+    # mpfit_batch give up; they are fit from a dummy guess and flagged below
+    badguess = ~np.isfinite(params).all(axis=1)
+    params[badguess] = [par['limits'][0]+1 for par in parinfo]
+    for ii,par in enumerate(parinfo):
+        lo, hi = par['limits']
+        if par['limited'][0]:
+            params[:,ii] = np.maximum(params[:,ii], lo)
+        if par['limited'][1]:
+            params[:,ii] = np.minimum(params[:,ii], hi)
+
+    grid = np.indices(stamps.shape[1:], dtype='float').reshape([2,-1])
+    model = functools.partial(_stamp_model, profile=psf, circle=circle,
+            rotate=rotate, vheight=vheight)
+    fit = mpfit_batch(model, grid, stamps.reshape([nstars,-1]), params,
+            err=None if err is None else
+            np.broadcast_to(err, stamps.shape).reshape([nstars,-1]),
+            parinfo=parinfo, **kwargs)
+    fit.status[badguess] = 0
+    if err is None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = fit.fnorm / fit.dof
+        fit.covar *= scale[:,None,None]
+        fit.perror *= np.sqrt(scale)[:,None]
+    return fit
+
+def _flux(fit, psf, circle, vheight):
+    """ PSF flux, amplitude * widths * profile area, and its error """
+    ind = 1 if vheight else 0
+    amp = fit.params[:,ind]
+    wx = fit.params[:,ind+3]
+    wy = wx if circle else fit.params[:,ind+4]
+    flux = _profile_area[psf] * amp * np.abs(wx * wy)
+    # propagate the covariance of (amplitude, widths)
+    grad = np.zeros(fit.params.shape)
+    grad[:,ind] = flux / amp
+    if circle:
+        grad[:,ind+3] = 2 * flux / wx
+    else:
+        grad[:,ind+3] = flux / wx
+        grad[:,ind+4] = flux / wy
+    with np.errstate(invalid='ignore'):
+        fluxerr = np.sqrt(np.einsum('nk,nkl,nl->n', grad, fit.covar, grad))
+    return flux, fluxerr
+
+_columns = (['frame','star','JD','flux','flux_err'] + parnames +
+        ['e_'+name for name in parnames] + ['chi2','reduced_chi2','status'])
+
+def _table(nrows):
+    dtype = [(name, 'int' if name in ('frame','star','status') else 'float')
+            for name in _columns]
+    table = np.zeros(nrows, dtype=dtype).view(np.recarray)
+    for name in _columns:
+        if table[name].dtype.kind == 'f':
+            table[name] = np.nan
+    return table
+
+def fit_frame(data, xcen, ycen, err=None, size=10, psf='gaussian',
+        circle=False, rotate=True, vheight=True, **kwargs):
+    """
+    PSF photometry of all of the stars (at columns xcen, rows ycen, 0-indexed)
+    on one image.
+
+    Returns a record array with one row per star (see `photometry`; the
+    frame and JD columns are left for the caller).  Positions are in the
+    coordinates of data, not of the stamps.
+    """
+    stamps, x0, y0 = cut_stamps(data, xcen, ycen, size)
+    if err is not None and np.ndim(err) > 0:
+        err = cut_stamps(err, xcen, ycen, size)[0]
+    fit = fit_stamps(stamps, err=err, psf=psf, circle=circle, rotate=rotate,
+            vheight=vheight, **kwargs)
+
+    table = _table(len(stamps))
+    table.star = np.arange(len(stamps))
+    table.flux, table.flux_err = _flux(fit, psf, circle, vheight)
+    names = [name for name,used in zip(parnames, [vheight, True, True, True,
+        True, not circle, rotate and not circle]) if used]
+    for ii,name in enumerate(names):
+        table[name] = fit.params[:,ii]
+        table['e_'+name] = fit.perror[:,ii]
+    if not vheight:
+        table.height = 0
+    if circle:
+        table.ywidth, table.e_ywidth = table.xwidth, table.e_xwidth
+    if circle or not rotate:
+        table.rotation = 0
+    table.xcen += x0
+    table.ycen += y0
+    table.chi2 = fit.fnorm
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table.reduced_chi2 = fit.fnorm / fit.dof
+    table.status = fit.status
+    failed = fit.status == 0
+    for name in _columns[3:-1]:
+        table[name][failed] = np.nan
+    return table
+
+def _photometry_frame(ii, files=None, xcen=None, ycen=None, jdkeyword=None,
+        **kwargs):
+    filename, errname = files[ii]
+    data, header = pyfits.getdata(filename, header=True, memmap=True)
+    err = None if errname is None else pyfits.getdata(errname, memmap=True)
+    table = fit_frame(data, xcen, ycen, err=err, **kwargs)
+    table.frame = ii
+    table.JD = header.get(jdkeyword, np.nan)
+    return table
+
+def photometry(filelist, xcen, ycen, size=10, psf='gaussian', circle=False,
+        rotate=True, vheight=True, numcores=1, outfile=None,
+        jdkeyword='MJD-OBS', **kwargs):
+    """
+    PSF photometry of a list of stars on a list of frames.
+
+    Each frame is opened (memory-mapped) once, the stamps around all of the
+    stars are cut out together and fit together with `fit_stamps`.
+
+    Inputs:
+        filelist - list of FITS file names, or "@file_list.txt".  Each entry
+            may be "image.fits errimage.fits" to give an error image.
+        xcen, ycen - 0-indexed column and row of each star, the same on every
+            frame
+        size - size of the square stamp fit around each star
+        psf - 'gaussian' or 'airy'
+        circle, rotate, vheight - as for `gaussfitter.gaussfit`
+        numcores - number of processes to spread the frames over
+        outfile - if set, write the table here: as a FITS binary table if the
+            name ends in .fits, otherwise as whitespace-separated text with a
+            header line (readable with `readcol`)
+        jdkeyword - header keyword giving the date of each frame
+        kwargs - passed to `fit_stamps`
+
+    Returns:
+        A record array with one row per star per frame and the columns
+        frame, star, JD, flux (integrated PSF flux), flux_err, the 7 PSF
+        parameters height, amplitude, xcen, ycen, xwidth, ywidth, rotation
+        (as for `twodgaussian`: xcen is the column, but xwidth is the width
+        along the rows; ywidth = xwidth for circle) and their errors
+        e_height, ..., e_rotation, chi2, reduced_chi2 and the mpfit status
+        (0 and NaN results for stars that could not be fit).
+    """
+    files = _read_filelist(filelist)
+    fitter = functools.partial(_photometry_frame, files=files,
+            xcen=np.atleast_1d(xcen), ycen=np.atleast_1d(ycen),
+            jdkeyword=jdkeyword, size=size, psf=psf, circle=circle,
+            rotate=rotate, vheight=vheight, **kwargs)
+    if numcores > 1 and len(files) > 1:
+        from contributed import parallel_map
+        tables = parallel_map(fitter, range(len(files)), numcores=numcores)
+    else:
+        tables = [fitter(ii) for ii in xrange(len(files))]
+    table = np.concatenate(tables).view(np.recarray)
+
+    if outfile is not None:
+        write_table(table, outfile)
+    return table
+
+def write_table(table, outfile):
+    """
+    Write a `photometry` table as a FITS binary table (if outfile ends in
+    .fits) or as text
+    """
+    if outfile.endswith('.fits'):
+        pyfits.BinTableHDU(np.asarray(table)).writeto(outfile, clobber=True)
+    else:
+        fmt = ["%6i" if table.dtype[name].kind == 'i' else "%15.7g"
+                for name in table.dtype.names]
+        np.savetxt(outfile, table, fmt=fmt,
+                header=" ".join(table.dtype.names))
@@ -34,11 +34,16 @@ import idlsave
 import gaussfitter
 import agpy.mpfit as mpfit
 import agpy
+import timestream_store
 from agpy.PCA_tools import *
-from AG_image_tools.drizzle import drizzle
+from AG_image_tools.drizzle import drizzle,PointingMatrix
 from agpy import smooth
-from guppy import hpy
-heapy = hpy()
+try:
+    # only used to report memory use when debugging: it is slow
+    from guppy import hpy
+    heapy = hpy()
+except ImportError:
+    heapy = None
 
 matplotlib.rcParams['image.origin']='lower'
 matplotlib.rcParams['image.interpolation']='nearest'
@@ -73,7 +78,16 @@ class lazydata(object):
             return obj.__dict__[self.varname]
         else:
             print "Computing %s " % self.varname
-            if self.flag:
+            store = obj.__dict__.get('store')
+            if store is not None and self.varname in store:
+                # memory-mapped, already in the [scan,time,bolo] layout with
+                # NaNs past the end of short scans; only the mask is
+                # allocated
+                data = store[self.varname]
+                if self.flag:
+                    data = numpy.ma.masked_array(data, mask=numpy.isnan(data)|(obj.flags > 0), copy=False)
+                obj.__dict__[self.varname] = data
+            elif self.flag:
                 obj.__dict__[self.varname] = obj.__dict__[self.structname][self.varname][0][obj.whscan,:].astype('float')
                 obj.__dict__[self.varname][obj.whempty,:] = NaN
                 obj.__dict__[self.varname].shape = obj.datashape
@@ -201,7 +215,12 @@ class Flagger:
 
         """
 
-    def _loadfits(self, filename, ncfilename='', flagfile='', mapnum='', axis=None, **kwargs):
+    def _loadfits(self, filename, ncfilename='', flagfile='', mapnum='', axis=None, store=True, **kwargs):
+        """
+        Load a _timestream00.fits file and its map and tstomap.  With
+        store=True the timestream and tstomap are copied once into a
+        memory-mapped timestream store (see `_loadsav`) and read from there.
+        """
         fnsearch = re.compile(
                 '([0-9]{6}_o[0-9b][0-9]_raw_ds5.nc)(_indiv[0-9]{1,2}pca)').search(filename)
         ncsearch = re.compile(
@@ -234,11 +253,24 @@ class Flagger:
             self.map = self.mapfile[0].data
             self.map[numpy.isnan(self.map)] = 0
             self.tstomapfn = self.pathprefix+self.fileprefix+"_tstomap.fits"
-            self.tstomapfile = pyfits.open(self.tstomapfn)
-            self.tstomap = self.tstomapfile[0].data
+            sources = [self.tsfn, self.tstomapfn]
+            storepath = self._store_path(store, self.tsfn, sources)
+            if storepath is not None:
+                if not timestream_store.is_store(storepath, sources):
+                    print "Converting %s to a timestream store (this is only done once)" % self.tsfn
+                    timestream_store.fits_to_store(self.tsfn, self.tstomapfn, storepath)
+                self.store = timestream_store.TimestreamStore(storepath)
+                self.tstomap = self.store['ts']
+            else:
+                self.store = None
+                self.tstomapfile = pyfits.open(self.tstomapfn)
+                self.tstomap = self.tstomapfile[0].data
 
 #      self.outfile = open(self.pathprefix+"log_"+self.fileprefix+"_flags.log",'a')
-        self.data = self.tsfile[0].data
+        if self.store is not None:
+            self.data = self.store['data']
+        else:
+            self.data = self.tsfile[0].data
         self.flagfn = self.pathprefix+self.fileprefix+"_flags.fits"
 #      if os.path.exists(self.flagfn):
 #          self.flagfile = pyfits.open(self.flagfn)
@@ -269,6 +301,10 @@ class Flagger:
         self.mu = 0
         self.key = 0
         self._lastkey = None
+        self.pointing = None
+        self.invalidate_map()
+        # eigenvectors of each timestream / scan, kept while flagging
+        self.pca = PCA()
         self.scannum = 0
         self.fignum = 1
         self.open = 1
@@ -288,33 +324,61 @@ class Flagger:
         self.showmap(vmax=vmax)
         self.dcon()
     
-    def _loadsav(self, savfile, flag=True, **kwargs):
-        memtot = heapy.heap().size / 1024.0**3
-        print "Beginning IDLsave file read. %0.3g GB used" % memtot
+    def _store_path(self, store, filename, sources):
+        """
+        The timestream store to use for filename (made from the files
+        `sources`): `timestream_store.default_path(filename)` if store is
+        True, or store if it is a string.  None if store is False, or if the
+        store is missing or out of date and can't be written.
+        """
+        if not store:
+            return None
+        storepath = store if isinstance(store,basestring) else timestream_store.default_path(filename)
+        if timestream_store.is_store(storepath, sources) or timestream_store.can_write(storepath):
+            return storepath
+        print "Can't write a timestream store to %s; reading %s directly" % (storepath, filename)
+        return None
+
+    def _loadsav(self, savfile, flag=True, store=True, **kwargs):
+        """
+        Load an IDL save file.
+
+        With store=True the save file is converted, the first time, into a
+        memory-mapped timestream store (see `timestream_store`) in the
+        directory `timestream_store.default_path(savfile)` (or `store`, if it
+        is a string).  Later sessions open the store instead, which reads
+        only the maps and scan information; each timestream is mapped from
+        disk when it is first used.  store=False reads the whole save file.
+
+        The store is converted again if the save file has changed (in size
+        or modification time) since.  If the store can't be written (e.g. the
+        directory is read-only), the save file is read as with store=False.
+        """
         t0 = time.time()
-        sav = idlsave.read(savfile)
-        memtot = heapy.heap().size / 1024.0**3
+        storepath = self._store_path(store, savfile, [savfile])
+        if storepath is not None:
+            if not timestream_store.is_store(storepath, [savfile]):
+                print "Converting %s to a timestream store (this is only done once)" % savfile
+                timestream_store.sav_to_store(savfile, storepath)
+            self.store = timestream_store.TimestreamStore(storepath)
+            metadata = self.store.metadata
+            self.bgps = self.mapstr = self.needed_once_struct = None
+            print "Opened timestream store %s in %f seconds%s" % (storepath, time.time()-t0, self._memory_report())
+        else:
+            self.store = None
+            print "Beginning IDLsave file read.%s" % self._memory_report()
+            self.bgps, self.mapstr, self.needed_once_struct = timestream_store.read_sav(savfile)
+            metadata = timestream_store.sav_metadata(self.bgps, self.mapstr, self.needed_once_struct)
+            print "Completed IDLsave file read in %f seconds%s" % (time.time() - t0, self._memory_report())
         t1 = time.time()
-        print "Finished reading IDLsave file in %i seconds using %0.3g GB" % (t1 - t0,memtot)
-        self.bgps = sav.get('bgps')
-        memtot = heapy.heap().size / 1024.0**3
-        t2 = time.time()
-        print "Set bgps variable in %i seconds using %0.3g GB" % (t2 - t1,memtot)
-        self.mapstr = sav.get('mapstr')
-        self.needed_once_struct = sav.get('needed_once_struct')
-        if self.needed_once_struct is None:
-            neededoncefile = savfile.replace('preiter','neededonce').replace('postiter','neededonce')
-            if os.path.exists(neededoncefile):
-                sav_once = idlsave.read(neededoncefile)
-                self.needed_once_struct = sav_once.get('needed_once_struct')
-        t3 = time.time()
-        print "Completed IDLsave file read in %f seconds." % (t3 - t0)
 
         self.ncfilename = savfile
         self.tsfile = None
-        if self.needed_once_struct is not None:
-            self.ncdf_filename = self.needed_once_struct.filenames[0]
-        self.outfile_prefix = self.mapstr.outmap[0]
+        if 'ncdf_filename' in metadata:
+            self.ncdf_filename = str(metadata['ncdf_filename'])
+        self.outfile_prefix = str(metadata['outmap'])
+        self.mapfields = dict((key[4:],value) for key,value in metadata.items() if key.startswith('map_'))
+        bgps_fields = list(metadata['bgps_fields'])
 
         fnsearch = re.compile(
                 '([0-9]{6}_o[0-9b][0-9]_raw_ds[125].nc)(_indiv[0-9]{1,2}pca)').search(savfile)
@@ -322,90 +386,44 @@ class Flagger:
             self.fileprefix = fnsearch.group()
             self.pathprefix = savfile[:fnsearch.start()]
 
-        self.ncscans = self.bgps['scans_info'][0]
-        self.sample_interval = self.bgps['sample_interval'][0]
-        if len(self.ncscans.shape) == 1: self.ncscans.shape = [1,2]
+        self.ncscans,self.scanlen,self.whscan,self.whempty = timestream_store.scan_layout(metadata['scans_info'])
+        self.sample_interval = metadata['sample_interval']
         self.scanlengths = self.ncscans[:,1]+1-self.ncscans[:,0]
-        self.scanlen = numpy.max(self.scanlengths)
-        self.ncflags = self.bgps['flags'][0] 
-        self.timelen = self.ncflags.shape[0]
-        self.nbolos = self.ncflags.shape[1]
+        self.timelen,self.nbolos = metadata['flags_shape']
         self.nscans = self.ncscans.shape[0]
-        self.ncbolo_params = self.bgps['bolo_params'][0]
-        self.ncbolo_indices = self.bgps['bolo_indices'][0]
+        self.ncbolo_params = metadata['bolo_params']
+        self.ncbolo_indices = metadata['bolo_indices']
         #self.bolo_indices = asarray(nonzero(self.ncbolo_params[:,0].ravel())).ravel()
         self.bolo_indices = self.ncbolo_indices
         self.ngoodbolos = self.bolo_indices.shape[0]
-        self.whscan = asarray([arange(self.scanlen)+i for i,j in self.ncscans[:,:2]]).ravel()
         self.scanstarts = arange(self.nscans)*self.scanlen
-        self.whempty = concatenate([arange(i+j,i+self.scanlen) for i,j in zip(self.scanstarts,self.scanlengths) ]).ravel()
-        self.whscan[self.whempty] = 0
 
         self.tsshape = [self.nscans*self.scanlen,self.ngoodbolos]
         self.datashape = [self.nscans,self.scanlen,self.ngoodbolos]
 
-        t4 = time.time()
-        memtot = heapy.heap().size / 1024.0**3
-        print "Beginning array reshaping with %f seconds elapsed, %0.3g GB used." % (t4 - t0, memtot)
-
-        #class lazy_whscan(object):
-        #    class data(object):
-        #        def __get__(self, obj, varname, type=None):
-        #            print "Computing ... "
-        #            obj.__dict__[varname] = self.bgps[varname][0][self.whscan,:].astype('float')
-        #    data = data()
-
-        #self.flags          = lazydata('flags',flag=False) # self.bgps['flags'][0][self.whscan,:]
+        # the timestreams are read (from the store or from the save file
+        # structures) when they are first used
         setattr(self.__class__, 'flags', lazydata('flags',flag=False))
         self.flags.shape    = self.datashape
 
         if self.needed_once_struct is not None:
-            print "Loading 'raw' and 'dc_bolos' from needed_once_struct"
-            #self.raw         = lazydata('raw', 'needed_once_struct') #self.needed_once_struct['raw'][0][self.whscan,:].astype('float')
-            #self.dc_bolos    = lazydata('dc_bolos', 'needed_once_struct') #self.needed_once_struct['dc_bolos'][0][self.whscan,:].astype('float')
-            setattr(self.__class__, 'raw', lazydata('raw', 'needed_once_struct',flag=flag)) #self.needed_once_struct['raw'][0][self.whscan,:].astype('float')
-            setattr(self.__class__, 'dc_bolos', lazydata('dc_bolos', 'needed_once_struct',flag=flag)) #self.needed_once_struct['dc_bolos'][0][self.whscan,:].astype('float')
-        elif self.bgps.dtype.fields.has_key('raw'):
-            print "Loading 'raw' and 'dc_bolos' from bgps"
-            #self.raw         = lazydata('raw') # self.bgps['raw'][0][self.whscan,:].astype('float')
-            #self.dc_bolos    = lazydata('dcbolos') # self.bgps['dc_bolos'][0][self.whscan,:].astype('float')
-            setattr(self.__class__, 'raw', lazydata('raw',flag=flag)) #self.needed_once_struct['raw'][0][self.whscan,:].astype('float')
-            setattr(self.__class__, 'dc_bolos', lazydata('dc_bolos',flag=flag)) #self.needed_once_struct['dc_bolos'][0][self.whscan,:].astype('float')
-        #self.astrosignal    = self.bgps['astrosignal'][0][self.whscan,:].astype('float')
-        #self.atmosphere     = self.bgps['atmosphere'][0][self.whscan,:].astype('float')
-        #self.ac_bolos       = self.bgps['ac_bolos'][0][self.whscan,:].astype('float')
-        #self.atmo_one       = self.bgps['atmo_one'][0][self.whscan,:].astype('float')
-        #self.noise          = self.bgps['noise'][0][self.whscan,:].astype('float')
-        #self.scalearr       = self.bgps['scalearr'][0][self.whscan,:].astype('float')
-        self.scale_coeffs   = self.bgps['scale_coeffs'][0].astype('float')
-        #self.weight         = self.bgps['weight'][0][self.whscan,:].astype('float')
-        #self.zeromedian     = self.astrosignal * 0
-        t5 = time.time()
-        memtot = heapy.heap().size / 1024.0**3
-        print "Finished array reshaping in %f seconds, %0.3g GB used." % (t5 - t4, memtot)
-        print "Beginning array flagging."
-
-        #try:
-        #    self.mapped_astrosignal = self.bgps['mapped_astrosignal'][0][self.whscan,:].astype('float')
-        #except ValueError:
-        #    self.mapped_astrosignal = copy.copy(self.astrosignal)
+            rawstruct = 'needed_once_struct'
+        elif 'raw' in bgps_fields or (self.store is not None and 'raw' in self.store):
+            rawstruct = 'bgps'
+        else:
+            rawstruct = None
+        if rawstruct is not None:
+            print "Loading 'raw' and 'dc_bolos' from %s" % (rawstruct if self.store is None else 'the store')
+            setattr(self.__class__, 'raw', lazydata('raw', rawstruct, flag=flag))
+            setattr(self.__class__, 'dc_bolos', lazydata('dc_bolos', rawstruct, flag=flag))
+        self.scale_coeffs   = metadata['scale_coeffs']
 
         datums=['astrosignal','atmosphere','ac_bolos','atmo_one','noise','scalearr','weight','mapped_astrosignal']
         for d in datums:
-            if hasattr(self.bgps,d): # for version one, may not have some...
+            if d in bgps_fields: # for version one, may not have some...
                 setattr(self.__class__, d, lazydata(d,flag=flag))
-            #self.__dict__[d] = lazydata(d)
-            #if self.__dict__.has_key(d):
-            #    self.__dict__[d][self.whempty,:] = NaN
-            #    self.__dict__[d].shape = self.datashape
-            #    self.__dict__[d] = nantomask(self.__dict__[d])
-            #    try:
-            #        self.__dict__[d].mask[self.flags > 0] = True
-            #    except TypeError:
-            #        self.__dict__[d].mask = (self.flags > 0)
-        #import pdb; pdb.set_trace()
         self.weight_by_bolo = self.weight.mean(axis=0).mean(axis=0)
-        if hasattr(self.bgps,'mapped_astrosignal'):
+        if 'mapped_astrosignal' in bgps_fields:
             setattr(self.__class__, 'mapped_astrosignal', lazydata('mapped_astrosignal',flag=flag))
         else:
             setattr(self.__class__, 'mapped_astrosignal', lazydata('astrosignal',flag=flag))
@@ -417,14 +435,12 @@ class Flagger:
         self.ncfile = None
         self.flagfn = savfile.replace("sav","_flags.fits")
 
-        self.map      = nantomask( self.mapstr['astromap'][0] )
-        self.default_map = nantomask( self.mapstr['astromap'][0] )
-        self.model    = nantomask( self.mapstr['model'][0] )
-        self.noisemap = nantomask( self.mapstr['noisemap'][0] )
-        #setattr(self.__class__, 'tstomap', lazydata('ts',reshape=True, structname='mapstr'))
-        #self.tstomap  = lazydata('ts',reshape=True) # 
+        self.map      = nantomask( self.mapfields['astromap'] )
+        self.default_map = nantomask( self.mapfields['astromap'] )
+        self.model    = nantomask( self.mapfields['model'] )
+        self.noisemap = nantomask( self.mapfields['noisemap'] )
 
-        if not hasattr(self.bgps,'atmo_one'):
+        if 'atmo_one' not in bgps_fields:
             print "Reading file as a v1.0.2 sav file"
             self.atmo_one = self.ac_bolos - self.astrosignal
             self.mapped_timestream = self.ac_bolos - self.atmosphere # apparently?
@@ -435,19 +451,19 @@ class Flagger:
             self.version = 'v2.0'
 
         if self.map.sum() == 0:
-            self.map  = nantomask( self.mapstr['rawmap'][0] )
+            self.map  = nantomask( self.mapfields['rawmap'] )
 
-        self.header = pyfits.Header(_hdr_string_list_to_cardlist( self.mapstr['hdr'][0] ))
+        self.header = pyfits.Header(_hdr_string_list_to_cardlist( metadata['hdr'] ))
 
-        t6 = time.time()
-        memtot = heapy.heap().size / 1024.0**3
-        print "Finished array flagging in %f seconds, %0.3g GB used." % (t6 - t5, memtot)
+        t2 = time.time()
+        print "Finished setting up the timestreams in %f seconds%s" % (t2 - t1, self._memory_report())
 
         # don't delay this
-        self.tstomap = reshape( self.mapstr['ts'][0][self.whscan,:] , self.datashape )
-        t7 = time.time()
-        memtot = heapy.heap().size / 1024.0**3
-        print "Computed tstomap in %f seconds, %0.3g GB used." % (t7 - t6, memtot)
+        if self.store is not None:
+            self.tstomap = self.store['ts']
+        else:
+            self.tstomap = reshape( self.mapstr['ts'][0][self.whscan,:] , self.datashape )
+        print "Computed tstomap in %f seconds%s" % (time.time() - t2, self._memory_report())
 
         self._initialize_vars(**kwargs)
 
@@ -495,17 +511,17 @@ class Flagger:
         'first_sky': lambda: self.atmo_one - self.lookup('atmos_remainder'),
         'first_sky_v1': lambda: self.atmo_one - self.lookup('atmos_remainder_v1'),
         'astrosignal_premap': lambda: self.lookup('PCA_astro')+self.astrosignal,
-        'PCA_atmo_v1':     lambda: reshape(unpca_subtract(numpy.nan_to_num(reshape(self.lookup('atmos_remainder_v1'),self.tsshape)),self.npca),self.datashape),
-        'PCA_astro_v1':     lambda: reshape(pca_subtract(numpy.nan_to_num(reshape(self.lookup('atmos_remainder_v1'),self.tsshape)),self.npca),self.datashape),
-        'PCA_atmo':     lambda: reshape(unpca_subtract(numpy.nan_to_num(reshape(self.lookup('atmos_remainder'),self.tsshape)),self.npca),self.datashape),
-        'PCA_astro':     lambda: reshape(pca_subtract(numpy.nan_to_num(reshape(self.lookup('atmos_remainder'),self.tsshape)),self.npca),self.datashape),
-        'PCA_astrosignal':   lambda: reshape(efuncs(reshape(self.astrosignal,self.tsshape)),self.datashape) / self.nbolos**0.5,
-        'PCA_acb':     lambda: reshape(efuncs(reshape(self.ac_bolos,self.tsshape)),self.datashape) / self.nbolos**0.5,
-        'PCA_zeromedian': lambda: reshape(efuncs(reshape(self.atmo_one,self.tsshape)),self.datashape) / self.nbolos**0.5,
-        'PCA_itermedian': lambda: reshape(efuncs(reshape(self.lookup('itermedian'),self.tsshape)),self.datashape) / self.nbolos**0.5,
-        'PCA_noise':   lambda: reshape(efuncs(reshape(self.noise,self.tsshape)),self.datashape) / self.nbolos**0.5,
-        'PCA_default': lambda: reshape(efuncs(reshape(self.atmo_one - self.atmosphere + self.astrosignal,self.tsshape)),self.datashape) / self.nbolos**0.5,
-        'PCA_atmos_remainder': lambda: reshape(efuncs(reshape(numpy.nan_to_num(self.lookup('atmos_remainder')),self.tsshape)),self.datashape) / self.nbolos**0.5,
+        'PCA_atmo_v1':     lambda: reshape(unpca_subtract(numpy.nan_to_num(reshape(self.lookup('atmos_remainder_v1'),self.tsshape)),self.npca,pca=self.pca),self.datashape),
+        'PCA_astro_v1':     lambda: reshape(pca_subtract(numpy.nan_to_num(reshape(self.lookup('atmos_remainder_v1'),self.tsshape)),self.npca,pca=self.pca),self.datashape),
+        'PCA_atmo':     lambda: reshape(unpca_subtract(numpy.nan_to_num(reshape(self.lookup('atmos_remainder'),self.tsshape)),self.npca,pca=self.pca),self.datashape),
+        'PCA_astro':     lambda: reshape(pca_subtract(numpy.nan_to_num(reshape(self.lookup('atmos_remainder'),self.tsshape)),self.npca,pca=self.pca),self.datashape),
+        'PCA_astrosignal':   lambda: reshape(efuncs(reshape(self.astrosignal,self.tsshape),pca=self.pca),self.datashape) / self.nbolos**0.5,
+        'PCA_acb':     lambda: reshape(efuncs(reshape(self.ac_bolos,self.tsshape),pca=self.pca),self.datashape) / self.nbolos**0.5,
+        'PCA_zeromedian': lambda: reshape(efuncs(reshape(self.atmo_one,self.tsshape),pca=self.pca),self.datashape) / self.nbolos**0.5,
+        'PCA_itermedian': lambda: reshape(efuncs(reshape(self.lookup('itermedian'),self.tsshape),pca=self.pca),self.datashape) / self.nbolos**0.5,
+        'PCA_noise':   lambda: reshape(efuncs(reshape(self.noise,self.tsshape),pca=self.pca),self.datashape) / self.nbolos**0.5,
+        'PCA_default': lambda: reshape(efuncs(reshape(self.atmo_one - self.atmosphere + self.astrosignal,self.tsshape),pca=self.pca),self.datashape) / self.nbolos**0.5,
+        'PCA_atmos_remainder': lambda: reshape(efuncs(reshape(numpy.nan_to_num(self.lookup('atmos_remainder')),self.tsshape),pca=self.pca),self.datashape) / self.nbolos**0.5,
         }
 
         self.tscache = {}
@@ -515,16 +531,21 @@ class Flagger:
 
         print "Completed the rest of initialization in an additional %f seconds" % (time.time()-t1)
 
+    def _memory_report(self):
+        """ ', N GB used' if debugging and guppy is available, else '' """
+        if self.debug and heapy is not None:
+            return ", %0.3g GB used" % (heapy.heap().size / 1024.0**3)
+        return ""
+
     def lookup(self, tsname):
         """
         Cache and return data...
         """
         if tsname not in self.tscache:
             t0 = time.time()
-            s0 = heapy.heap().size
             print "Loading and caching %s" % tsname
             self.tscache[tsname] = self.tsplot_dict[tsname]()
-            print "Loading and caching %s took %0.2g seconds and ate up %0.2g GB" % (tsname,time.time()-t0, (heapy.heap().size-s0)/1024.**3)
+            print "Loading and caching %s took %0.2g seconds%s" % (tsname,time.time()-t0,self._memory_report())
 
         return self.tscache.get(tsname)
     
@@ -551,6 +572,7 @@ class Flagger:
             self.tsplot=tsplot
         if self.tsplot_dict.has_key(self.tsplot):
             self.data = self.lookup(self.tsplot) #self.tsplot_dict[self.tsplot]()
+            self.invalidate_map()
         else:
             print "No option for %s" % self.tsplot
             return
@@ -577,9 +599,9 @@ class Flagger:
         Test a variety of noisemap computations
         """
         t0=time.time()
-        self.residualmap = self.mapstr['RESIDMAP'][0]
-        self.weightmap = self.mapstr['WT_MAP'][0]
-        self.nhitsmap = self.mapstr['NHITSMAP'][0]
+        self.residualmap = self.mapfields['residmap']
+        self.weightmap = self.mapfields['wt_map']
+        self.nhitsmap = self.mapfields['nhitsmap']
         self.residsquaremap = drizzle(self.tstomap,self.noise**2,self.map.shape,self.weight*(True-self.flags))
         self.weightsquaremap = drizzle(self.tstomap,self.weight**2,self.map.shape,1.0)
         self.varscalemap = self.weightmap / (self.weightmap**2 - self.weightsquaremap)
@@ -1191,8 +1213,8 @@ class Flagger:
             self.idl_writeflags()
 
     def idl_clearflags(self):
-        if self.needed_once_struct is not None:
-            clearcmd = ("clearflags,'%s' & " % (self.needed_once_struct.filenames[0]))
+        if hasattr(self,'ncdf_filename'):
+            clearcmd = ("clearflags,'%s' & " % (self.ncdf_filename))
             idlcmd = "/Applications/itt/idl/idl/bin/idl"
             cmd = '%s -e "%s"' % (idlcmd,clearcmd)
             os.environ.update({"IDL_STARTUP":"/Users/adam/work/bolocam/.idl_startup_bgps.pro"})
@@ -1203,8 +1225,8 @@ class Flagger:
 
     def idl_writeflags(self, clearflags=False, override_whgood=False):
         flagcmd = "flags_to_ncdf,'%s','%s'" % (self.flagfn,self.filename)
-        if self.needed_once_struct is not None:
-            if clearflags: flagcmd = ("clearflags,'%s' & " % (self.needed_once_struct.filenames[0])) + flagcmd
+        if hasattr(self,'ncdf_filename'):
+            if clearflags: flagcmd = ("clearflags,'%s' & " % (self.ncdf_filename)) + flagcmd
         if override_whgood: flagcmd+=",bolo_indices=%s" % ("["+",".join(["%i" % bi for bi in self.bolo_indices])+"]")
         idlcmd = "/Applications/itt/idl/idl/bin/idl"
         cmd = '%s -e "%s"' % (idlcmd,flagcmd)
@@ -1266,7 +1288,7 @@ class Flagger:
         elif event.key == 'e': 
             self.expsub()
         elif event.key == 'P': # PCA
-            self.plotscan(self.scannum,data=efuncs(self.plane),flag=False,logscale=True)
+            self.plotscan(self.scannum,data=efuncs(self.plane,pca=self.pca),flag=False,logscale=True)
             self.PCAflag = True
         elif event.key == 'q':
             self.close()
@@ -1947,6 +1969,7 @@ class Flagger:
             setattr(self.__class__, d, lazydata(d,flag=False))
 
         self.unmask_all()
+        self.invalidate_map()
 
     def planePCA(self,clear=True, timestream='data', fignum=11, plotitem='evects', scannum=None, flag=True, geometry=None, **kwargs):
 
@@ -1957,13 +1980,13 @@ class Flagger:
             data = self.data[scannum,:,:].copy()
             if flag:
                 data[self.flags[scannum,:,:].astype('bool')] = 0
-            self.efuncarr,self.covmat,self.evals,self.evects = efuncs(data,return_others=True)
+            self.efuncarr,self.covmat,self.evals,self.evects = efuncs(data,return_others=True,pca=self.pca)
         elif self.tsplot_dict.has_key(timestream):
             data = self.lookup(timestream) #tsplot_dict[timestream]()
             data = data[scannum,:,:].copy()
             if flag:
                 data[self.flags[scannum,:,:].astype('bool')] = 0
-            self.efuncarr,self.covmat,self.evals,self.evects = efuncs(data,return_others=True)
+            self.efuncarr,self.covmat,self.evals,self.evects = efuncs(data,return_others=True,pca=self.pca)
         else:
             raise KeyError("Timestream %s is not valid." % timestream)
 
@@ -1986,10 +2009,10 @@ class Flagger:
     def doPCA(self,clear=True,timestream='data', fignum=9, plotitem='evects', **kwargs):
 
         if timestream == 'data':
-            self.efuncarr,self.covmat,self.evals,self.evects = efuncs(reshape(self.data,[self.data.shape[0]*self.data.shape[1],self.data.shape[2]]),return_others=True)
+            self.efuncarr,self.covmat,self.evals,self.evects = efuncs(reshape(self.data,[self.data.shape[0]*self.data.shape[1],self.data.shape[2]]),return_others=True,pca=self.pca)
         elif self.tsplot_dict.has_key(timestream):
             data = self.lookup(timestream) #tsplot_dict[timestream]()
-            self.efuncarr,self.covmat,self.evals,self.evects = efuncs(reshape(data,[data.shape[0]*data.shape[1],data.shape[2]]),return_others=True)
+            self.efuncarr,self.covmat,self.evals,self.evects = efuncs(reshape(data,[data.shape[0]*data.shape[1],data.shape[2]]),return_others=True,pca=self.pca)
         else:
             raise KeyError("Timestream %s is not valid." % timestream)
         self.PCAfig=figure(fignum)
@@ -2006,9 +2029,16 @@ class Flagger:
         ylabel(ylabel_dict[plotitem])
         colorbar()
 
-    def compute_map(self,ts=None,tsname=None,weights=None,showmap=True,**kwargs):
+    def compute_map(self,ts=None,tsname=None,weights=None,showmap=True,full=False,**kwargs):
         """
         Create a map from the data and potentially show it
+
+        The summed data and weight maps are kept, so when the map is made
+        again from the same timestream and weights, only the samples whose
+        flags (or masks) changed since the last call are removed from (or
+        added back to) them, and only the pixels those samples hit change.
+        full=True forces a complete drizzle; so does calling `invalidate_map`
+        after changing the values of a timestream or of the weights in place.
         """
         t0 = time.time()
         if ts is None: 
@@ -2017,17 +2047,55 @@ class Flagger:
             else:
                 ts = self.mapped_timestream
         if weights is None: weights = self.weight
-        elif not isinstance(weights,numpy.ndarray): weights = numpy.ones(ts.shape)*weights
 
-        self.map = drizzle(self.tstomap,ts,self.map.shape,weights*(True-self.flags))
-        print "Computing map took %f seconds" % (time.time() - t0)
+        if self.pointing is None or self.pointing.mapshape != self.map.shape:
+            self.pointing = PointingMatrix(self.tstomap, self.map.shape)
+            self.invalidate_map()
+        # masked samples are left out of the map like flagged ones; treat
+        # them as flagged so that mask changes are updated like flag changes
+        flagged = (numpy.asarray(self.flags) != 0) | numpy.ma.getmaskarray(ts)
+        tsdata, weightdata = numpy.ma.getdata(ts), weights
+        if not numpy.isscalar(weights):
+            flagged |= numpy.ma.getmaskarray(weights)
+            weightdata = numpy.ma.getdata(weights)
+        state = self._mapstate
+        if (not full and state is not None and state['ts'] is ts and
+                (state['weights'] is weights or (numpy.isscalar(weights) and
+                    numpy.isscalar(state['weights']) and
+                    state['weights'] == weights))):
+            removed = flagged & ~state['flagged']
+            restored = state['flagged'] & ~flagged
+            self.pointing.add(state['summap'], state['weightmap'], tsdata,
+                    weightdata, samples=removed, sign=-1)
+            self.pointing.add(state['summap'], state['weightmap'], tsdata,
+                    weightdata, samples=restored)
+            state['flagged'] = flagged
+            print "Updating map (%i samples flagged, %i unflagged) took %f seconds" % (
+                    removed.sum(), restored.sum(), time.time() - t0)
+        else:
+            summap,weightmap = self.pointing.sums(tsdata, weightdata,
+                    flags=flagged)
+            state = self._mapstate = {'ts':ts, 'weights':weights,
+                    'flagged':flagged, 'summap':summap, 'weightmap':weightmap}
+            print "Computing map took %f seconds" % (time.time() - t0)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            self.map = state['summap'] / state['weightmap']
         if showmap: self.showmap(**kwargs)
 
+    def invalidate_map(self):
+        """
+        Forget the summed maps kept by `compute_map`, so that the next map is
+        drizzled from scratch.  Needed whenever a timestream or the weights
+        are changed in place.
+        """
+        self._mapstate = None
+
     def print_mem_iter(self,extras=True):
 
-        if self.needed_once_struct is not None:
-            outfilename = self.mapstr.outmap[0]
-            infilename = self.needed_once_struct.filenames[0]
+        if hasattr(self,'ncdf_filename'):
+            outfilename = self.outfile_prefix
+            infilename = self.ncdf_filename
 
             command = "mem_iter,'{infile}','{outfile}',/no_offsets,/pointing_model,niter=[13,13],dosave=2".format(outfile=outfilename,infile=infilename)
             if extras:
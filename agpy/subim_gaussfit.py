@@ -4,6 +4,9 @@
 #./subim_gaussfit.py @file_list.txt x_cen y_cen [outfile.txt]
 #%run subim_gaussfit.py @file_list.txt x_cen y_cen [outfile.txt] in an interactive session
 # or %run subim_gaussfit.py @file_list.txt @coord_list.txt [outfile.txt]
+#
+# For many stars and/or frames, psf_photometry.photometry does the same fits
+# in batches (each file is opened once) and returns a table.
 #"""
 import sys
 #sys.path.append('/Users/adam/classes/probstat')  #the gaussfitter.py file is in this directory
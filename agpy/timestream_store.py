@@ -0,0 +1,293 @@
+"""
+An on-disk, memory-mapped store for Bolocam timestreams, used by `pyflagger`.
+
+Reading an IDL save file (or a `_timestream00.fits` file) loads every
+timestream into memory.  A store is made from it once: each timestream is
+written, already cut into the [nscans, scanlen, nbolos] layout the Flagger
+uses, to its own ``.npy`` file in a directory, with the (small) scan
+information, maps and header in ``metadata.npz``, which also records the
+size and modification time of the source file, so that the store is made
+again if the file changes.  Each scan is a contiguous block of its file.  Opening the store afterwards reads only the metadata; the
+timestreams are memory-mapped when first used, so only the scans that are
+looked at are read from disk.
+
+Example::
+
+    >>> store = open_store('050906_o11_raw_ds5.nc_indiv13pca_postiter.sav')
+    >>> store['ac_bolos'].shape
+    (20, 3000, 144)
+    >>> scan = store.scan('ac_bolos', 3)
+"""
+import os
+import time
+import numpy
+
+# the timestreams read from the bgps (or needed_once) structure, and 'ts',
+# the timestream -> map pointing, from the mapstr structure
+timestream_names = ['flags', 'raw', 'dc_bolos', 'astrosignal', 'atmosphere',
+        'ac_bolos', 'atmo_one', 'noise', 'scalearr', 'weight',
+        'mapped_astrosignal']
+map_names = ['astromap', 'model', 'noisemap', 'rawmap', 'residmap', 'wt_map',
+        'nhitsmap']
+
+def default_path(filename):
+    """ The store directory used for a file: its name without the extension,
+    plus '_store' """
+    return os.path.splitext(filename)[0] + "_store"
+
+def source_stamp(sources):
+    """ The size and modification time of each of the files a store is made
+    from, recorded in its metadata as 'source_stamp' """
+    return numpy.array([[os.path.getsize(fn), os.path.getmtime(fn)]
+        for fn in sources], dtype='float')
+
+def is_store(path, sources=None):
+    """
+    Has a store been (completely) written to `path`?  If the files it is
+    made from are given as `sources`, they must also be unchanged (same size
+    and modification time) since it was written.
+    """
+    metadatafile = os.path.join(path, 'metadata.npz')
+    if not os.path.exists(metadatafile):
+        return False
+    if sources is None:
+        return True
+    metadata = numpy.load(metadatafile)
+    try:
+        stamp = metadata['source_stamp'] if 'source_stamp' in metadata.files else None
+    finally:
+        metadata.close()
+    try:
+        current = source_stamp(sources)
+    except OSError:
+        # the sources are gone: the store is all there is
+        return True
+    return stamp is not None and numpy.array_equal(stamp, current)
+
+def can_write(path):
+    """ Can a store be written to `path` (i.e., is it, or the nearest
+    existing directory above it, writable)? """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+    return os.path.isdir(path) and os.access(path, os.W_OK)
+
+def scan_layout(scans_info):
+    """
+    The mapping of the concatenated scans onto the [nscans, scanlen] grid.
+
+    Returns
+    -------
+    ncscans: [nscans, 2] first and last sample of each scan
+    scanlen: length of the longest scan
+    whscan: the sample at each position of the grid (raveled)
+    whempty: the (raveled) grid positions beyond the end of shorter scans
+    """
+    ncscans = numpy.array(scans_info)
+    if len(ncscans.shape) == 1: ncscans.shape = [1,2]
+    scanlengths = ncscans[:,1]+1-ncscans[:,0]
+    scanlen = numpy.max(scanlengths)
+    nscans = ncscans.shape[0]
+    whscan = numpy.asarray([numpy.arange(scanlen)+i for i,j in ncscans[:,:2]]).ravel()
+    scanstarts = numpy.arange(nscans)*scanlen
+    whempty = numpy.concatenate([numpy.arange(i+j,i+scanlen) for i,j in zip(scanstarts,scanlengths) ]).ravel()
+    whscan[whempty] = 0
+    return ncscans, scanlen, whscan, whempty
+
+def read_sav(savfile):
+    """
+    Read the bgps, mapstr and needed_once_struct structures from an IDL save
+    file (needed_once_struct from the matching '_neededonce' file if it is
+    not in this one)
+    """
+    import idlsave
+    sav = idlsave.read(savfile)
+    bgps = sav.get('bgps')
+    mapstr = sav.get('mapstr')
+    needed_once_struct = sav.get('needed_once_struct')
+    if needed_once_struct is None:
+        neededoncefile = savfile.replace('preiter','neededonce').replace('postiter','neededonce')
+        if os.path.exists(neededoncefile):
+            sav_once = idlsave.read(neededoncefile)
+            needed_once_struct = sav_once.get('needed_once_struct')
+    return bgps, mapstr, needed_once_struct
+
+def sav_metadata(bgps, mapstr, needed_once_struct=None):
+    """
+    The scan information, maps, and header from the save file structures, as
+    a dict of arrays (the contents of a store's metadata)
+    """
+    metadata = {}
+    for name in ('scans_info', 'sample_interval', 'bolo_params',
+            'bolo_indices'):
+        metadata[name] = numpy.asarray(bgps[name][0])
+    metadata['scale_coeffs'] = bgps['scale_coeffs'][0].astype('float')
+    metadata['bgps_fields'] = numpy.array(bgps.dtype.names)
+    metadata['flags_shape'] = numpy.array(bgps['flags'][0].shape)
+    mapfields = [name.lower() for name in mapstr.dtype.names]
+    for name in map_names:
+        if name in mapfields:
+            metadata['map_'+name] = numpy.asarray(mapstr[name][0])
+    metadata['hdr'] = numpy.array([str(card) for card in mapstr['hdr'][0]])
+    metadata['outmap'] = numpy.array(str(mapstr.outmap[0]))
+    if needed_once_struct is not None:
+        metadata['ncdf_filename'] = numpy.array(str(needed_once_struct.filenames[0]))
+    return metadata
+
+def _write_timestream(path, name, source, whscan, whempty, shape):
+    """
+    Write source[whscan] (with whempty set to NaN for floats) in the
+    [nscans, scanlen, nbolos] layout, a scan at a time
+    """
+    nscans, scanlen = shape[:2]
+    dtype = source.dtype
+    if dtype.kind == 'f':
+        # keep single precision timestreams single precision
+        dtype = numpy.result_type(dtype, numpy.float32)
+    out = numpy.lib.format.open_memmap(os.path.join(path, name+'.npy'),
+            mode='w+', dtype=dtype, shape=tuple(shape))
+    empty = numpy.zeros(nscans*scanlen, dtype='bool')
+    empty[whempty] = True
+    for scan in xrange(nscans):
+        rows = slice(scan*scanlen, (scan+1)*scanlen)
+        block = numpy.asarray(source[whscan[rows]], dtype=dtype)
+        if dtype.kind == 'f':
+            block[empty[rows]] = numpy.nan
+        out[scan] = block.reshape(shape[1:])
+    out.flush()
+    del out
+
+def write_store(path, metadata, timestreams, whscan, whempty, shape):
+    """
+    Write a store: `timestreams` is a dict of name: [nsamples, nbolos] array
+    (or None), cut into `shape` via `whscan`/`whempty`.  The metadata is
+    written last, so an interrupted conversion is not mistaken for a store.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    elif is_store(path):
+        # replacing an out-of-date store: remove its metadata first, then
+        # the timestreams
+        os.remove(os.path.join(path, 'metadata.npz'))
+        for fn in os.listdir(path):
+            if fn.endswith('.npy'):
+                os.remove(os.path.join(path, fn))
+    for name, source in timestreams.items():
+        if source is not None:
+            _write_timestream(path, name, source, whscan, whempty, shape)
+    numpy.savez(os.path.join(path, 'metadata.npz'), **metadata)
+
+def sav_to_store(savfile, path=None, verbose=False):
+    """
+    Convert an IDL save file to a store (default: `default_path(savfile)`).
+    This reads the whole save file once.  If verbose, report how long it
+    took.
+    """
+    if path is None:
+        path = default_path(savfile)
+    t0 = time.time()
+    stamp = source_stamp([savfile])
+    bgps, mapstr, needed_once_struct = read_sav(savfile)
+    metadata = sav_metadata(bgps, mapstr, needed_once_struct)
+    metadata['source_stamp'] = stamp
+    ncscans, scanlen, whscan, whempty = scan_layout(metadata['scans_info'])
+    shape = [ncscans.shape[0], scanlen, len(metadata['bolo_indices'])]
+
+    timestreams = {}
+    for name in timestream_names:
+        if needed_once_struct is not None and name in ('raw', 'dc_bolos'):
+            timestreams[name] = needed_once_struct[name][0]
+        elif name in bgps.dtype.names:
+            timestreams[name] = bgps[name][0]
+    timestreams['ts'] = mapstr['ts'][0]
+    write_store(path, metadata, timestreams, whscan, whempty, shape)
+    if verbose:
+        print "Converted %s to a timestream store in %s in %0.1f seconds" % (savfile, path, time.time()-t0)
+    return path
+
+def fits_to_store(tsfilename, tstomapfilename, path=None):
+    """
+    Convert a '_timestream00.fits' file and its '_tstomap.fits' pointing
+    (both [nscans, scanlen, nbolos]) to a store with the timestreams 'data'
+    and 'ts', copying one scan at a time from the memory-mapped FITS files
+    """
+    try:
+        import astropy.io.fits as pyfits
+    except ImportError:
+        import pyfits
+    if path is None:
+        path = default_path(tsfilename)
+    stamp = source_stamp([tsfilename, tstomapfilename])
+    data = pyfits.getdata(tsfilename, memmap=True)
+    tstomap = pyfits.getdata(tstomapfilename, memmap=True)
+    nscans, scanlen = data.shape[:2]
+    # the FITS cubes are already in the scan layout
+    whscan = numpy.arange(nscans*scanlen)
+    whempty = numpy.array([], dtype='int')
+    write_store(path, {'source': numpy.array(tsfilename),
+                       'source_stamp': stamp},
+            {'data': data.reshape(nscans*scanlen, -1),
+             'ts': tstomap.reshape(nscans*scanlen, -1)},
+            whscan, whempty, data.shape)
+    return path
+
+class TimestreamStore(object):
+    """
+    A store written by `sav_to_store` or `fits_to_store`.
+
+    Parameters
+    ----------
+    path: str
+        The store directory
+    mmap_mode: str
+        How the timestreams are memory-mapped (see `numpy.load`).  The
+        default, 'c' (copy-on-write), lets them be modified in memory (e.g.
+        flags) without changing the files.
+    """
+    def __init__(self, path, mmap_mode='c'):
+        if not is_store(path):
+            raise IOError("%s is not a timestream store" % path)
+        self.path = path
+        self.mmap_mode = mmap_mode
+        metadata = numpy.load(os.path.join(path, 'metadata.npz'))
+        self.metadata = dict((key, metadata[key]) for key in metadata.files)
+        metadata.close()
+        self.variables = sorted(fn[:-4] for fn in os.listdir(path)
+                if fn.endswith('.npy'))
+        self._arrays = {}
+
+    def __contains__(self, name):
+        return name in self.variables
+
+    def __getitem__(self, name):
+        """ The memory-mapped [nscans, scanlen, nbolos] timestream """
+        if name not in self._arrays:
+            if name not in self:
+                raise KeyError("No timestream %s in %s" % (name, self.path))
+            self._arrays[name] = numpy.load(os.path.join(self.path,
+                name+'.npy'), mmap_mode=self.mmap_mode)
+        return self._arrays[name]
+
+    def scan(self, name, scannum):
+        """ A view of one scan of a timestream """
+        return self[name][scannum]
+
+def open_store(filename, path=None):
+    """
+    Open the store of a save file (or of a '_timestream00.fits' file, whose
+    '_tstomap.fits' file must be next to it), converting it first if it has
+    not been yet, or if the file has changed since
+    """
+    if path is None:
+        path = default_path(filename)
+    if filename.endswith('.sav'):
+        if not is_store(path, [filename]):
+            sav_to_store(filename, path)
+    else:
+        tstomapfilename = filename.replace('_timestream00.fits', '_tstomap.fits')
+        if not is_store(path, [filename, tstomapfilename]):
+            fits_to_store(filename, tstomapfilename, path)
+    return TimestreamStore(path)
@@ -1 +1 @@
-from parallel_map import parallel_map
+from parallel_map import parallel_map,parallel_map_array,ParallelPool
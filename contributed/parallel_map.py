@@ -4,6 +4,11 @@ Parellel Map snippet by Brian Refsdal
 http://www.astropython.org/snippet/2010/3/Parallel-map-using-multiprocessing
 """
 import numpy
+import os
+import signal
+import sys
+import tempfile
+import traceback
 _multi=False
 _ncpus=1
 
@@ -18,8 +23,7 @@ except:
   pass
 
 
-__all__ = ('parallel_map',)
-
+__all__ = ('parallel_map', 'parallel_map_array', 'ParallelPool')
 
 def worker(f, ii, chunk, out_q, err_q, lock):
   """
@@ -41,7 +45,7 @@ def worker(f, ii, chunk, out_q, err_q, lock):
     try:
       result = f(val)
     except Exception, e:
-      err_q.put(e)
+      err_q.put(_picklable_error(e))
       return
 
     vals.append(result)
@@ -50,44 +54,65 @@ def worker(f, ii, chunk, out_q, err_q, lock):
   out_q.put( (ii, vals) )
 
 
-def run_tasks(procs, err_q, out_q, num):
+def run_tasks(procs, err_q, out_q, num, progress=None, total=None):
   """
   A function that executes populated processes and processes
   the resultant array. Checks error queue for any exceptions.
 
+  Results are read from `out_q` as they arrive, while the processes are
+  still running: a process can't exit until its output has been consumed,
+  so waiting for all of them to join first could deadlock.
+
   :param procs: list of Process objects
   :param out_q: thread-safe output queue
   :param err_q: thread-safe queue to populate on exception
   :param num : length of resultant array
+  :param progress: optional callable, called as progress(ndone, total)
+    each time a process returns its results
+  :param total: number of elements in the input sequence
 
   """
+  import Queue
+
   # function to terminate processes that are still running.
   die = (lambda vals : [val.terminate() for val in vals
              if val.exitcode is None])
 
+  # Processes finish in arbitrary order. Process IDs double
+  # as index in the resultant array.
+  results=[None]*num;
+  ndone = 0
   try:
     for proc in procs:
       proc.start()
 
+    nreceived = 0
+    while nreceived < num:
+      if not err_q.empty():
+        # kill all on any exception from any one slave
+        die(procs)
+        raise err_q.get()
+      try:
+        idx, result = out_q.get(timeout=0.1)
+      except Queue.Empty:
+        if (not any(proc.is_alive() for proc in procs) and out_q.empty()
+            and err_q.empty()):
+          raise RuntimeError("parallel_map worker processes exited "
+                             "without returning their results")
+        continue
+      results[idx] = result
+      nreceived += 1
+      ndone += len(result)
+      if progress is not None:
+        progress(ndone, total)
+
     for proc in procs:
       proc.join()
 
-  except Exception, e:
-    # kill all slave processes on ctrl-C
+  except BaseException:
+    # kill all slave processes on ctrl-C or any error
     die(procs)
-    raise e
-
-  if not err_q.empty():
-    # kill all on any exception from any one slave
-    die(procs)
-    raise err_q.get()
-
-  # Processes finish in arbitrary order. Process IDs double
-  # as index in the resultant array.
-  results=[None]*num;
-  while not out_q.empty():
-    idx, result = out_q.get()
-    results[idx] = result
+    raise
 
   try:
       # Remove extra dimension added by array_split
@@ -96,17 +121,43 @@ def run_tasks(procs, err_q, out_q, num):
       return results
 
 
-def parallel_map(function, sequence, numcores=None):
+def _is_picklable(obj):
+  import cPickle
+  try:
+    cPickle.dumps(obj, -1)
+    return True
+  except Exception:
+    return False
+
+
+def parallel_map(function, sequence, numcores=None, pool=None,
+                 chunksize=None, progress=None):
   """
   A parallelized version of the native Python map function that
   utilizes the Python multiprocessing module to divide and 
   conquer sequence.
 
+  Picklable functions (module-level functions, or functools.partial of
+  them) run on a persistent `ParallelPool`, which is reused by later calls
+  and hands out work in small chunks so that uneven tasks (e.g. fits that
+  converge at different rates) are balanced across the workers; its
+  workers are restarted when `function` is from `__main__` and was defined
+  after they were started.  Other callables (lambdas, closures) are run by
+  processes forked for this call, each taking an equal share of `sequence`.
+
+  An exception raised by `function` cancels the remaining work and is
+  re-raised here; so is ctrl-C, after killing the workers.
+
   parallel_map does not yet support multiple argument sequences.
 
   :param function: callable function that accepts argument from iterable
   :param sequence: iterable sequence 
   :param numcores: number of cores to use
+  :param pool: the `ParallelPool` to use; defaults to a module-wide pool
+    with `numcores` workers that is kept alive between calls
+  :param chunksize: number of elements per pool task (see `ParallelPool.map`)
+  :param progress: optional callable, called as progress(ndone, ntotal) as
+    results come in
   """
   if not callable(function):
     raise TypeError("input function '%s' is not callable" %
@@ -119,11 +170,22 @@ def parallel_map(function, sequence, numcores=None):
   size = len(sequence)
 
   if not _multi or size == 1:
-    return map(function, sequence)
+    results = []
+    for val in sequence:
+      results.append(function(val))
+      if progress is not None:
+        progress(len(results), size)
+    return results
 
   if numcores is None:
     numcores = _ncpus
 
+  if pool is not None or _is_picklable(function):
+    if pool is None:
+      pool = get_pool(numcores)
+    return pool.map(function, sequence, chunksize=chunksize,
+                    progress=progress)
+
   # Returns a started SyncManager object which can be used for sharing 
   # objects between processes. The returned manager object corresponds
   # to a spawned child process and has methods which will create shared
@@ -149,7 +211,522 @@ def parallel_map(function, sequence, numcores=None):
            args=(function, ii, chunk, out_q, err_q, lock))
          for ii, chunk in enumerate(sequence)]
 
-  return run_tasks(procs, err_q, out_q, numcores)
+  try:
+    return run_tasks(procs, err_q, out_q, numcores, progress=progress,
+                     total=size)
+  finally:
+    manager.shutdown()
+
+
+# shared buffers are plain files, so put them in RAM if we can
+_shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+class SharedArray(object):
+  """
+  A numpy array backed by a file in shared memory (/dev/shm where it
+  exists).  Only the file name, shape and dtype are sent to other processes,
+  which map the same memory; nothing is pickled or copied.
+  """
+
+  def __init__(self, shape, dtype, filename=None):
+    self.shape = tuple(shape)
+    self.dtype = numpy.dtype(dtype)
+    self.owner = filename is None
+    if self.owner:
+      fd, filename = tempfile.mkstemp(prefix='parallel_map_', dir=_shm_dir)
+      os.close(fd)
+    self.filename = filename
+    nbytes = max(int(numpy.prod(self.shape)) * self.dtype.itemsize, 1)
+    if self.owner:
+      with open(filename, 'r+b') as fh:
+        fh.truncate(nbytes)
+    self.array = numpy.memmap(filename, dtype=self.dtype, mode='r+',
+                              shape=self.shape)
+
+  @classmethod
+  def from_array(cls, array):
+    shared = cls(array.shape, array.dtype)
+    shared.array[...] = array
+    return shared
+
+  @property
+  def info(self):
+    """ (filename, shape, dtype): enough to re-open the buffer elsewhere """
+    return (self.filename, self.shape, self.dtype.str)
+
+  def unlink(self):
+    """
+    Remove the file.  The memory stays valid for as long as this process
+    (or any other) still has it mapped.
+    """
+    if self.owner and os.path.exists(self.filename):
+      os.remove(self.filename)
+
+
+def _open_shared(info, mode):
+  filename, shape, dtype = info
+  return numpy.memmap(filename, dtype=dtype, mode=mode, shape=shape)
+
+
+def pool_worker(task_q, result_q):
+  """
+  Loop of a `ParallelPool` worker process: take a task from `task_q`, run
+  it, and report (task ID, values, error or None) to `result_q`.  A None
+  task stops the worker.
+
+  Tasks arrive pickled, as (kind, function, payload), so that a function
+  that can't be unpickled here is reported like any other error (wrapped in
+  `_UnpicklableTask`, so the pool can start fresh workers and retry).  'items'
+  tasks map the function over a list and return the list of results.
+  'array' tasks map the function over rows [start, stop) of a shared input
+  buffer and write the results straight into a shared output buffer.
+  """
+  import cPickle
+  # let the parent deal with ctrl-C
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  while True:
+    task = task_q.get()
+    if task is None:
+      break
+    taskid, pickled = task
+    try:
+      kind, function, payload = cPickle.loads(pickled)
+    except (AttributeError, ImportError), e:
+      # e.g. a function defined in __main__ after this worker was forked
+      result_q.put((taskid, None, _UnpicklableTask(_picklable_error(e))))
+      continue
+    try:
+      if kind == 'items':
+        values = [function(item) for item in payload]
+      else:
+        ininfo, outinfo, start, stop = payload
+        inarr = _open_shared(ininfo, 'r')
+        outarr = _open_shared(outinfo, 'r+')
+        for ii in xrange(start, stop):
+          outarr[ii] = function(inarr[ii])
+        del inarr, outarr
+        values = None
+      result_q.put((taskid, values, None))
+    except Exception, e:
+      result_q.put((taskid, None, _picklable_error(e)))
+
+
+class _UnpicklableTask(Exception):
+  """ A worker could not unpickle a task; args[0] is the error """
+
+
+def _picklable_error(e):
+  """ The exception if it can be pickled, otherwise a summary of it """
+  import pickle
+  tb = traceback.format_exc()
+  try:
+    pickle.dumps(e)
+    e.remote_traceback = tb
+    return e
+  except Exception:
+    return RuntimeError("%s: %s\n%s" % (type(e).__name__, e, tb))
+
+
+class ParallelPool(object):
+  """
+  A persistent pool of worker processes.  The workers are started once and
+  reused by every call, so repeated maps (e.g. over the planes of many
+  cubes) don't pay for process start-up each time.
+
+  `imap` streams the results of mapping a function over any sequence, in
+  order, as they are computed; `map` returns them as a list.  `map_array`
+  is for NumPy arrays: inputs and outputs live in shared-memory buffers
+  (`SharedArray`), so each task sent to a worker is just the function, the
+  buffer names, and a range of rows, and array elements are never pickled.
+
+  Workers pull tasks from a common queue, which balances uneven work
+  automatically.
+
+  The workers are forked when the pool starts, so they only know the
+  functions that existed then.  A function defined (or redefined) in
+  `__main__` since is handled by restarting the workers before the call,
+  and a task that a worker can't unpickle (e.g. a partial of such a
+  function) by restarting them and resubmitting the outstanding tasks once.
+  Call `restart` after changing other module state the workers rely on.  If the function raises, or ctrl-C is pressed, the rest of
+  the call is cancelled and the exception is raised in the caller; the pool
+  stays usable (on ctrl-C the workers are restarted, since they may be stuck
+  in a long task).
+
+  The function must be picklable (a module-level function, or a
+  functools.partial of one); lambdas are not.
+
+  >>> pool = ParallelPool(numcores=4)
+  >>> smoothed = pool.map_array(my_function, cube)
+  >>> for fit in pool.imap(fit_spectrum, spectra, progress=report):
+  ...     save(fit)
+  >>> pool.close()
+  """
+
+  def __init__(self, numcores=None):
+    if numcores is None:
+      numcores = _ncpus
+    self.numcores = numcores
+    self._taskid = 0
+    # tasks whose results are no longer wanted (cancelled calls)
+    self._abandoned = set()
+    self._start()
+
+  def _start(self):
+    self.procs = []
+    self._abandoned = set()
+    # task ID -> (pickled task, already retried), until its result arrives
+    self._outstanding = {}
+    # the __main__ functions the workers will know about
+    main = sys.modules.get('__main__')
+    self._main_functions = dict((name, value) for name, value in
+                                vars(main).items() if callable(value)) \
+                           if main is not None else {}
+    if _multi and self.numcores > 1:
+      self.task_q = multiprocessing.Queue()
+      self.result_q = multiprocessing.Queue()
+      self.procs = [multiprocessing.Process(target=pool_worker,
+                                            args=(self.task_q, self.result_q))
+                    for ii in xrange(self.numcores)]
+      for proc in self.procs:
+        proc.daemon = True
+        proc.start()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  @property
+  def alive(self):
+    return bool(self.procs) and all(proc.is_alive() for proc in self.procs)
+
+  def close(self):
+    """ Stop the worker processes """
+    for proc in self.procs:
+      if proc.is_alive():
+        self.task_q.put(None)
+    for proc in self.procs:
+      proc.join(1)
+      if proc.is_alive():
+        proc.terminate()
+    self.procs = []
+
+  def terminate(self):
+    """ Kill the worker processes without waiting for running tasks """
+    for proc in self.procs:
+      proc.terminate()
+    self.procs = []
+    self._outstanding = {}
+
+  def restart(self):
+    """
+    Start new worker processes (which see the current state of every
+    module), resubmitting the tasks that are still outstanding
+    """
+    outstanding = [(taskid, pickled) for taskid, (pickled, retried)
+                   in sorted(self._outstanding.items())
+                   if taskid not in self._abandoned]
+    self.terminate()
+    self._start()
+    for taskid, pickled in outstanding:
+      self._outstanding[taskid] = (pickled, True)
+      self.task_q.put((taskid, pickled))
+
+  def _refresh(self, function):
+    """
+    Restart the workers if `function` (or the function of a partial) is
+    from `__main__` but is not what they know under its name
+    """
+    function = getattr(function, 'func', function)
+    name = getattr(function, '__name__', None)
+    if (self.procs and getattr(function, '__module__', None) == '__main__'
+        and self._main_functions.get(name) is not function):
+      self.restart()
+
+  def _submit(self, kind, function, payload):
+    """ Queue a task; return its ID """
+    import cPickle
+    # pickle here, so that errors are raised in the caller rather than
+    # lost in the queue's feeder thread
+    pickled = cPickle.dumps((kind, function, payload), -1)
+    self._taskid += 1
+    self._outstanding[self._taskid] = (pickled, False)
+    self.task_q.put((self._taskid, pickled))
+    return self._taskid
+
+  def _get_result(self):
+    """
+    Wait for the next (task ID, values, error) from the workers, skipping
+    results of cancelled tasks.  The first time a task can't be unpickled
+    by a worker, the workers are restarted and the task is retried.
+    """
+    import Queue
+    while True:
+      try:
+        taskid, values, error = self.result_q.get(timeout=0.5)
+      except Queue.Empty:
+        if not self.alive:
+          # a worker was killed (e.g. out of memory) mid-task
+          self.terminate()
+          self._start()
+          raise RuntimeError("A ParallelPool worker process died; the "
+                             "pool has been restarted")
+        continue
+      task = self._outstanding.pop(taskid, None)
+      if taskid in self._abandoned:
+        self._abandoned.discard(taskid)
+        continue
+      if isinstance(error, _UnpicklableTask):
+        if task is not None and not task[1]:
+          self._outstanding[taskid] = task
+          self.restart()
+          continue
+        error = error.args[0]
+      return taskid, values, error
+
+  def _cancel(self, taskids):
+    """
+    Cancel outstanding tasks: queued ones are removed, and results of those
+    already running are ignored when they arrive
+    """
+    removed = self._drain()
+    for taskid in removed:
+      self._outstanding.pop(taskid, None)
+    self._abandoned |= (set(taskids) - removed)
+
+  def imap(self, function, sequence, chunksize=1, progress=None):
+    """
+    Map `function` over `sequence` in parallel, yielding the results in
+    order as soon as they (and all those before them) are ready.
+
+    Only a few tasks per worker are queued at a time and new ones are
+    handed out as workers become free, so `sequence` may be a long or lazy
+    iterable and slow elements don't hold up the others.
+
+    Leaving the loop early (``break``, or an exception in the caller)
+    cancels the remaining work.
+
+    :param function: picklable callable
+    :param sequence: iterable of picklable elements
+    :param chunksize: number of elements sent to a worker at once; raise it
+      when each call is very quick, to cut down on communication
+    :param progress: optional callable, called as progress(ndone, ntotal)
+      each time a task finishes; ntotal is None if `sequence` has no len
+    """
+    try:
+      total = len(sequence)
+    except TypeError:
+      total = None
+
+    if not self.procs:
+      ndone = 0
+      for item in sequence:
+        result = function(item)
+        ndone += 1
+        if progress is not None:
+          progress(ndone, total)
+        yield result
+      return
+
+    if not self.alive:
+      raise RuntimeError("The pool has been closed")
+    self._refresh(function)
+
+    chunksize = max(1, int(chunksize))
+    items = iter(sequence)
+    # task ID -> position of its chunk; chunk position -> results
+    pending = {}
+    finished = {}
+    nsent = nyielded = ndone = 0
+    exhausted = False
+    try:
+      while True:
+        # keep every worker busy, with a couple of tasks in reserve
+        while not exhausted and len(pending) < 2*self.numcores:
+          chunk = []
+          for item in items:
+            chunk.append(item)
+            if len(chunk) == chunksize:
+              break
+          if len(chunk) < chunksize:
+            exhausted = True
+          if chunk:
+            pending[self._submit('items', function, chunk)] = nsent
+            nsent += 1
+
+        while nyielded in finished:
+          for result in finished.pop(nyielded):
+            yield result
+          nyielded += 1
+
+        if not pending:
+          break
+
+        taskid, values, error = self._get_result()
+        if taskid not in pending:
+          continue
+        position = pending.pop(taskid)
+        if error is not None:
+          raise error
+        finished[position] = values
+        ndone += len(values)
+        if progress is not None:
+          progress(ndone, total)
+    except KeyboardInterrupt:
+      # the workers may be stuck in a long task: restart them
+      self.terminate()
+      self._start()
+      pending = {}
+      raise
+    finally:
+      if pending:
+        self._cancel(pending)
+
+  def map(self, function, sequence, chunksize=None, progress=None):
+    """
+    Return ``map(function, sequence)``, computed in parallel; see `imap`.
+
+    :param chunksize: number of elements per task.  Defaults to giving each
+      worker about four tasks, so that uneven tasks even out.
+    """
+    if chunksize is None:
+      chunksize = max(1, len(sequence) // (4*self.numcores))
+    return list(self.imap(function, sequence, chunksize=chunksize,
+                          progress=progress))
+
+  def map_array(self, function, array, chunksize=None, progress=None):
+    """
+    Return ``numpy.array(map(function, array))``, computed in parallel.
+
+    `function` is applied to each element of `array` along its first axis
+    and must return arrays (or scalars) of the same shape and dtype every
+    time; the first element is computed here to find them out.  Results are
+    returned in order, in a single array.
+
+    :param function: picklable callable
+    :param array: the input array (copied once into shared memory unless it
+      is already a `SharedArray`)
+    :param chunksize: number of elements per task.  Defaults to giving each
+      worker about four tasks, so that uneven tasks even out.
+    :param progress: optional callable, called as progress(ndone, ntotal)
+      each time a task finishes
+    """
+    if isinstance(array, SharedArray):
+      inbuf = array
+    else:
+      inbuf = None
+      array = numpy.asarray(array)
+    inarray = array.array if inbuf is not None else array
+    size = len(inarray)
+    if size == 0:
+      return numpy.array([])
+
+    first = numpy.asarray(function(inarray[0]))
+
+    if not self.procs or size == 1:
+      results = numpy.empty((size,) + first.shape, dtype=first.dtype)
+      results[0] = first
+      for ii in xrange(1, size):
+        results[ii] = function(inarray[ii])
+        if progress is not None:
+          progress(ii+1, size)
+      return results
+
+    if not self.alive:
+      raise RuntimeError("The pool has been closed")
+    self._refresh(function)
+
+    if inbuf is None:
+      inbuf = SharedArray.from_array(inarray)
+    outbuf = SharedArray((size,) + first.shape, first.dtype)
+    taskids = {}
+    try:
+      outbuf.array[0] = first
+
+      if chunksize is None:
+        chunksize = max(1, (size-1) // (4*self.numcores))
+      for start in xrange(1, size, chunksize):
+        stop = min(start+chunksize, size)
+        taskid = self._submit('array', function,
+                              (inbuf.info, outbuf.info, start, stop))
+        taskids[taskid] = stop - start
+
+      ndone = 1
+      while taskids:
+        taskid, values, error = self._get_result()
+        if taskid not in taskids:
+          continue
+        ndone += taskids.pop(taskid)
+        if error is not None:
+          raise error
+        if progress is not None:
+          progress(ndone, size)
+
+      # the memory stays mapped here after the file is removed
+      return outbuf.array.view(numpy.ndarray)
+    except KeyboardInterrupt:
+      self.terminate()
+      self._start()
+      taskids = {}
+      raise
+    finally:
+      if taskids:
+        self._cancel(taskids)
+      outbuf.unlink()
+      if not isinstance(array, SharedArray):
+        inbuf.unlink()
+
+  def _drain(self):
+    """ Remove queued tasks; return their IDs """
+    import Queue
+    removed = set()
+    while True:
+      try:
+        task = self.task_q.get_nowait()
+      except Queue.Empty:
+        return removed
+      if task is None:
+        # keep shutdown requests
+        self.task_q.put(None)
+        return removed
+      removed.add(task[0])
+
+
+_default_pool = None
+
+def get_pool(numcores=None):
+  """
+  Return the shared, persistent `ParallelPool`, (re)starting it if it does
+  not exist yet, has died, or has a different number of cores
+  """
+  global _default_pool
+  if numcores is None:
+    numcores = _ncpus
+  if (_default_pool is None or _default_pool.numcores != numcores or
+      (numcores > 1 and _multi and not _default_pool.alive)):
+    if _default_pool is not None:
+      _default_pool.close()
+    _default_pool = ParallelPool(numcores)
+  return _default_pool
+
+
+def parallel_map_array(function, array, numcores=None, chunksize=None,
+                       pool=None, progress=None):
+  """
+  Like `parallel_map`, but for NumPy arrays: map `function` over the first
+  axis of `array` using shared-memory buffers and a persistent worker pool,
+  and return the results stacked in one array.  See
+  `ParallelPool.map_array`.
+
+  :param pool: a `ParallelPool` to use; defaults to a module-wide pool with
+    `numcores` workers that is kept alive between calls
+  """
+  if pool is None:
+    pool = get_pool(numcores)
+  return pool.map_array(function, array, chunksize=chunksize,
+                        progress=progress)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,37 @@
+"""
+convolvend must not modify its inputs: read-only arrays are accepted, and
+NaNs in the image or kernel are only zeroed in its own copies.
+"""
+import numpy as np
+from AG_fft_tools.convolve_nd import convolvend
+
+def test_readonly_inputs():
+    image = np.random.randn(20,30)
+    kernel = np.ones([3,3])/9.
+    expected = convolvend(image.copy(), kernel.copy())
+    for arr in (image, kernel):
+        arr.flags.writeable = False
+    for use_rfft in (True, False):
+        result = convolvend(image, kernel, use_rfft=use_rfft)
+        assert np.abs(result - expected).max() < 1e-12
+
+def test_nan_inputs_unchanged():
+    image = np.random.randn(20,30)
+    image[5,7] = np.nan
+    kernel = np.ones([3,3])
+    kernel[0,0] = np.nan
+    image_copy, kernel_copy = image.copy(), kernel.copy()
+    for kwargs in ({'normalize_kernel':True}, {'normalize_kernel':True,
+            'interpolate_nan':True}, {'boundary':'wrap'}):
+        convolvend(image, kernel, quiet=True, **kwargs)
+        assert np.array_equal(np.isnan(image), np.isnan(image_copy))
+        assert np.array_equal(np.isnan(kernel), np.isnan(kernel_copy))
+        assert np.all(image[image==image] == image_copy[image_copy==image_copy])
+        assert np.all(kernel[kernel==kernel] == kernel_copy[kernel_copy==kernel_copy])
+
+def test_nan_readonly():
+    image = np.random.randn(20,30)
+    image[5,7] = np.nan
+    image.flags.writeable = False
+    result = convolvend(image, np.ones([3,3])/9., interpolate_nan=True)
+    assert np.isfinite(result).all()
@@ -0,0 +1,49 @@
+"""
+convolve_tiled should match convolvend(psf_pad=True) for in-memory and
+memory-mapped inputs and outputs, whatever the tiling.
+"""
+import os
+import shutil
+import tempfile
+import numpy as np
+from AG_fft_tools.convolve_nd import convolvend
+from AG_fft_tools.convolve_tiled import convolve_tiled
+
+def make_image():
+    image = np.random.randn(70,53)
+    image[10:13,40] = np.nan
+    return image
+
+def test_tiled_matches_convolvend():
+    image = make_image()
+    kernel = np.random.rand(9,7)
+    kernel /= kernel.sum()
+    for kwargs in ({}, {'interpolate_nan':True}, {'ignore_edge_zeros':True},
+            {'interpolate_nan':True, 'ignore_edge_zeros':True, 'min_wt':0.5}):
+        expected = convolvend(image, kernel, psf_pad=True, quiet=True, **kwargs)
+        for tilesize in (16, (32,20), 200):
+            result = convolve_tiled(image, kernel, tilesize=tilesize,
+                    quiet=True, **kwargs)
+            both = np.isfinite(expected)
+            assert np.array_equal(both, np.isfinite(result))
+            assert np.abs(result[both] - expected[both]).max() < 1e-10
+
+def test_tiled_memmap():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        image = make_image()
+        kernel = np.ones([5,5])/25.
+        infile = os.path.join(tmpdir, 'image.npy')
+        np.save(infile, image)
+        mapped = np.load(infile, mmap_mode='r')
+        outfile = os.path.join(tmpdir, 'smoothed.npy')
+        expected = convolvend(image, kernel, psf_pad=True,
+                interpolate_nan=True)
+        for numcores in (1,2):
+            convolve_tiled(mapped, kernel, output=outfile, tilesize=24,
+                    interpolate_nan=True, numcores=numcores)
+            assert np.abs(np.load(outfile) - expected).max() < 1e-10
+        # the input file is untouched
+        assert np.array_equal(np.isnan(np.load(infile)), np.isnan(image))
+    finally:
+        shutil.rmtree(tmpdir)
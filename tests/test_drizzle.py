@@ -0,0 +1,72 @@
+"""
+PointingMatrix should reproduce drizzle, including with flags, several
+threads, and incremental updates
+"""
+import numpy as np
+from AG_image_tools.drizzle import drizzle, PointingMatrix
+
+mapshape = (20,30)
+
+def make_data():
+    tstomap = np.random.randint(0, 20*25, (3,50,12))
+    ts = np.random.randn(*tstomap.shape)
+    ts[0,3,4] = np.nan
+    weights = np.random.rand(*tstomap.shape)
+    flags = np.random.rand(*tstomap.shape) < 0.1
+    return tstomap, ts, weights, flags
+
+def same(a, b):
+    return (np.array_equal(np.isnan(a), np.isnan(b)) and
+            np.nanmax(np.abs(a-b)) < 1e-12)
+
+def test_pointing_matrix():
+    tstomap, ts, weights, flags = make_data()
+    expected = drizzle(tstomap, ts, mapshape, weights*~flags)
+    for nthreads in (1,3):
+        pointing = PointingMatrix(tstomap, mapshape, nthreads=nthreads)
+        assert same(pointing.drizzle(ts, weights, flags=flags), expected)
+        model = np.random.randn(*mapshape)
+        assert np.all(pointing.totimestream(model) == model.flat[tstomap])
+
+def test_masked():
+    tstomap, ts, weights, flags = make_data()
+    mts = np.ma.masked_where(flags, ts)
+    pointing = PointingMatrix(tstomap, mapshape)
+    assert same(pointing.drizzle(mts), drizzle(tstomap, mts, mapshape))
+
+def test_incremental():
+    tstomap, ts, weights, flags = make_data()
+    pointing = PointingMatrix(tstomap, mapshape)
+    summap, weightmap = pointing.sums(ts, weights, flags=flags)
+    box = np.zeros(flags.shape, dtype='bool')
+    box[1,10:30,2:8] = True
+    pointing.add(summap, weightmap, ts, weights, samples=box & ~flags,
+            sign=-1)
+    assert same(summap/weightmap,
+            pointing.drizzle(ts, weights, flags=flags|box))
+    unflag = np.flatnonzero(flags & ~box)
+    pointing.add(summap, weightmap, ts, weights, samples=unflag)
+    assert same(summap/weightmap, pointing.drizzle(ts, weights, flags=box))
+
+def test_masked_weights():
+    tstomap, ts, weights, flags = make_data()
+    mweights = np.ma.masked_where(flags, weights)
+    mts = np.ma.masked_where(np.random.rand(*ts.shape) < 0.1, ts)
+    # masked weights, or masked samples, are left out like flagged ones
+    expected = drizzle(tstomap, ts, mapshape, weights*~flags)
+    assert same(drizzle(tstomap, ts, mapshape, mweights), expected)
+    expected = drizzle(tstomap, ts, mapshape, weights*~mts.mask)
+    assert same(drizzle(tstomap, mts, mapshape, weights), expected)
+    assert same(drizzle(tstomap, mts, mapshape),
+            drizzle(tstomap, ts, mapshape, (~mts.mask).astype('float')))
+    expected = drizzle(tstomap, ts, mapshape, weights*~(flags|mts.mask))
+    assert same(drizzle(tstomap, mts, mapshape, mweights), expected)
+    # the caller's weights are untouched
+    assert np.array_equal(mweights.data, weights)
+    # and incremental updates agree
+    pointing = PointingMatrix(tstomap, mapshape)
+    summap, weightmap = pointing.sums(mts, mweights)
+    box = np.zeros(flags.shape, dtype='bool')
+    box[2,5:20] = True
+    pointing.add(summap, weightmap, mts, mweights, samples=box, sign=-1)
+    assert same(summap/weightmap, pointing.drizzle(mts, mweights, flags=box))
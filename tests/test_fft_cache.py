@@ -0,0 +1,56 @@
+"""
+convolvend's kernel FFT / weight / workspace caches (use_fft_cache=True)
+should give exactly the results of an uncached convolution, and must not
+reuse the FFT of a kernel that has changed.
+"""
+import numpy as np
+from AG_fft_tools import fast_ffts
+from AG_fft_tools.convolve_nd import convolvend
+
+def uncached(image, kernel, **kwargs):
+    return convolvend(image, kernel, use_fft_cache=False, **kwargs)
+
+def test_repeat_is_identical():
+    fast_ffts.clear_caches()
+    image = np.random.randn(40,50)
+    kernel = np.random.rand(7,7)
+    first = convolvend(image, kernel)
+    assert len(fast_ffts.kernel_cache) > 0
+    first_copy = first.copy()
+    second = convolvend(image, kernel)
+    assert np.all(first == second)
+    # the result is not a view of a reused work array
+    convolvend(np.random.randn(40,50), kernel)
+    assert np.all(first == first_copy)
+    assert np.abs(first - uncached(image, kernel)).max() < 1e-12
+
+def test_changed_kernel_is_not_reused():
+    fast_ffts.clear_caches()
+    image = np.random.randn(40,50)
+    kernel = np.random.rand(7,7)
+    convolvend(image, kernel)
+    # same object and shape, new contents
+    kernel[3,3] += 5
+    assert np.abs(convolvend(image, kernel) - uncached(image, kernel)).max() < 1e-12
+    other = np.random.rand(7,7)
+    assert np.abs(convolvend(image, other) - uncached(image, other)).max() < 1e-12
+
+def test_cached_weights():
+    fast_ffts.clear_caches()
+    kernel = np.ones([5,5])/25.
+    for ii in range(2):
+        image = np.random.randn(30,30)
+        if ii:
+            image[10,12] = np.nan
+        for kwargs in ({'ignore_edge_zeros':True},
+                {'interpolate_nan':True, 'ignore_edge_zeros':True}):
+            assert np.allclose(convolvend(image, kernel, **kwargs),
+                    uncached(image, kernel, **kwargs), atol=1e-12)
+
+if __name__ == "__main__":
+    import timeit
+    image = np.random.randn(512,512)
+    kernel = np.random.rand(31,31)
+    for cache in (False, True):
+        print "use_fft_cache=%s: %0.4f s" % (cache, min(timeit.Timer(
+            lambda: convolvend(image, kernel, use_fft_cache=cache)).repeat(3,5))/5)
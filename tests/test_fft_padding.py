@@ -0,0 +1,69 @@
+"""
+Compare convolvend's per-axis 2,3,5,7-smooth padding (fft_pad=True) with the
+old power-of-two padding (fft_pad='pow2') for image sizes we commonly smooth.
+Reports the padded shape, the padded size in MB (per complex128 array), and
+the best-of-3 runtime of a psf_pad=True convolution with a 31x31 kernel.
+"""
+import timeit
+import numpy as np
+from agpy import convolve
+from AG_fft_tools import fast_ffts
+
+sizes = [(300,300), (512,512), (1100,300), (1000,1000), (1500,700),
+        (2000,2000), (3000,1200)]
+
+def padded_shape(shape, kernshape, fft_pad):
+    if fft_pad == 'pow2':
+        fsize = 2**np.ceil(np.log2(np.max(np.array(shape)+np.array(kernshape))))
+        return tuple(int(fsize) for ii in shape)
+    else:
+        return tuple(fast_ffts.next_fast_len(s+k) for s,k in zip(shape,kernshape))
+
+def test_padding_is_smaller():
+    for shape in sizes:
+        new = padded_shape(shape, (31,31), True)
+        old = padded_shape(shape, (31,31), 'pow2')
+        assert np.prod(new) <= np.prod(old)
+        assert all(n >= s+31 for n,s in zip(new,shape))
+
+def test_padding_results_agree():
+    image = np.random.randn(110,30)
+    kernel = np.random.rand(9,9)
+    new = convolve(image, kernel, normalize_kernel=True, fft_pad=True)
+    old = convolve(image, kernel, normalize_kernel=True, fft_pad='pow2')
+    assert np.abs(new-old).max() < 1e-12
+
+if __name__ == "__main__":
+    kernel = np.ones([31,31])
+    print " ".join(["%12s" % n for n in ("shape","pad","padded","MB","seconds")])
+    for shape in sizes:
+        image = np.random.randn(*shape)
+        for fft_pad in ('pow2',True):
+            newshape = padded_shape(shape, kernel.shape, fft_pad)
+            # don't let the kernel FFT cache hide the cost of the padding
+            fast_ffts.clear_caches()
+            timer = timeit.Timer(lambda: convolve(image, kernel,
+                normalize_kernel=True, fft_pad=fft_pad, psf_pad=True,
+                use_fft_cache=False))
+            print "%12s %12s %12s %12.1f %12.4f" % ("%ix%i" % shape,
+                    fft_pad, "%ix%i" % newshape,
+                    np.prod(newshape)*16/1024.**2, min(timer.repeat(3,1)))
+
+"""
+RESULTS: (numpy 1.16 FFTs, real-input path, one core)
+       shape          pad       padded           MB      seconds
+     300x300         pow2      512x512          4.0       0.0287
+     300x300         True      336x336          1.7       0.0105
+     512x512         pow2    1024x1024         16.0       0.1166
+     512x512         True      560x560          4.8       0.0470
+    1100x300         pow2    2048x2048         64.0       0.5885
+    1100x300         True     1134x336          5.8       0.0564
+   1000x1000         pow2    2048x2048         64.0       0.5988
+   1000x1000         True    1050x1050         16.8       0.1819
+    1500x700         pow2    2048x2048         64.0       0.5916
+    1500x700         True     1536x735         17.2       0.1866
+   2000x2000         pow2    2048x2048         64.0       0.6197
+   2000x2000         True    2048x2048         64.0       0.5536
+   3000x1200         pow2    4096x4096        256.0       2.4551
+   3000x1200         True    3072x1250         58.6       0.4552
+"""
@@ -0,0 +1,86 @@
+"""
+Flagger.compute_map updates the map incrementally as samples are flagged,
+unflagged, masked or unmasked; after any sequence of those the map should be
+the same as a full drizzle of the unflagged, unmasked samples.  Changing a
+timestream's values in place needs invalidate_map.
+"""
+import types
+import numpy as np
+from agpy import pyflagger
+from AG_image_tools.drizzle import drizzle
+
+mapshape = (20,30)
+
+def make_flagger(seed=0):
+    random = np.random.RandomState(seed)
+    # a bare Flagger with only what compute_map uses (no files or plots)
+    flagger = types.InstanceType(pyflagger.Flagger)
+    shape = (3,50,12)
+    flagger.tstomap = random.randint(0, 20*25, shape)
+    flagger.map = np.zeros(mapshape)
+    flagger.flags = np.zeros(shape, dtype='int')
+    flagger.flags[0,:5] = 1
+    data = random.randn(*shape)
+    data[1,3,4] = np.nan
+    flagger.mapped_timestream = np.ma.masked_array(data,
+            mask=flagger.flags > 0)
+    flagger.weight = np.ma.masked_array(random.rand(*shape),
+            mask=random.rand(*shape) < 0.05)
+    flagger.tsplot_dict = {}
+    flagger.pointing = None
+    flagger.invalidate_map()
+    return flagger
+
+def full_map(flagger):
+    ts, weight = flagger.mapped_timestream, flagger.weight
+    use = (flagger.flags == 0) & ~np.ma.getmaskarray(ts) & \
+            ~np.ma.getmaskarray(weight)
+    return drizzle(flagger.tstomap, ts.data, mapshape, weight.data*use)
+
+def same(a, b):
+    return (np.array_equal(np.isnan(a), np.isnan(b)) and
+            np.nanmax(np.abs(a-b)) < 1e-12)
+
+def test_flag_sequence():
+    flagger = make_flagger()
+    flagger.compute_map(showmap=False)
+    state = flagger._mapstate
+    assert same(flagger.map, full_map(flagger))
+    def flag(index, change):
+        flagger.flags[index] += change
+        flagger.compute_map(showmap=False)
+        assert flagger._mapstate is state
+        assert same(flagger.map, full_map(flagger))
+    flag((1,slice(10,30),slice(2,8)), 1)        # box
+    flag((slice(None),slice(None),5), 1)        # bolometer
+    flag((1,slice(20,25),slice(2,8)), 1)        # flagged twice
+    flag((1,slice(10,30),slice(2,8)), -1)       # partly unflagged
+    flag((slice(None),slice(None),5), -1)
+    flag((0,slice(0,5)), -1)                    # unflag, but still masked
+    # unmasking in place is picked up too
+    flagger.mapped_timestream.mask[0,:3] = False
+    flagger.compute_map(showmap=False)
+    assert flagger._mapstate is state
+    assert same(flagger.map, full_map(flagger))
+    flagger.flags[:] = 0
+    flagger.compute_map(showmap=False)
+    assert same(flagger.map, full_map(flagger))
+
+def test_invalidate():
+    flagger = make_flagger()
+    flagger.compute_map(showmap=False)
+    flagger.mapped_timestream[2] *= 2
+    flagger.invalidate_map()
+    flagger.flags[2,:10] = 1
+    flagger.compute_map(showmap=False)
+    assert same(flagger.map, full_map(flagger))
+    # a new timestream or new weights start a new map
+    state = flagger._mapstate
+    flagger.weight = flagger.weight*2
+    flagger.compute_map(showmap=False)
+    assert flagger._mapstate is not state
+    assert same(flagger.map, full_map(flagger))
+    # as does a full=True call
+    state = flagger._mapstate
+    flagger.compute_map(showmap=False, full=True)
+    assert flagger._mapstate is not state
@@ -0,0 +1,28 @@
+"""
+The Flagger uses a timestream store only where it is current or can be
+written; otherwise it reads the save (or FITS) file directly.
+"""
+import os
+import shutil
+import tempfile
+import types
+from agpy import pyflagger, timestream_store
+
+def test_store_path():
+    flagger = types.InstanceType(pyflagger.Flagger)
+    path = tempfile.mkdtemp()
+    try:
+        savfile = os.path.join(path, 'scan.sav')
+        open(savfile, 'w').close()
+        assert flagger._store_path(False, savfile, [savfile]) is None
+        assert flagger._store_path(True, savfile, [savfile]) == \
+                timestream_store.default_path(savfile)
+        other = os.path.join(path, 'other_store')
+        assert flagger._store_path(other, savfile, [savfile]) == other
+        # a store that can't be written falls back to reading the file
+        blocker = os.path.join(path, 'file')
+        open(blocker, 'w').close()
+        assert flagger._store_path(os.path.join(blocker, 'store'), savfile,
+                [savfile]) is None
+    finally:
+        shutil.rmtree(path)
@@ -0,0 +1,114 @@
+"""
+moments_stack and onedmoments_stack should give the same guesses as looping
+moments and onedmoments over the images or spectra, ignoring NaN pixels
+(as the scalar functions do for masked arrays), and NaN guesses wherever
+the scalar functions raise "something is nan".
+"""
+import numpy as np
+from agpy import gaussfitter
+
+def make_stamps(nimages=12, shape=(15,17), seed=0):
+    random = np.random.RandomState(seed)
+    Y, X = np.indices(shape)
+    stamps = []
+    for ii in xrange(nimages):
+        x0, y0 = random.uniform(3,shape[1]-3), random.uniform(3,shape[0]-3)
+        wx, wy = random.uniform(1,3,2)
+        stamps.append(random.uniform(1,10)*np.exp(-(X-x0)**2/(2*wx**2) -
+            (Y-y0)**2/(2*wy**2)) + random.uniform(0,2) +
+            random.randn(*shape)*0.1)
+    return np.array(stamps)
+
+def make_spectra(nspec=30, nchan=50, seed=0):
+    random = np.random.RandomState(seed)
+    xax = np.linspace(-20,30,nchan)
+    amp = random.uniform(-5,5,nspec)
+    cen = random.uniform(-10,20,nspec)
+    wid = random.uniform(1,6,nspec)
+    spectra = amp[:,None]*np.exp(-(xax-cen[:,None])**2/(2*wid[:,None]**2)) + \
+            random.randn(nspec,nchan)*0.3 + random.uniform(-1,1,(nspec,1))
+    return xax, spectra
+
+def loop_moments(stamps, circle, rotate, vheight, **kwargs):
+    result = []
+    for stamp in stamps:
+        try:
+            result.append(gaussfitter.moments(stamp, circle, rotate, vheight,
+                **kwargs))
+        except ValueError:
+            result.append(np.nan)
+    return result
+
+def test_moments_stack():
+    stamps = make_stamps()
+    for circle, rotate, vheight in ((0,1,1), (0,0,1), (1,0,1), (0,1,0),
+            (1,0,0)):
+        expected = np.array(loop_moments(stamps, circle, rotate, vheight))
+        assert np.allclose(gaussfitter.moments_stack(stamps, circle, rotate,
+            vheight), expected, rtol=1e-12)
+        # a cube with the images along its last axis
+        assert np.allclose(gaussfitter.moments_stack(stamps.transpose(1,2,0),
+            circle, rotate, vheight, axis=2), expected, rtol=1e-12)
+    # a single image
+    assert np.allclose(gaussfitter.moments_stack(stamps[0], 0, 1, 1),
+            [gaussfitter.moments(stamps[0], 0, 1, 1)], rtol=1e-12)
+
+def test_moments_stack_nans():
+    stamps = make_stamps()
+    stamps[1,4,5] = np.nan
+    stamps[2,:,0] = np.nan
+    stamps[3,7,:3] = np.nan
+    stamps[4] = 0         # moments raises for an empty image...
+    stamps[5] = np.nan    # ...or an entirely blank one
+    result = gaussfitter.moments_stack(stamps, 0, 1, 1)
+    expected = loop_moments(np.ma.masked_invalid(stamps[:4]), 0, 1, 1,
+            estimator=np.ma.median)
+    assert np.allclose(result[:4], np.array(expected, dtype='float'),
+            rtol=1e-12)
+    assert np.isnan(loop_moments(stamps[4:5], 0, 1, 1)[0])
+    assert np.isnan(result[4:6]).all()
+    assert np.isfinite(result[6:]).all()
+
+def test_onedmoments_stack():
+    xax, spectra = make_spectra()
+    for vheight in (True, False):
+        for negamp in (None, True, False):
+            expected = np.array([gaussfitter.onedmoments(xax, spectrum,
+                vheight=vheight, negamp=negamp) for spectrum in spectra])
+            result = gaussfitter.onedmoments_stack(xax, spectra,
+                    vheight=vheight, negamp=negamp)
+            assert np.allclose(result, expected, rtol=1e-12, atol=1e-12)
+            # a (nchan, ny, nx) cube
+            cube = spectra.T.reshape([len(xax),5,6])
+            result = gaussfitter.onedmoments_stack(xax, cube, axis=0,
+                    vheight=vheight, negamp=negamp)
+            assert result.shape == (5,6,len(expected[0]))
+            assert np.allclose(result.reshape(expected.shape), expected,
+                    rtol=1e-12, atol=1e-12)
+
+def test_onedmoments_stack_nans():
+    xax, spectra = make_spectra()
+    # blanked edge channels are left out, as if the spectrum were shorter
+    spectra[1,:4] = np.nan
+    spectra[2,-7:] = np.nan
+    spectra[3] = np.nan
+    spectra[4] = 0
+    result = gaussfitter.onedmoments_stack(xax, spectra)
+    for ii in (1,2):
+        good = np.isfinite(spectra[ii])
+        assert np.allclose(result[ii], gaussfitter.onedmoments(xax[good],
+            spectra[ii][good]), rtol=1e-12, atol=1e-12)
+    # an interior NaN channel doesn't spoil the guess
+    spectra[5,20] = np.nan
+    assert np.isfinite(gaussfitter.onedmoments_stack(xax, spectra[5])).all()
+    # a blank spectrum gets NaN guesses, as does a flat one, for which
+    # onedmoments raises
+    assert np.isnan(result[3]).all()
+    try:
+        gaussfitter.onedmoments(xax, spectra[4])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("onedmoments should reject a flat spectrum")
+    assert np.isnan(result[4]).all()
+    assert np.isfinite(result[np.arange(len(spectra)) > 4]).all()
@@ -0,0 +1,127 @@
+"""
+mpfit_batch (and onedgaussfit_stack and collapse_gaussfit(method='batch')
+built on it) should reach the same fits as mpfit wherever those are well
+determined, and report NaN errors instead of mpfit's zero errors for
+degenerate fits, so that they are not mistaken for perfectly determined ones.
+"""
+import numpy as np
+from agpy import gaussfitter
+from agpy.mpfit import mpfit_batch
+from test_collapse_gaussfit import make_cube
+
+def make_spectra(nspec=200, nchan=60, seed=0):
+    """ Lines of all strengths and widths (some off the band) on offsets """
+    random = np.random.RandomState(seed)
+    xax = np.arange(float(nchan))
+    amp = random.choice([0,0.5,1,3,10], nspec)
+    cen = random.uniform(-5,nchan+5,nspec)
+    wid = random.uniform(0.3,8,nspec)
+    offset = random.choice([0,0,5], nspec)
+    spectra = amp[:,None]*np.exp(-(xax-cen[:,None])**2/(2*wid[:,None]**2)) + \
+            offset[:,None] + random.randn(nspec,nchan)
+    return xax, spectra
+
+def well_determined(params, errors):
+    """ mpfit fits whose errors are all non-zero and smaller than the values """
+    if errors is None:
+        return False
+    return (errors > 0).all() and (errors < np.abs(params)).all()
+
+def test_matches_mpfit():
+    xax, spectra = make_spectra()
+    guesses = gaussfitter.onedmoments_stack(xax, spectra)
+    for autoderiv in (True, False):
+        params, errors, chi2, status = gaussfitter.onedgaussfit_stack(xax,
+                spectra, err=1., params=guesses, autoderiv=autoderiv)
+        nchecked = 0
+        for ii in xrange(len(spectra)):
+            mpp,gfit,mpperr,mpchi2 = gaussfitter.onedgaussfit(xax, spectra[ii],
+                    err=np.ones(len(xax)), params=list(guesses[ii]),
+                    autoderiv=autoderiv)
+            if well_determined(mpp, mpperr):
+                nchecked += 1
+                assert status[ii] > 0
+                assert np.allclose(params[ii], mpp, rtol=1e-4, atol=1e-6)
+                assert np.allclose(errors[ii], mpperr, rtol=1e-3)
+                assert np.allclose(chi2[ii], mpchi2, rtol=1e-8)
+        assert nchecked > len(spectra)/4
+
+def test_degenerate_spectra():
+    xax = np.arange(40.)
+    random = np.random.RandomState(1)
+    spike = np.zeros(40)
+    spike[20] = 10
+    edge = 5*np.exp(-(xax-39)**2/(2*1.5**2))
+    spectra = np.array([np.zeros(40),              # nothing to fit
+                        np.ones(40)*3,             # flat
+                        spike,                     # a single channel
+                        random.randn(40),          # noise
+                        edge + random.randn(40)*0.1])
+    guesses = [[0,1,20,2], [3,1,20,2], [0,10,20,3], [0,1,20,2], [0,5,35,3]]
+    params, errors, chi2, status = gaussfitter.onedgaussfit_stack(xax,
+            spectra, err=1., params=guesses)
+    # there is no line to fit in the first three: the errors are undefined,
+    # or (for the single channel) at least too large for collapse_gaussfit's
+    # amplitude cut, where mpfit reports zero errors
+    assert np.isnan(errors[:2]).all()
+    for ii in xrange(3):
+        assert not np.abs(params[ii,1]) > errors[ii,1]
+        mpp,gfit,mpperr,mpchi2 = gaussfitter.onedgaussfit(xax, spectra[ii],
+                err=np.ones(40), params=guesses[ii])
+        assert (mpperr == 0).any()
+    # real fits agree with mpfit
+    for ii in (3,4):
+        mpp,gfit,mpperr,mpchi2 = gaussfitter.onedgaussfit(xax, spectra[ii],
+                err=np.ones(40), params=guesses[ii])
+        assert (mpperr > 0).all()
+        assert np.allclose(params[ii], mpp, rtol=1e-4, atol=1e-6)
+        assert np.allclose(errors[ii], mpperr, rtol=1e-3)
+
+def test_pegged_and_singular():
+    x = np.arange(10.)
+    data = np.array([5-0.5*x, 1+x])
+    line = lambda x,p: p[:,0:1] + p[:,1:2]*x
+    # the slope of the first problem ends at its limit
+    fit = mpfit_batch(line, x, data, [1,1],
+            parinfo=[{}, {'limited':[1,0], 'limits':[0,0]}])
+    assert fit.params[0,1] == 0 and np.isnan(fit.perror[0]).all()
+    assert np.allclose(fit.params[1], [1,1])
+    assert np.isfinite(fit.perror[1]).all()
+    # two parameters with the same effect can't be told apart
+    fit = mpfit_batch(lambda x,p: p[:,0:1] + p[:,1:2] + 0*x, x, data[1],
+            [1,1])
+    assert np.isnan(fit.perror).all() and np.isnan(fit.covar).all()
+    # fixed parameters have zero error
+    fit = mpfit_batch(line, x, data[1], [1,1], parinfo=[{'fixed':1}, {}])
+    assert fit.perror[0,0] == 0 and fit.perror[0,1] > 0
+
+def test_unsupported_parinfo():
+    line = lambda x,p: p[:,0:1] + p[:,1:2]*x
+    for key,value in (('tied','2*p[0]'), ('mpside',2), ('mpmaxstep',0.1)):
+        try:
+            mpfit_batch(line, np.arange(5.), np.arange(5.), [0,1],
+                    parinfo=[{}, {key:value}])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("%s should not be silently ignored" % key)
+    # mpfit's defaults for them are fine
+    mpfit_batch(line, np.arange(5.), np.arange(5.), [0,1],
+            parinfo=[{'tied':'', 'mpside':0, 'mpmaxstep':0}, {}])
+
+def test_collapse_batch_matches_mpfit():
+    for seed in xrange(3):
+        xax, cube = make_cube(seed=seed)
+        batch = np.array(gaussfitter.collapse_gaussfit(cube, xax,
+            return_errors=True, method='batch', chunksize=16))
+        mpfit = np.array(gaussfitter.collapse_gaussfit(cube, xax,
+            return_errors=True, method='mpfit'))
+        for ii,jj in zip(*np.nonzero(np.isfinite(mpfit[0]) |
+                np.isfinite(batch[0]))):
+            errors = mpfit[3:6,ii,jj]
+            if (errors > 0).all():
+                assert np.allclose(batch[:,ii,jj], mpfit[:,ii,jj], rtol=1e-3,
+                        atol=1e-6)
+            else:
+                # a degenerate fit mpfit accepted with zero errors
+                assert np.isnan(batch[:,ii,jj]).all()
@@ -0,0 +1,80 @@
+"""
+parallel_map_array / ParallelPool.map_array should return the same array as
+a serial map, through the shared-memory buffers and a persistent pool.
+"""
+import os
+import tempfile
+import numpy as np
+from contributed.parallel_map import (ParallelPool, SharedArray,
+        parallel_map_array, get_pool, _shm_dir)
+
+def row_stats(row):
+    return np.array([row.sum(), row.max(), np.nanmean(row)])
+
+def test_map_array_matches_serial():
+    cube = np.random.randn(23,5,7)
+    cube[3,2,2] = np.nan
+    expected = np.array(map(row_stats, cube.reshape(23,-1)))
+    pool = ParallelPool(numcores=2)
+    try:
+        for chunksize in (None, 1, 5, 100):
+            result = pool.map_array(row_stats, cube.reshape(23,-1),
+                    chunksize=chunksize)
+            assert result.shape == expected.shape
+            assert np.array_equal(np.isnan(result), np.isnan(expected))
+            assert np.all(result[result==result] == expected[expected==expected])
+        # the same pool is reused, with a SharedArray input
+        shared = SharedArray.from_array(cube)
+        try:
+            assert np.allclose(pool.map_array(np.sum, shared),
+                    cube.sum(axis=(1,2)), equal_nan=True)
+        finally:
+            shared.unlink()
+    finally:
+        pool.close()
+
+def test_parallel_map_array():
+    planes = np.random.randn(10,4,4)
+    result = parallel_map_array(np.linalg.det, planes, numcores=2)
+    assert np.allclose(result, [np.linalg.det(p) for p in planes])
+    # the module-wide pool is kept alive between calls
+    pool = get_pool(2)
+    result = parallel_map_array(np.linalg.det, planes, numcores=2)
+    assert get_pool(2) is pool
+
+def test_no_buffers_left():
+    before = set(os.listdir(_shm_dir or tempfile.gettempdir()))
+    parallel_map_array(np.max, np.random.randn(8,3), numcores=2)
+    after = set(os.listdir(_shm_dir or tempfile.gettempdir()))
+    assert not [fn for fn in after-before if fn.startswith('parallel_map_')]
+
+main_script = """
+import sys
+sys.path.insert(0, %r)
+import numpy
+from contributed.parallel_map import parallel_map_array, get_pool
+def f(row):
+    return row.sum()
+print list(parallel_map_array(f, numpy.ones([8,3]), numcores=2))
+# defined after the default pool's workers were forked
+def g(row):
+    return row.sum() + 10
+print list(parallel_map_array(g, numpy.ones([8,3]), numcores=2))
+print list(get_pool(2).map_array(g, numpy.ones([8,3])))
+"""
+
+def test_functions_defined_later():
+    import subprocess
+    import sys
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    fd, script = tempfile.mkstemp(suffix='.py')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(main_script % root)
+        output = subprocess.check_output([sys.executable, script])
+    finally:
+        os.remove(script)
+    lines = output.strip().splitlines()
+    assert len(lines) == 3
+    for total,line in zip((3, 13, 13), lines):
+        assert eval(line) == [total]*8
@@ -0,0 +1,119 @@
+"""
+ParallelPool.imap / map should yield results in order, re-raise errors from
+the workers, and cancel the remaining work when a call is abandoned, leaving
+the pool usable.
+"""
+import time
+from contributed.parallel_map import ParallelPool, parallel_map
+
+def slow_square(x):
+    # later elements finish first
+    time.sleep(0.01*(10-x%10))
+    return x*x
+
+def fail_on_three(x):
+    if x == 3:
+        raise ValueError("bad element %i" % x)
+    return x
+
+def test_imap_order_and_progress():
+    pool = ParallelPool(numcores=3)
+    try:
+        reports = []
+        results = list(pool.imap(slow_square, range(20),
+            progress=lambda ndone, ntotal: reports.append((ndone, ntotal))))
+        assert results == [x*x for x in range(20)]
+        assert reports[-1] == (20, 20)
+        assert [n for n, t in reports] == sorted(n for n, t in reports)
+        # lazy iterables, chunked
+        assert list(pool.imap(slow_square, iter(range(15)), chunksize=4)) == \
+                [x*x for x in range(15)]
+    finally:
+        pool.close()
+
+def test_errors_propagate():
+    pool = ParallelPool(numcores=2)
+    try:
+        for call in (lambda: pool.map(fail_on_three, range(10), chunksize=1),
+                lambda: list(pool.imap(fail_on_three, range(10))),
+                lambda: parallel_map(fail_on_three, range(10), pool=pool)):
+            try:
+                call()
+            except ValueError, e:
+                assert 'bad element 3' in str(e)
+            else:
+                raise AssertionError("the worker's error was not raised")
+            # the pool is still usable, and no stale results leak in
+            assert pool.map(slow_square, range(12)) == [x*x for x in range(12)]
+        # lambdas use forked processes instead of the pool
+        try:
+            parallel_map(lambda x: fail_on_three(x), range(10), numcores=2)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("the worker's error was not raised")
+    finally:
+        pool.close()
+
+def test_cancellation():
+    pool = ParallelPool(numcores=2)
+    try:
+        for result in pool.imap(slow_square, range(100)):
+            break
+        assert result == 0
+        # the abandoned tasks are cancelled, not waited for or returned
+        t0 = time.time()
+        assert pool.map(slow_square, range(6), chunksize=1) == \
+                [x*x for x in range(6)]
+        assert time.time() - t0 < 1.5
+        assert pool.alive
+    finally:
+        pool.close()
+    assert not pool.alive
+
+main_script = """
+import sys
+sys.path.insert(0, %r)
+import functools
+from contributed.parallel_map import parallel_map, ParallelPool
+def f(x):
+    return x + 100
+print parallel_map(f, range(8), numcores=2)
+# defined after the default pool's workers were forked
+def g(x):
+    return x + 200
+print parallel_map(g, range(8), numcores=2)
+# redefined: the workers must not use the old g
+def g(x):
+    return x + 300
+print parallel_map(g, range(8), numcores=2)
+# only the task, not the function, is new to the workers
+pool = ParallelPool(numcores=2)
+pool.map(f, range(4))
+class Offset(object):
+    def __init__(self, offset):
+        self.offset = offset
+def add(x, offset):
+    return x + offset.offset
+pool._main_functions['add'] = add
+print pool.map(functools.partial(add, offset=Offset(400)), range(8))
+pool.close()
+"""
+
+def test_functions_defined_later():
+    import os
+    import subprocess
+    import sys
+    import tempfile
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    fd, script = tempfile.mkstemp(suffix='.py')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(main_script % root)
+        output = subprocess.check_output([sys.executable, script])
+    finally:
+        os.remove(script)
+    lines = output.strip().splitlines()
+    for offset,line in zip((100, 200, 300, 400), lines):
+        assert eval(line) == [x + offset for x in range(8)]
+    assert len(lines) == 4
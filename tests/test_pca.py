@@ -0,0 +1,91 @@
+"""
+Compare PCA_tools' chunked / randomized PCA cleaning with a direct
+diagonalization of the full covariance, on a 144-bolometer timestream with a
+few correlated 'atmospheric' components.
+"""
+import time
+import numpy as np
+from agpy import PCA_tools
+
+def timestream(ntime=20000, nbolos=144, ncorr=5, seed=0):
+    random = np.random.RandomState(seed)
+    atmo = np.dot(random.randn(ntime,ncorr), random.randn(ncorr,nbolos))
+    return atmo*10 + random.randn(ntime,nbolos)
+
+def direct_clean(arr, ncomps, keep=False):
+    evals,evects = np.linalg.eigh(np.dot(arr.T,arr))
+    evects = evects[:,::-1]
+    efuncarr = np.dot(arr,evects)
+    if keep:
+        efuncarr[:,ncomps:] = 0
+    else:
+        efuncarr[:,:ncomps] = 0
+    return np.inner(efuncarr,evects)
+
+def test_chunked_matches_direct():
+    arr = timestream()
+    pca = PCA_tools.PCA(chunksize=3000)
+    for ncomps in (5,13):
+        assert np.abs(pca.subtract(arr,ncomps) - direct_clean(arr,ncomps)).max() < 1e-9
+        assert np.abs(pca.keep(arr,ncomps) - direct_clean(arr,ncomps,keep=True)).max() < 1e-9
+
+def test_randomized():
+    arr = timestream()
+    pca = PCA_tools.PCA(method='randomized')
+    assert np.abs(pca.subtract(arr,5) - direct_clean(arr,5)).max() < 1e-6
+
+def test_float32():
+    arr = timestream()
+    cleaned = PCA_tools.pca_subtract(arr.astype('float32'),5)
+    assert cleaned.dtype == np.float32
+    assert np.abs(cleaned - direct_clean(arr,5)).max() < 1e-3
+
+def test_scans_and_cache():
+    cube = timestream().reshape(4,5000,144)
+    pca = PCA_tools.PCA()
+    cleaned = pca.subtract(cube,13)
+    assert len(pca.cache) == 4
+    assert np.abs(cleaned[2] - direct_clean(cube[2],13)).max() < 1e-9
+    pca.keep(cube,13)
+    assert len(pca.cache) == 4
+
+def test_cache_lru():
+    cube = timestream(ntime=400,nbolos=20).reshape(4,100,20)
+    pca = PCA_tools.PCA(maxcache=3)
+    for scan in cube[:3]:
+        pca.components(scan,5)
+    # a hit keeps scan 0, so the least recently used (scan 1) is dropped
+    pca.components(cube[0],5)
+    pca.components(cube[3],5)
+    keys = [pca._key(pca._prepare(scan),5) for scan in cube]
+    assert pca.cache.keys() == [keys[2],keys[0],keys[3]]
+
+def test_efuncs():
+    arr = timestream()
+    efuncarr,covmat,evals,evects = PCA_tools.efuncs(arr,return_others=True)
+    assert efuncarr.shape == arr.shape
+    assert np.abs(evals - np.linalg.eigvalsh(np.dot(arr.T,arr))[::-1]).max() < 1e-9*evals[0]
+
+if __name__ == "__main__":
+    test_chunked_matches_direct()
+    test_randomized()
+    test_float32()
+    test_scans_and_cache()
+    test_cache_lru()
+    test_efuncs()
+
+    for ntime in (100000,200000,400000):
+        arr = timestream(ntime).astype('float32')
+        t0 = time.time()
+        PCA_tools.PCA(cache=False).subtract(arr,13)
+        t1 = time.time()
+        direct_clean(arr,13)
+        t2 = time.time()
+        print "%7i samples: chunked %0.2fs, full covariance %0.2fs" % (ntime, t1-t0, t2-t1)
+
+"""
+RESULTS: (numpy 1.16, one core, 144 bolometers, 13 components, float32)
+ 100000 samples: chunked 0.36s, full covariance 0.87s
+ 200000 samples: chunked 0.60s, full covariance 1.49s
+ 400000 samples: chunked 1.29s, full covariance 3.21s
+"""
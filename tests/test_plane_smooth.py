@@ -0,0 +1,47 @@
+"""
+cubes.plane_smooth(batched=True) should give the same cube as smoothing one
+plane at a time, for every smooth option: those smooth_planes supports are
+passed to it, and the others fall back to the per-plane path.
+"""
+import numpy as np
+from agpy import cubes
+from AG_fft_tools.smooth_tools import smooth_planes, smooth_planes_kwargs
+
+def make_cube():
+    cube = np.random.randn(4,24,30)
+    cube[1,5,6] = np.nan
+    return cube
+
+def test_batched_matches_planes():
+    cube = make_cube()
+    for kwargs in ({'kerneltype':'tophat', 'use_fft':True},
+            {'kerneltype':'gaussian', 'use_fft':True, 'psf_pad':True},
+            {'kerneltype':'tophat', 'interpolate_nan':True, 'nthreads':1},
+            {'kerneltype':'gaussian', 'boundary':'fill', 'quiet':True},
+            {'kerneltype':'gaussian', 'psf_pad':False},
+            {'kerneltype':'boxcar', 'downsample':True, 'downsample_factor':2},
+            {'kerneltype':'tophat', 'boundary':'wrap'}):
+        batched = cubes.plane_smooth(cube, kernelwidth=2, batched=True,
+                **kwargs)
+        planes = cubes.plane_smooth(cube, kernelwidth=2, batched=False,
+                parallel=False, **kwargs)
+        assert batched.shape == planes.shape
+        both = np.isfinite(planes)
+        assert np.array_equal(both, np.isfinite(batched))
+        assert np.abs(batched[both] - planes[both]).max() < 1e-10
+
+def test_smooth_planes_kwargs():
+    assert smooth_planes_kwargs({'use_fft':True, 'kerneltype':'tophat'}) == \
+            {'kerneltype':'tophat'}
+    for unsupported in ({'use_fft':False}, {'psf_pad':False},
+            {'downsample':True}, {'boundary':'wrap'}, {'tilesize':64}):
+        assert smooth_planes_kwargs(unsupported) is None
+
+def test_smooth_planes_rejects_unknown():
+    for kerneltype in ('gaussian', 'tophat'):
+        try:
+            smooth_planes(make_cube(), kerneltype=kerneltype, use_fft=True)
+        except TypeError:
+            pass
+        else:
+            raise AssertionError("use_fft should not be silently ignored")
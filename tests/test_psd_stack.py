@@ -0,0 +1,36 @@
+"""
+PSD2_stack should reproduce PSD2 and pspec plane by plane
+"""
+import numpy as np
+from AG_fft_tools import psds
+
+def test_psd_stack():
+    for shape in [(32,32),(31,40)]:
+        stack = np.random.randn(4,*shape)
+        stack[1,3,4] = np.nan
+        for kwargs in ({}, {'hanning':True}):
+            new = psds.PSD2_stack(stack, **kwargs)
+            for plane,psd in zip(stack,new):
+                ref = psds.PSD2(plane, **kwargs)
+                assert np.abs(ref-psd).max() < 1e-12*ref.max()
+        freq,spectra = psds.PSD2_stack(stack, oned=True)
+        for plane,spectrum in zip(stack,spectra):
+            reffreq,ref = psds.pspec(psds.PSD2(plane))
+            assert np.allclose(freq, reffreq)
+            assert np.allclose(spectrum, ref)
+
+def test_wavnum_scale():
+    for shape in [(32,48),(31,40),(40,31)]:
+        stack = np.random.randn(3,*shape)
+        scale = psds.wavenumber_scale(shape)
+        assert scale.shape == shape
+        # zero at the (shifted) zero frequency, 1 at each axis's highest
+        assert scale[shape[0]//2,shape[1]//2] == 0
+        assert np.allclose(scale[0,shape[1]//2], 1)
+        assert np.allclose(scale[shape[0]//2,0], 1)
+        plain = psds.PSD2_stack(stack)
+        new = psds.PSD2_stack(stack, wavnum_scale=True)
+        assert np.allclose(new, plain*scale)
+        for plane,psd in zip(stack,new):
+            ref = psds.PSD2(plane, wavnum_scale=True)
+            assert np.abs(ref-psd).max() < 1e-12*ref.max()
@@ -0,0 +1,33 @@
+"""
+Check that the batch PSF photometry in psf_photometry agrees with
+gaussfitter.gaussfit star by star.
+"""
+import numpy as np
+from agpy import gaussfitter, psf_photometry
+
+def make_frame(nstars=50, shape=(300,300), seed=0):
+    rs = np.random.RandomState(seed)
+    xcen = rs.uniform(10, shape[1]-10, nstars)
+    ycen = rs.uniform(10, shape[0]-10, nstars)
+    data = rs.randn(*shape)*0.05 + 1
+    for x,y in zip(xcen,ycen):
+        data += gaussfitter.twodgaussian([0,2,x,y,1.4,1.8],0,0,1,shape=shape)
+    return data, xcen, ycen
+
+def test_fit_frame():
+    data, xcen, ycen = make_frame()
+    table = psf_photometry.fit_frame(data, xcen, ycen, size=14, rotate=False)
+    assert (table.status > 0).all()
+    stamps, x0, y0 = psf_photometry.cut_stamps(data, xcen, ycen, 14)
+    for ii in xrange(5):
+        params = gaussfitter.gaussfit(stamps[ii], rotate=0)
+        assert abs(params[2]+x0[ii] - table.xcen[ii]) < 1e-4
+        assert abs(params[3]+y0[ii] - table.ycen[ii]) < 1e-4
+        assert abs(params[1] - table.amplitude[ii]) < 1e-4
+    assert abs(np.median(table.flux) - 2*np.pi*2*1.4*1.8) < 1
+
+def test_cut_stamps_edges():
+    data = np.arange(100.).reshape(10,10)
+    stamps, x0, y0 = psf_photometry.cut_stamps(data, [0,5], [0,5], 4)
+    assert np.isnan(stamps[0,:2]).all() and np.isnan(stamps[0,:,:2]).all()
+    assert (stamps[1] == data[3:7,3:7]).all()
@@ -0,0 +1,97 @@
+"""
+Compare the bincount-based radial profile statistics with a direct loop over
+the bins.
+"""
+import numpy as np
+from AG_image_tools import radialprofile
+
+def loop_profile(image, statistic, binsize=0.5, mask=None):
+    binner = radialprofile.get_binner(image.shape, binsize=binsize)
+    bins, whichbin = binner.bins, binner.whichbin
+    if mask is None:
+        mask = np.ones(image.shape, dtype='bool')
+    prof = []
+    for b in xrange(1, len(bins)):
+        values = image.flat[mask.flat*(whichbin==b)]
+        if len(values) == 0:
+            prof.append(np.nan)
+        elif statistic == 'mad':
+            prof.append(np.median(np.abs(values-np.median(values)))/0.6745)
+        else:
+            prof.append(statistic(values))
+    return np.array(prof)
+
+def test_statistics():
+    image = np.random.randn(60,70) + 10
+    mask = np.random.rand(60,70) > 0.3
+    for kwargs,statistic in [({'stddev':True},np.std),
+            ({'median':True},np.median), ({'mad':True},'mad')]:
+        for m in (None, mask):
+            new = radialprofile.azimuthalAverage(image, mask=m, **kwargs)
+            old = loop_profile(image, statistic, mask=m)
+            assert np.allclose(new, old, equal_nan=True)
+
+def baseline_profile(image, statistic, binsize=0.5, mask=None, sector=None):
+    """ One image's profile, binned as the original azimuthalAverage did """
+    y, x = np.indices(image.shape)
+    center = np.array([(x.max()-x.min())/2.0, (y.max()-y.min())/2.0])
+    r = np.hypot(x - center[0], y - center[1])
+    nbins = int(np.round(r.max() / binsize)+1)
+    bins = np.linspace(0,nbins*binsize,nbins+1)
+    if mask is None:
+        mask = np.ones(image.shape, dtype='bool')
+    if sector is not None:
+        theta = np.arctan2(x - center[0], y - center[1])
+        theta[theta < 0] += 2*np.pi
+        theta_deg = theta*180.0/np.pi
+        mask = mask & (theta_deg > sector[0]) & (theta_deg < sector[1])
+    whichbin = np.digitize(r.flat, bins)
+    prof = []
+    for b in xrange(1, nbins+1):
+        values = image.flat[mask.flat*(whichbin==b)]
+        prof.append(statistic(values) if len(values) else np.nan)
+    return np.array(prof)
+
+def test_stack():
+    stack = np.random.randn(5,40,50)
+    mask = np.random.rand(40,50) > 0.2
+    binner = radialprofile.get_binner(stack.shape[1:], binsize=1.0)
+    assert binner is radialprofile.get_binner((40,50), binsize=1)
+    for statistic,function in (('mean',np.mean), ('stddev',np.std),
+            ('median',np.median)):
+        for m in (None, mask):
+            profiles = binner.profiles(stack, statistic, mask=m)
+            assert profiles.shape == (5, binner.nbins)
+            for image,prof in zip(stack,profiles):
+                assert np.allclose(prof, baseline_profile(image, function,
+                    binsize=1.0, mask=m), equal_nan=True)
+    azbins = np.linspace(0,359.9999999999999,5)
+    binner = radialprofile.get_binner(stack.shape[1:], azbins=azbins)
+    profiles = binner.profiles(stack)
+    assert profiles.shape == (5, 4, binner.nbins)
+    for image,prof in zip(stack,profiles):
+        for sector,sectorprof in zip(zip(azbins[:-1],azbins[1:]),prof):
+            assert np.allclose(sectorprof, baseline_profile(image, np.mean,
+                sector=sector), equal_nan=True)
+
+def test_bins_keywords():
+    image = np.random.randn(40,50)
+    mask = np.random.rand(40,50) > 0.2
+    azbins = np.linspace(0,359.9999999999999,5)
+    # steps and mask are applied to each angular range, as azimuthalAverage
+    # would with that range's mask
+    az,rr,profiles = radialprofile.azimuthalAverageBins(image, 5, steps=True,
+            mask=mask)
+    nbins = radialprofile.get_binner(image.shape).nbins
+    assert rr.shape == (2*nbins,) and len(profiles) == 4
+    for sector,prof in zip(zip(azbins[:-1],azbins[1:]),profiles):
+        expected = baseline_profile(image, np.mean, mask=mask, sector=sector)
+        assert np.allclose(prof, np.repeat(expected, 2), equal_nan=True)
+    az,(rr,prof) = radialprofile.azimuthalAverageBins(image, 1, steps=True)
+    assert rr.shape == prof.shape == (2*nbins,)
+    try:
+        radialprofile.azimuthalAverageBins(image, 5, returnradius=True)
+    except TypeError:
+        pass
+    else:
+        raise AssertionError("unknown keywords should raise TypeError")
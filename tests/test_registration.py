@@ -0,0 +1,16 @@
+"""
+register_stack should recover known sub-pixel offsets
+"""
+import numpy as np
+from AG_fft_tools import registration
+from AG_fft_tools.shift import shift
+
+def test_register_stack():
+    yy,xx = np.indices((64,60))
+    ref = np.exp(-((xx-30.)**2+(yy-32.)**2)/(2*4**2))
+    offsets = np.random.uniform(-5,5,(10,2))
+    frames = np.array([shift(ref,-dx,-dy) for dx,dy in offsets])
+    aligned, found = registration.register_stack(frames, reference=ref,
+            usfac=20)
+    assert np.abs(found-offsets).max() <= 0.5/20 + 1e-6
+    assert np.abs(aligned-ref).max() < 0.05
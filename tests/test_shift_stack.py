@@ -0,0 +1,21 @@
+"""
+shift_stack and shift1d_stack should match shifting one plane at a time
+"""
+import numpy as np
+from AG_fft_tools.shift import shift, shift1d, shift_stack, shift1d_stack
+
+def test_shift_stack():
+    stack = np.random.randn(7,32,27)
+    stack[2,3,4] = np.nan
+    dx, dy = np.random.uniform(-3,3,(2,7))
+    shifted = shift_stack(stack, dx, dy, chunksize=3)
+    for plane,x,y,result in zip(stack, dx, dy, shifted):
+        assert np.abs(shift(plane, x, y) - result).max() < 1e-12
+
+def test_shift1d_stack():
+    timestreams = np.random.randn(101,6)
+    dx = np.random.uniform(-3,3,6)
+    shifted = shift1d_stack(timestreams, dx, axis=0)
+    for ii in range(6):
+        assert np.abs(shift1d(timestreams[:,ii], dx[ii]) -
+                shifted[:,ii]).max() < 1e-12
@@ -0,0 +1,42 @@
+"""
+With complextype=np.complex64 the FFT tools should return single-precision
+results that agree with the double-precision ones to ~1e-6 of the peak.
+"""
+import numpy as np
+from AG_fft_tools.convolve_nd import convolvend
+from AG_fft_tools.shift import shift
+from AG_fft_tools.upsample import upsample_image
+from AG_fft_tools.psds import PSD2
+
+def close(single, double, tol=1e-5):
+    return np.abs(single - double).max() <= tol*np.abs(double).max()
+
+def test_convolvend_complex64():
+    image = np.random.randn(30,40)
+    image[3,4] = np.nan
+    kernel = np.ones([5,5])/25.
+    for use_rfft in (True, False):
+        for interpolate_nan in (False, True):
+            kwargs = dict(use_rfft=use_rfft, interpolate_nan=interpolate_nan,
+                    quiet=True)
+            single = convolvend(image, kernel, complextype=np.complex64, **kwargs)
+            assert single.dtype == np.float32
+            assert close(single, convolvend(image, kernel, **kwargs))
+
+def test_shift_complex64():
+    image = np.random.randn(32,30)
+    single = shift(image, 1.3, -2.4, complextype=np.complex64)
+    assert single.dtype == np.float32
+    assert close(single, shift(image, 1.3, -2.4))
+
+def test_upsample_complex64():
+    image = np.random.randn(16,16)
+    single = upsample_image(image, 2, complextype=np.complex64)
+    assert single.real.dtype == np.float32
+    assert close(single, upsample_image(image, 2))
+
+def test_psd_complex64():
+    image = np.random.randn(32,32)
+    single = PSD2(image, complextype=np.complex64)
+    assert single.dtype == np.float32
+    assert close(single, PSD2(image))
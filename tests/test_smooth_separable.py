@@ -0,0 +1,50 @@
+"""
+smooth's separable (1D convolution) path should match the 2D FFT path, and
+honor complextype and nthreads the same way.
+"""
+import numpy as np
+from AG_fft_tools.smooth_tools import smooth
+from AG_fft_tools.convolve_nd import convolve_separable, convolvend
+
+def test_separable_matches_2d():
+    image = np.random.randn(60,45)
+    image[20,30] = np.nan
+    for kerneltype in ('gaussian','boxcar'):
+        for kwargs in ({}, {'interpolate_nan':True},
+                {'ignore_edge_zeros':True, 'nwidths':8}):
+            separable = smooth(image, 3, kerneltype, **kwargs)
+            full = smooth(image, 3, kerneltype, separable=False, **kwargs)
+            both = np.isfinite(full)
+            assert np.array_equal(both, np.isfinite(separable))
+            assert np.abs(separable[both] - full[both]).max() < 1e-10
+
+def test_complextype():
+    image = np.random.randn(40,50).astype('float32')
+    for kerneltype in ('gaussian','tophat'):
+        single = smooth(image, 2, kerneltype, complextype=np.complex64,
+                nthreads=2)
+        assert single.dtype == np.float32
+        double = smooth(image, 2, kerneltype)
+        assert double.dtype == np.float64
+        assert np.abs(single-double).max() < 1e-5*np.abs(double).max()
+
+def test_separable_precision():
+    image = np.random.randn(40,50).astype('float32')
+    kernels = [np.ones(5)/5., np.ones(3)/3.]
+    # direct (narrow) and FFT (wide) 1D convolutions
+    for direct_max in (None, 1):
+        assert convolve_separable(image, kernels,
+                direct_max=direct_max).dtype == np.float32
+        assert convolve_separable(image.astype('float64'), kernels,
+                direct_max=direct_max).dtype == np.float64
+        assert convolve_separable(image, kernels, direct_max=direct_max,
+                complextype=np.complex128).dtype == np.float64
+    expected = convolvend(image.astype('float64'),
+            np.multiply.outer(*kernels), psf_pad=True)
+    assert np.abs(convolve_separable(image, kernels, direct_max=1) -
+            expected).max() < 1e-5
+
+def test_unsupported_options_use_2d_path():
+    image = np.random.randn(30,30)
+    assert smooth(image, 2, psf_pad=False).shape == image.shape
+    assert np.iscomplexobj(smooth(image, 2, return_fft=True))
@@ -0,0 +1,93 @@
+"""
+A timestream store should hand back the scans in the Flagger's
+[scan, time, bolo] layout, with NaNs past the end of shorter scans
+"""
+import os
+import shutil
+import tempfile
+import numpy as np
+from agpy import timestream_store
+
+def test_store():
+    scans_info = np.array([[0,99],[120,199],[250,349]])
+    ncscans,scanlen,whscan,whempty = timestream_store.scan_layout(scans_info)
+    assert scanlen == 100 and len(whempty) == 20
+    nbolos = 7
+    timestream = np.random.randn(400, nbolos).astype('float32')
+    flags = np.random.randint(0, 2, (400, nbolos))
+    shape = [3, scanlen, nbolos]
+
+    path = tempfile.mkdtemp()
+    try:
+        timestream_store.write_store(os.path.join(path, 'store'),
+                {'scans_info': scans_info},
+                {'ac_bolos': timestream, 'flags': flags}, whscan, whempty,
+                shape)
+        store = timestream_store.TimestreamStore(os.path.join(path, 'store'))
+        assert 'ac_bolos' in store and 'weight' not in store
+        assert np.all(store.metadata['scans_info'] == scans_info)
+
+        expected = timestream[whscan].reshape(shape)
+        expected.reshape(-1, nbolos)[whempty] = np.nan
+        data = store['ac_bolos']
+        assert isinstance(data, np.memmap) and data.dtype == np.float32
+        assert np.array_equal(np.isnan(data), np.isnan(expected))
+        assert np.all(data[~np.isnan(data)] == expected[~np.isnan(expected)])
+        assert np.all(store.scan('flags', 1)[:80] == flags[120:200])
+
+        # copy-on-write: changing the flags leaves the file alone
+        store['flags'][0] += 1
+        reopened = timestream_store.TimestreamStore(os.path.join(path, 'store'))
+        assert np.all(reopened.scan('flags', 0) == flags[:100])
+    finally:
+        shutil.rmtree(path)
+
+def test_source_stamp():
+    path = tempfile.mkdtemp()
+    try:
+        source = os.path.join(path, 'scan.sav')
+        with open(source, 'w') as f:
+            f.write('x'*100)
+        storepath = os.path.join(path, 'store')
+        def write(metadata, name):
+            timestream_store.write_store(storepath, metadata,
+                    {name: np.zeros([10,2])}, np.arange(10),
+                    np.array([], dtype='int'), [1,10,2])
+        write({'source_stamp': timestream_store.source_stamp([source])},
+                'old')
+        assert timestream_store.is_store(storepath, [source])
+        # a changed modification time, or size, makes it out of date
+        os.utime(source, (0, os.path.getmtime(source)-10))
+        assert not timestream_store.is_store(storepath, [source])
+        assert timestream_store.is_store(storepath)
+        write({'source_stamp': timestream_store.source_stamp([source])},
+                'new')
+        assert timestream_store.is_store(storepath, [source])
+        with open(source, 'a') as f:
+            f.write('x')
+        assert not timestream_store.is_store(storepath, [source])
+        # rewriting replaces the old timestreams
+        assert timestream_store.TimestreamStore(storepath).variables == ['new']
+        # stores written without a stamp are out of date
+        write({}, 'new')
+        assert not timestream_store.is_store(storepath, [source])
+        # but without the source, use the store
+        os.remove(source)
+        assert timestream_store.is_store(storepath, [source])
+    finally:
+        shutil.rmtree(path)
+
+def test_can_write():
+    path = tempfile.mkdtemp()
+    try:
+        assert timestream_store.can_write(os.path.join(path, 'a', 'store'))
+        # nothing can be written below a file
+        blocker = os.path.join(path, 'file')
+        open(blocker, 'w').close()
+        assert not timestream_store.can_write(os.path.join(blocker, 'store'))
+        os.chmod(path, 0555)
+        assert timestream_store.can_write(os.path.join(path, 'store')) == \
+                os.access(path, os.W_OK)
+    finally:
+        os.chmod(path, 0755)
+        shutil.rmtree(path)
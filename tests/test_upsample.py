@@ -0,0 +1,17 @@
+"""
+dftups' chirp-z and tiled matrix methods should agree with the dense matrix
+products
+"""
+import numpy as np
+from AG_fft_tools import upsample
+
+def test_dftups_methods():
+    for shape in [(32,32),(31,40)]:
+        inp = np.random.randn(*shape) + 1j*np.random.randn(*shape)
+        for args in [(15,15,10,7.3,-20),(shape[0]*3,shape[1]*3,3,0,0)]:
+            dense = upsample.dftups(inp, *args, method='matrix',
+                    tilesize=1024)
+            for kwargs in [dict(method='czt'),
+                    dict(method='matrix', tilesize=7)]:
+                other = upsample.dftups(inp, *args, **kwargs)
+                assert np.abs(other-dense).max() < 1e-12*np.abs(dense).max()